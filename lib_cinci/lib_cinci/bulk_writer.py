@@ -0,0 +1,91 @@
+import logging
+import logging.config
+from StringIO import StringIO
+
+from pandas.io import sql
+from sqlalchemy.schema import CreateTable
+
+from lib_cinci.config import load
+
+logging.config.dictConfig(load('logger_config.yaml'))
+logger = logging.getLogger()
+
+#Drop-in replacement for DataFrame.to_sql for large tables. Rows are sent
+#with COPY FROM STDIN (as CSV) instead of INSERT batches. Column types are
+#the same ones to_sql would use, indexes are created after the data is
+#loaded and everything happens in a single transaction, so other
+#connections never see a half written table.
+
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+def frame_to_csv(df):
+    '''
+        Write df as CSV for COPY: no header, NULL as an empty field and
+        floats with enough digits to get the same value back
+    '''
+    buf = StringIO()
+    df.to_csv(buf, index=False, header=False, na_rep='',
+              float_format='%.17g', encoding='utf-8')
+    buf.seek(0)
+    return buf
+
+def create_table_statement(df, name, engine, schema=None, dtype=None):
+    '''
+        CREATE TABLE statement for df (without indexes), with the same
+        column types as DataFrame.to_sql
+    '''
+    pandas_sql = sql.SQLDatabase(engine, schema=schema)
+    table = sql.SQLTable(name, pandas_sql, frame=df, index=False,
+                         schema=schema, dtype=dtype)
+    return str(CreateTable(table.table).compile(engine))
+
+def copy_to_sql(df, name, engine, schema=None, if_exists='fail', index=True,
+                dtype=None, chunksize=50000, indexes=[]):
+    '''
+        Save df in table name, arguments are the same as DataFrame.to_sql.
+        Index columns (if index is True) get one index each, as to_sql does,
+        indexes is a list of extra indexes to create, each one a list of
+        columns
+    '''
+    if index:
+        index_columns = [c for c in df.index.names if c is not None]
+        df = df.reset_index()
+    else:
+        index_columns = []
+
+    table = quote_identifier(name)
+    if schema is not None:
+        table = '{}.{}'.format(quote_identifier(schema), table)
+
+    con = engine.raw_connection()
+    cur = con.cursor()
+    try:
+        cur.execute('SELECT to_regclass(%s);', (table,))
+        exists = cur.fetchone()[0] is not None
+        if exists and if_exists == 'fail':
+            raise ValueError('Table {} already exists.'.format(table))
+        if exists and if_exists == 'replace':
+            cur.execute('DROP TABLE {};'.format(table))
+        if not exists or if_exists == 'replace':
+            cur.execute(create_table_statement(df, name, engine, schema, dtype))
+
+        columns = ', '.join(quote_identifier(c) for c in df.columns)
+        copy = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(table, columns)
+        for start in range(0, len(df), chunksize):
+            cur.copy_expert(copy, frame_to_csv(df.iloc[start:start+chunksize]))
+
+        for column in index_columns:
+            cur.execute('CREATE INDEX ON {} ({});'.format(table,
+                                                          quote_identifier(column)))
+        for columns in indexes:
+            cur.execute('CREATE INDEX ON {} ({});'.format(table,
+                        ', '.join(quote_identifier(c) for c in columns)))
+        con.commit()
+    except:
+        con.rollback()
+        raise
+    finally:
+        cur.close()
+        con.close()
+    logger.debug('Copied {} rows to {}'.format(len(df), table))
@@ -12,10 +12,11 @@ import pandas as pd
 import util
 from sqlalchemy import create_engine
 from lib_cinci.db import uri
-from lib_cinci.config import load
+from lib_cinci.config import load, main
 
 from lib_cinci.exceptions import SchemaMissing
 from lib_cinci.features import tables_and_columns_for_schema, existing_feature_schemas
+from lib_cinci.feature_cache import FeatureCache, table_version
 
 logging.config.dictConfig(load('logger_config.yaml'))
 logger = logging.getLogger()
@@ -49,9 +50,18 @@ class FeatureLoader():
         engine = create_engine(uri)
         self.con = engine.raw_connection()
         self.con.cursor().execute("SET SCHEMA '{}'".format(schema))
+        self.con.commit()
 
+        self.schema = schema
         self.start_date = start_date
         self.end_date = end_date
+        #Rows fetched at a time when reading features
+        self.chunksize = 50000
+
+        #If a folder is set in config.yaml, feature tables are cached
+        #there and read from disk while they do not change
+        cache_folder = main.get('feature_cache')
+        self.cache = FeatureCache(cache_folder) if cache_folder else None
 
     def load_parcels_inspections(self, only_residential):
         logger.debug("Loading labels for [{}, {}]".format(self.start_date,
@@ -100,12 +110,10 @@ class FeatureLoader():
 
         # can not load all features directly, because some of them are dummy
         # variables replace these with the names of their dummy variables
-        dummy_variables = {"home_use": ["single-family", "two-family",
-                           "three-family", "multi-family", "mixed-use"]}
         features_to_load = self.resolve_dummy_variables(features_to_load,
-                                                        dummy_variables)
+                                                        util.dummy_variables)
 
-        query = ("SELECT feature.*, labels.inspection_date "
+        query = ("SELECT {columns}, labels.inspection_date "
                  "FROM  house_type AS feature "
                  "JOIN parcels_inspections AS labels "
                  "ON feature.parcel_id = labels.parcel_id "
@@ -113,7 +121,9 @@ class FeatureLoader():
                  "AND labels.inspection_date < %(end_date)s")
 
         features = self.__read_feature_from_db(query, features_to_load,
-                                               drop_duplicates=True)
+                                               drop_duplicates=True,
+                                               table_name='house_type',
+                                               keys=['parcel_id'])
         logger.debug("... {} rows, {} features".format(len(features),
                                                        len(features.columns)))
         return features
@@ -121,13 +131,14 @@ class FeatureLoader():
     def load_named_entities(self, features_to_load):
         logger.debug("Loading owner features for [{}, {}]".format(
             self.start_date, self.end_date))
-        query = ("SELECT feature.* "
+        query = ("SELECT {columns} "
                  "FROM named_entities AS feature "
                  "WHERE feature.inspection_date >= %(start_date)s "
                  "AND feature.inspection_date < %(end_date)s")
 
         features = self.__read_feature_from_db(query, features_to_load,
-                                               drop_duplicates=True)
+                                               drop_duplicates=True,
+                                               table_name='named_entities')
         logger.debug("... {} rows, {} features".format(len(features),
                                                        len(features.columns)))
         return features
@@ -135,7 +146,7 @@ class FeatureLoader():
     def load_parc_area(self, features_to_load):
         logger.debug("Loading parcel areas for [{}, {}]".format(
             self.start_date, self.end_date))
-        query = ("SELECT feature.*, labels.inspection_date "
+        query = ("SELECT {columns}, labels.inspection_date "
                  "FROM parc_area AS feature "
                  "JOIN parcels_inspections AS labels "
                  "ON feature.parcel_id = labels.parcel_id "
@@ -143,7 +154,9 @@ class FeatureLoader():
                  "AND labels.inspection_date < %(end_date)s")
 
         features = self.__read_feature_from_db(query, features_to_load,
-                                               drop_duplicates=True)
+                                               drop_duplicates=True,
+                                               table_name='parc_area',
+                                               keys=['parcel_id'])
         logger.debug("... {} rows, {} features".format(len(features),
                                                        len(features.columns)))
         return features
@@ -160,7 +173,8 @@ class FeatureLoader():
                  "AND labels.inspection_date < %(end_date)s")
 
         features = self.__read_feature_from_db(query, features_to_load,
-                                               drop_duplicates=True)
+                                               drop_duplicates=True,
+                                               table_name='parc_year')
         logger.debug("... {} rows, {} features".format(len(features),
                                                        len(features.columns)))
         return features
@@ -168,13 +182,14 @@ class FeatureLoader():
     def load_crime_features(self, features_to_load):
         logger.debug("Loading crime features for [{}, {}]".format(
             self.start_date, self.end_date))
-        query = ("SELECT feature.* "
+        query = ("SELECT {columns} "
                  "FROM crime_old AS feature "
                  "WHERE feature.inspection_date >= %(start_date)s "
                  "AND feature.inspection_date < %(end_date)s")
 
         features = self.__read_feature_from_db(query, features_to_load,
-                                               drop_duplicates=True)
+                                               drop_duplicates=True,
+                                               table_name='crime_old')
         logger.debug("... {} rows, {} features".format(len(features),
                                                        len(features.columns)))
         return features
@@ -182,13 +197,14 @@ class FeatureLoader():
     def load_crime_new_features(self, features_to_load):
         logger.debug("Loading crime features for [{}, {}]".format(
             self.start_date, self.end_date))
-        query = ("SELECT feature.* "
+        query = ("SELECT {columns} "
                  "FROM crime_new AS feature "
                  "WHERE feature.inspection_date >= %(start_date)s "
                  "AND feature.inspection_date < %(end_date)s")
 
         features = self.__read_feature_from_db(query, features_to_load,
-                                               drop_duplicates=True)
+                                               drop_duplicates=True,
+                                               table_name='crime_new')
         logger.debug("... {} rows, {} features".format(len(features),
                                                        len(features.columns)))
         return features
@@ -196,13 +212,14 @@ class FeatureLoader():
     def load_tax(self, features_to_load):
         logger.debug("load_tax: Loading tax features for [{}, {})".format(
             self.start_date, self.end_date))
-        query = ("SELECT feature.* "
+        query = ("SELECT {columns} "
                  "FROM tax  AS feature "
                  "WHERE feature.inspection_date >= %(start_date)s "
                  "AND feature.inspection_date < %(end_date)s")
 
         features = self.__read_feature_from_db(query, features_to_load,
-                                               drop_duplicates=True)
+                                               drop_duplicates=True,
+                                               table_name='tax')
         logger.debug("... {} rows, {} features".format(len(features),
                                                        len(features.columns)))
         #logger.debug('Loaded tax features head:\n%s\nType: %s' % (features.head(1), type(features)))
@@ -212,7 +229,7 @@ class FeatureLoader():
     def load_census_2010(self, features_to_load):
         logger.debug("Loading census features for [{}, {})".format(
             self.start_date, self.end_date))
-        query = ("SELECT feature.*, labels.inspection_date "
+        query = ("SELECT {columns}, labels.inspection_date "
                  "FROM  census_2010 AS feature "
                  "JOIN parcels_inspections AS labels "
                  "ON feature.parcel_id = labels.parcel_id "
@@ -220,7 +237,9 @@ class FeatureLoader():
                  "AND labels.inspection_date < %(end_date)s")
 
         features = self.__read_feature_from_db(query, features_to_load,
-                                               drop_duplicates=True)
+                                               drop_duplicates=True,
+                                               table_name='census_2010',
+                                               keys=['parcel_id'])
         logger.debug("... {} rows, {} features".format(len(features),
                                                        len(features.columns)))
         return features
@@ -238,7 +257,7 @@ class FeatureLoader():
             #This piece of code has some security concerns since it is
             #vulnerable to SQL injection, if this goes into production
             #it will need a local SQL verification
-            query = ("SELECT feature.* "
+            query = ("SELECT {columns} "
                      "FROM "+table_name+"  AS feature "
                      "WHERE feature.inspection_date >= %(start_date)s "
                      "AND feature.inspection_date < %(end_date)s")
@@ -274,22 +293,79 @@ class FeatureLoader():
 
     def generic_imputer(self, df, dtypes):
         # exploit that counts are ints, while averages (and such) are floats
-        float_cols = [df.columns[idx] for idx,dt in enumerate(dtypes) if dt==pd.np.dtype('float64')]
-        int_cols = [df.columns[idx] for idx,dt in enumerate(dtypes) if dt==pd.np.dtype('int64')]
+        # (features are loaded as 32 bit, see __query)
+        float_cols = [df.columns[idx] for idx,dt in enumerate(dtypes) if dt.kind == 'f']
+        int_cols = [df.columns[idx] for idx,dt in enumerate(dtypes) if dt.kind in 'iu']
         df.loc[:,float_cols] = df.loc[:,float_cols].fillna(df.loc[:,float_cols].median(axis=0))
         df.loc[:,int_cols] = df.loc[:,int_cols].fillna(df.loc[:,int_cols].median(axis=0))
         return df
     
+    def __query(self, query, params):
+        '''
+            Run query with a server side cursor, rows are fetched in chunks
+            of self.chunksize and every chunk is converted to compact dtypes
+            (float32, int32) before fetching the next one, parcel_id is
+            converted to categorical at the end
+        '''
+        cur = self.con.cursor(name='feature_loader')
+        cur.itersize = self.chunksize
+        chunks = []
+        try:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(self.chunksize)
+                columns = [d[0] for d in cur.description]
+                if not rows:
+                    break
+                chunk = pd.DataFrame.from_records(rows, columns=columns,
+                                                  coerce_float=True)
+                chunks.append(util.compact_dtypes(chunk))
+        finally:
+            cur.close()
+            #Close the transaction opened by the cursor
+            self.con.commit()
+
+        if not chunks:
+            return pd.DataFrame([], columns=columns)
+        #Chunks with and without NULLs in an integer column are concatenated
+        #as float64, go back to 32 bits
+        features = util.compact_dtypes(pd.concat(chunks, ignore_index=True))
+        if 'parcel_id' in features.columns:
+            features['parcel_id'] = features.parcel_id.astype('category')
+        return features
+
     def __read_feature_from_db(self, query, features_to_load,
-                               drop_duplicates=True, table_name=None):
-        features = pd.read_sql(query, con=self.con,
-                               params={"start_date": self.start_date,
-                                       "end_date": self.end_date,
-                                       "table_name": table_name})
-
-        if drop_duplicates:
-            features = features.drop_duplicates(subset=["parcel_id",
-                "inspection_date"])
+                               drop_duplicates=True, table_name=None,
+                               keys=['parcel_id', 'inspection_date']):
+        '''
+            Run query (its {columns} placeholder is replaced with keys and
+            features_to_load from the feature table) and return
+            features_to_load indexed by parcel_id and inspection_date
+        '''
+        #Remove indexes from features to load if they exist
+        #they are always loaded
+        if 'parcel_id' in features_to_load: features_to_load.remove('parcel_id')
+        if 'inspection_date' in features_to_load: features_to_load.remove('inspection_date')
+
+        features = None
+        if self.cache is not None and table_name is not None and drop_duplicates:
+            #Cached tables have every column
+            features = self.__read_feature_from_cache(query.format(columns='feature.*'),
+                                                      features_to_load,
+                                                      table_name)
+
+        if features is None:
+            #Select only the columns listed by the user
+            columns = ', '.join('feature."{}"'.format(c.replace('"', '""'))
+                                for c in keys + features_to_load)
+            features = self.__query(query.format(columns=columns),
+                                    params={"start_date": self.start_date,
+                                            "end_date": self.end_date,
+                                            "table_name": table_name})
+
+            if drop_duplicates:
+                features = features.drop_duplicates(subset=["parcel_id",
+                    "inspection_date"])
         try:
             #Some features are costructed using both the parcel_id
             #and the inspection date
@@ -300,17 +376,40 @@ class FeatureLoader():
             #But some others only have parcel_id
             features = features.set_index("parcel_id")
 
-        #Remove indexes from features to load if they exist
-        #so the next statement does not fail
-        if 'parcel_id' in features_to_load: features_to_load.remove('parcel_id')
-        if 'inspection_date' in features_to_load: features_to_load.remove('inspection_date')
-
-        #Since the query will load ALL COLUMNS, select only the ones listed by
-        #the user
         features = features[features_to_load]
         #logger.debug('Features loaded (head):\n%s' % features.head(2))
         return features
 
+    def __read_feature_from_cache(self, query, features_to_load, table_name):
+        '''
+            Read features_to_load for inspections in [start_date, end_date)
+            from the local cache. If table_name is not cached or changed
+            since it was cached, load the whole table (every column, every
+            date) with query and cache it. Returns None if the table
+            cannot be cached (it has no inspection_date column)
+        '''
+        version = table_version(self.con, self.schema,
+                                [table_name, 'parcels_inspections'], query)
+        features = self.cache.load(self.schema, table_name, version,
+                                   features_to_load, self.start_date,
+                                   self.end_date)
+        if features is not None:
+            logger.debug("Loaded {} from cache".format(table_name))
+            return features
+
+        logger.debug("{} not in cache, loading every date from db".format(table_name))
+        features = self.__query(query, params={"start_date": '1970-01-01',
+                                               "end_date": '2080-01-01',
+                                               "table_name": table_name})
+        if 'inspection_date' not in features.columns:
+            return None
+        features = features.drop_duplicates(subset=["parcel_id",
+                                                    "inspection_date"])
+        self.cache.save(self.schema, table_name, version, features)
+        return self.cache.load(self.schema, table_name, version,
+                               features_to_load, self.start_date,
+                               self.end_date)
+
     @staticmethod
     def resolve_dummy_variables(features_to_load, dummy_mapping):
         # replace all features that map to dummy vars by these dummy vars
@@ -341,14 +440,13 @@ class Dataset():
         df.set_index(index, inplace=True)
         return df
 
-def get_dataset(schema, features, start_date, end_date, only_residential):
-    start_date = start_date.strftime('%Y-%m-%d')
-    end_date = end_date.strftime('%Y-%m-%d')
-    loader = FeatureLoader(schema, start_date, end_date)
-
-    #List all columns (with their respective table names) in the current schema
-    tables_and_columns =  tables_and_columns_for_schema(schema)
-
+def load_dataset(loader, features, tables_and_columns, only_residential):
+    '''
+        Load labels and features (without imputing them) for the inspections
+        in the loader date range. Returns the DataFrame and a list with
+        (table_name, columns, dtypes) for every feature group, which is
+        needed to impute the dataset, or any subset of it, later
+    '''
     #the features parameters is a list of tuples of the form (table_name, column_name)
     #check that every tuple actually exists in the selected schema, if not,
     #raise and exception
@@ -374,6 +472,7 @@ def get_dataset(schema, features, start_date, end_date, only_residential):
     # load each group of features and merge into a full dataset
     # merging makes sure we have the same index and sorting
     # for all features and inspections
+    loaded_groups = []
     for table_name, feature_group in grouped_features:
         #Load features as data frame
         feats = loader.load_feature_group(table_name, feature_group)
@@ -385,17 +484,30 @@ def get_dataset(schema, features, start_date, end_date, only_residential):
         #this will help to identify features when evaluating models
         feats.columns = old_cols.map(lambda s: '{}_{}'.format(table_name, s))
 
-        old_cols_to_new = {o:n for o,n in zip(old_cols,feats.columns)}
-        new_cols_to_old = {v:k for k,v in old_cols_to_new.items()}
-
         #Join with the labels and the rest of the features
         dataset = dataset.join(feats, how='left')
         # dataset = dataset.dropna(subset=['viol_outcome'])
 
+        loaded_groups.append((table_name, zip(old_cols, feats.columns),
+                              feats.dtypes))
+
+    return dataset, loaded_groups
+
+
+def make_dataset(dataset, loader, loaded_groups, features):
+    '''
+        Impute every feature group in dataset (as returned by load_dataset),
+        shuffle the rows and split them into features and labels
+    '''
+    for table_name, columns, dtypes in loaded_groups:
+        old_cols_to_new = {o:n for o,n in columns}
+        new_cols_to_old = {n:o for o,n in columns}
+        new_cols = [n for o,n in columns]
+
         # impute the columns
-        dataset.loc[:,feats.columns] = loader.impute_feature_group(table_name,
-                                        dataset.loc[:,feats.columns].rename(columns=new_cols_to_old),
-                                        feats.dtypes
+        dataset.loc[:,new_cols] = loader.impute_feature_group(table_name,
+                                        dataset.loc[:,new_cols].rename(columns=new_cols_to_old),
+                                        dtypes
                                        ).rename(columns=old_cols_to_new)
 
     # randomize the ordering
@@ -413,6 +525,21 @@ def get_dataset(schema, features, start_date, end_date, only_residential):
     return Dataset(parcels_inspections, features_df, labels, features)
 
 
+def get_dataset(schema, features, start_date, end_date, only_residential,
+                tables_and_columns=None):
+    start_date = start_date.strftime('%Y-%m-%d')
+    end_date = end_date.strftime('%Y-%m-%d')
+    loader = FeatureLoader(schema, start_date, end_date)
+
+    #List all columns (with their respective table names) in the current schema
+    if tables_and_columns is None:
+        tables_and_columns = tables_and_columns_for_schema(schema)
+
+    dataset, loaded_groups = load_dataset(loader, features, tables_and_columns,
+                                          only_residential)
+    return make_dataset(dataset, loader, loaded_groups, features)
+
+
 def get_training_dataset(features, start_date, end_date, only_residential):
     """
     :param schema: Database schema to use
@@ -444,10 +571,50 @@ def get_testing_dataset(features, start_date, end_date, only_residential):
     return get_dataset(schema, features, start_date, end_date,
                        only_residential)
 
-def get_features_for_inspections_in_schema(schema, features, only_residential=False):
+def get_training_and_testing_datasets(features, start_date, fake_today,
+                                      end_date, only_residential,
+                                      tables_and_columns=None):
+    """
+    Same as calling get_training_dataset and get_testing_dataset, but every
+    feature table is read only once
+    :param features: Which features to load
+    :param start_date: Training inspections from this date
+    :param fake_today: Training inspections until this date, testing
+        inspections from this date
+    :param end_date: Testing inspections until this date
+    :param tables_and_columns: Columns in the features schema, they are
+        listed if not given
+    :return: train and test datasets
+    """
+    logger.info("Getting features and labels for training and test data")
+
+    # features are taken from the "features" schema
+    schema = "features"
+
+    loader = FeatureLoader(schema, start_date.strftime('%Y-%m-%d'),
+                           end_date.strftime('%Y-%m-%d'))
+    if tables_and_columns is None:
+        tables_and_columns = tables_and_columns_for_schema(schema)
+
+    dataset, loaded_groups = load_dataset(loader, features, tables_and_columns,
+                                          only_residential)
+
+    #Both sets are imputed separately, as if they were loaded on their own
+    dates = pd.to_datetime(dataset.index.get_level_values('inspection_date'))
+    is_train = np.asarray(dates < pd.Timestamp(fake_today))
+    train = make_dataset(dataset[is_train].copy(), loader, loaded_groups,
+                         features)
+    test = make_dataset(dataset[~is_train].copy(), loader, loaded_groups,
+                        features)
+    return train, test
+
+
+def get_features_for_inspections_in_schema(schema, features, only_residential=False,
+                                           tables_and_columns=None):
     logger.info("Getting features for all inspections in {}".format(schema))
 
     start_date = datetime.datetime.strptime('01Jan1970', '%d%b%Y')
     end_date = datetime.datetime.strptime('01Jan2080', '%d%b%Y')
 
-    return get_dataset(schema, features, start_date, end_date, only_residential)
+    return get_dataset(schema, features, start_date, end_date, only_residential,
+                       tables_and_columns)
@@ -0,0 +1,143 @@
+import os
+import json
+import fcntl
+import datetime
+import shutil
+import hashlib
+import logging
+import logging.config
+
+import numpy as np
+import pandas as pd
+
+from lib_cinci.config import load
+
+logging.config.dictConfig(load('logger_config.yaml'))
+logger = logging.getLogger()
+
+#Local cache for feature tables. Every (schema, table) is saved in its own
+#folder with one .npy file per column and rows sorted by inspection_date,
+#so a date range is a contiguous slice and columns can be memory mapped
+#and read independently. A version string (see table_version) is saved
+#along with the data, if the table changes, the cached copy is ignored.
+
+def table_version(con, schema, tables, query):
+    '''
+        Returns a string that changes when any of the tables in schema
+        changes or when the query used to load them changes. Replacing a
+        table (e.g. to_sql with if_exists='replace') changes its oid,
+        inserts, updates and deletes change the pg_stat counters
+    '''
+    q = ("SELECT c.relname, c.oid, c.relfilenode, "
+         "s.n_tup_ins, s.n_tup_upd, s.n_tup_del "
+         "FROM pg_class AS c "
+         "JOIN pg_namespace AS n ON n.oid = c.relnamespace "
+         "LEFT JOIN pg_stat_user_tables AS s ON s.relid = c.oid "
+         "WHERE n.nspname = %s AND c.relname = ANY(%s) "
+         "ORDER BY c.relname")
+    cur = con.cursor()
+    cur.execute(q, (schema, list(tables)))
+    rows = cur.fetchall()
+    cur.close()
+    return hashlib.md5(query + str(rows)).hexdigest()
+
+
+class FeatureCache():
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path_to_table(self, schema, table):
+        return os.path.join(self.folder, schema, table)
+
+    def __read_meta(self, schema, table):
+        path = os.path.join(self.path_to_table(schema, table), 'meta.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def __load_column(self, path, meta, name, start=None, end=None):
+        column = meta['columns'][name]
+        filename = os.path.join(path, column['file'])
+        #Object columns are pickled, they cannot be memory mapped
+        values = np.load(filename, mmap_mode='r' if column['mmap'] else None)
+        values = values[start:end]
+        #Go back to the type returned by the database
+        if column['dtype'] == 'object':
+            values = values.astype(object)
+        elif column['dtype'] == 'date':
+            values = values.astype('M8[D]').astype(object)
+        elif column['dtype'] == 'datetime':
+            values = values.astype('M8[us]').astype(object)
+        return np.array(values)
+
+    def load(self, schema, table, version, columns, start_date, end_date):
+        '''
+            Load columns for rows with start_date <= inspection_date < end_date.
+            Returns a DataFrame with parcel_id, inspection_date and columns
+            or None if table is not in the cache or its version is different.
+            Raises KeyError if any of the columns does not exist.
+        '''
+        meta = self.__read_meta(schema, table)
+        if meta is None or meta['version'] != version:
+            return None
+
+        path = self.path_to_table(schema, table)
+        missing = [c for c in columns if c not in meta['columns']]
+        if missing:
+            raise KeyError('{} not in {}.{}'.format(missing, schema, table))
+
+        dates = np.load(os.path.join(path, meta['columns']['inspection_date']['file']),
+                        mmap_mode='r')
+        start = np.searchsorted(dates, np.datetime64(pd.Timestamp(start_date)), side='left')
+        end = np.searchsorted(dates, np.datetime64(pd.Timestamp(end_date)), side='left')
+
+        names = ['parcel_id', 'inspection_date'] + list(columns)
+        data = {name: self.__load_column(path, meta, name, start, end)
+                for name in names}
+        return pd.DataFrame(data, columns=names)
+
+    def save(self, schema, table, version, df):
+        '''
+            Save df (must have an inspection_date column) as the cached
+            copy of schema.table. The copy is written to a temporary folder
+            and then moved, so readers never see a half written table.
+            Writers are serialized with a lock on the table
+        '''
+        dates = pd.to_datetime(df.inspection_date).values
+        df = df.iloc[np.argsort(dates, kind='mergesort')]
+        path = self.path_to_table(schema, table)
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        meta = {'version': version, 'rows': len(df), 'columns': {}}
+        for i, name in enumerate(df.columns):
+            values = np.asarray(df[name])
+            dtype = str(values.dtype)
+            if name == 'parcel_id':
+                #Fixed width strings can be memory mapped
+                values = values.astype(str)
+            elif name == 'inspection_date' and dtype == 'object':
+                #Dates are stored as datetime64 so they can be searched
+                is_date = (len(values) > 0 and
+                           type(values[0]) is datetime.date)
+                dtype = 'date' if is_date else 'datetime'
+                values = pd.to_datetime(values).values
+            filename = 'col_{}.npy'.format(i)
+            np.save(os.path.join(tmp_path, filename), values)
+            meta['columns'][name] = {'file': filename, 'dtype': dtype,
+                                     'mmap': values.dtype != np.dtype(object)}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        #Several processes may fill the cache at the same time, only
+        #one of them replaces the folder at a time
+        with open('{}.lock'.format(path), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+        logger.debug('Saved {} rows for {}.{} in cache'.format(len(df), schema, table))
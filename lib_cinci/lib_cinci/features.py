@@ -83,6 +83,30 @@ def tables_and_columns_for_schema(schema):
     return results
 
 
+def tables_and_columns_for_schemas(schemas):
+    '''
+        Same as tables_and_columns_for_schema, but for several schemas
+        with a single query. Returns a dictionary schema -> list of
+        (table_name, column_name) tuples
+    '''
+    query = ("SELECT table_schema, table_name, column_name "
+             "FROM information_schema.columns "
+             "WHERE table_schema = ANY(%s);")
+    conn = connect(host=main['db']['host'], user=main['db']['user'],
+                   password=main['db']['password'],
+                   database=main['db']['database'],
+                   port=main['db']['port'])
+    cur = conn.cursor()
+    cur.execute(query, (list(schemas),))
+    results = cur.fetchall()
+    cur.close()
+    conn.close()
+    by_schema = {schema: [] for schema in schemas}
+    for schema, table, column in results:
+        by_schema[schema].append((table, column))
+    return by_schema
+
+
 def tables_in_schema(schema):
     '''
         Utility function to see which tables already exist in schema
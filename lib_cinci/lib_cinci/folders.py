@@ -2,7 +2,7 @@ import os
 
 output_folder = os.environ['OUTPUT_FOLDER']
 
-# Where to save test set predictions
+# Where to save test set predictions (see lib_cinci.prediction_store)
 path_to_predictions = os.path.join(output_folder, "predictions")
 # Where to pickle models
 path_to_pickled_models = os.path.join(output_folder, "pickled_models")
@@ -12,5 +12,6 @@ path_to_pickled_scalers = os.path.join(output_folder, "pickled_scalers")
 path_to_pickled_imputers = os.path.join(output_folder, "pickled_imputers")
 # Where to dump train and testing sets
 path_to_dumps = os.path.join(output_folder, "dumps")
-# Where to dump the top X predictions made on all parcels
+# Where to save the top X predictions made on all parcels
+# (see lib_cinci.prediction_store)
 path_to_top_predictions_on_all_parcels = os.path.join(output_folder, "top_predictions_on_all_parcels")
@@ -0,0 +1,104 @@
+import logging
+import logging.config
+
+from lib_cinci.config import load
+
+logging.config.dictConfig(load('logger_config.yaml'))
+logger = logging.getLogger()
+
+#Parcel to parcel neighbour graph. Every pair of parcels in
+#shape_files.parcels_cincy whose geometries are within MAX_DIST meters is
+#saved once in GRAPH_TABLE (a parcel is its own neighbour, with distance 0),
+#sorted by parcel_id and distance, so features that count things near a
+#parcel can use an indexed equality join instead of ST_DWithin. The graph
+#is rebuilt only when the parcels shapefile changes, VERSION_TABLE has the
+#fingerprint of the shapefile that was used to build it.
+
+GRAPH_TABLE = 'public.parcel_neighbours'
+VERSION_TABLE = 'public.parcel_neighbours_version'
+#Max distance (in meters) in the graph
+MAX_DIST = 1000
+#Geometries in shape_files use SRID 3735, whose unit is the US survey foot
+FOOT_PER_METER = 3.281
+
+
+def parcels_version(cur):
+    '''
+        md5 of every parcelid and geometry in shape_files.parcels_cincy
+    '''
+    cur.execute("""
+        SELECT md5(string_agg(row_hash, '' ORDER BY row_hash))
+        FROM (
+            SELECT md5(coalesce(parcelid, '') || ':' ||
+                       coalesce(encode(ST_AsBinary(geom), 'hex'), '')) AS row_hash
+            FROM shape_files.parcels_cincy
+        ) t;
+        """)
+    return cur.fetchone()[0]
+
+
+def graph_version(cur):
+    '''
+        Version of the parcels shapefile used to build the graph,
+        None if the graph does not exist
+    '''
+    cur.execute('SELECT to_regclass(%s);', (VERSION_TABLE,))
+    if cur.fetchone()[0] is None:
+        return None
+    cur.execute('SELECT version FROM {};'.format(VERSION_TABLE))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def make_parcel_graph(con, refresh=False):
+    '''
+        Create GRAPH_TABLE if it does not exist or it was built from a
+        different version of shape_files.parcels_cincy (or refresh is True).
+        Several processes can call this at the same time, only the first
+        one builds the graph
+    '''
+    cur = con.cursor()
+    cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s));', (GRAPH_TABLE,))
+    version = parcels_version(cur)
+    if not refresh and graph_version(cur) == version:
+        logger.info('{} is up to date'.format(GRAPH_TABLE))
+        con.commit()
+        cur.close()
+        return
+
+    logger.info('Building {} with parcels within {} m'.format(GRAPH_TABLE,
+                                                             MAX_DIST))
+    query = """
+        DROP TABLE IF EXISTS {graph};
+        CREATE TABLE {graph} AS
+            SELECT a.parcelid AS parcel_id,
+                   b.parcelid AS neighbour_id,
+                   min(ST_Distance(a.geom, b.geom))/{foot_per_meter} AS dist_m
+            FROM shape_files.parcels_cincy a
+            JOIN shape_files.parcels_cincy b
+            ON ST_DWithin(a.geom, b.geom, {max_dist}*{foot_per_meter}::double precision)
+            WHERE a.parcelid IS NOT NULL
+            AND b.parcelid IS NOT NULL
+            GROUP BY a.parcelid, b.parcelid
+            ORDER BY parcel_id, dist_m;
+        CREATE INDEX ON {graph} (parcel_id, dist_m);
+        CREATE INDEX ON {graph} (neighbour_id);
+
+        DROP TABLE IF EXISTS {version_table};
+        CREATE TABLE {version_table} (version text, max_dist integer,
+                                      created_at timestamp DEFAULT now());
+        INSERT INTO {version_table} (version, max_dist) VALUES (%(version)s,
+                                                                {max_dist});
+        """.format(graph=GRAPH_TABLE, version_table=VERSION_TABLE,
+                   max_dist=MAX_DIST, foot_per_meter=FOOT_PER_METER)
+    cur.execute(query, {'version': version})
+    con.commit()
+    cur.close()
+
+
+def check_max_dist(max_dist):
+    if max_dist > MAX_DIST:
+        raise ValueError(('{} only has parcels within {} m, max_dist '
+                          'cannot be {}').format(GRAPH_TABLE, MAX_DIST,
+                                                 max_dist))
+
@@ -4,6 +4,7 @@ from lib_cinci.config import main
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 from dataset import get_features_for_inspections_in_schema
+from lib_cinci.prediction_store import PredictionStore
 
 
 def predict_on_schema(model_id, schema):
@@ -66,7 +67,5 @@ def get_predictions(model_id):
     output_folder = os.environ['OUTPUT_FOLDER']
     path_to_predictions = os.path.join(output_folder, "top_predictions_on_all_parcels")
 
-    predictions = pd.read_csv(os.path.join(path_to_predictions, model_id),
-                                    index_col=['parcel_id', 'inspection_date'],
-                                   parse_dates=['inspection_date'])
-    return predictions
+    store = PredictionStore(path_to_predictions)
+    return store.load(model_id)
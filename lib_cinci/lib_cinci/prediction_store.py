@@ -0,0 +1,229 @@
+import os
+import re
+import fcntl
+import shutil
+import tempfile
+import logging
+import logging.config
+
+import numpy as np
+import pandas as pd
+
+from lib_cinci.config import load
+
+logging.config.dictConfig(load('logger_config.yaml'))
+logger = logging.getLogger()
+
+#Binary store for model predictions. (parcel_id, inspection_date) pairs are
+#saved once in a shared, append only index (index_parcel_id.npy and
+#index_inspection_date.npy), every model gets a folder in models/ with the
+#positions of its rows in the index and float32 scores (and labels, if
+#any), sorted by score in descending order, so the top k predictions of a
+#model are the first k rows. Writers from several processes are
+#serialized with a lock on the index, models are written to a temporary
+#folder and then renamed, so readers never see half written files.
+#Predictions saved as CSV files (named after the model id) in the store
+#folder by earlier versions are imported the first time they are read.
+
+#Names of the CSV files written before the store existed (MongoDB ids)
+_LEGACY_CSV = re.compile('^[0-9a-f]{24}$')
+
+class PredictionStore():
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path_to_models = os.path.join(folder, 'models')
+        if not os.path.exists(self.path_to_models):
+            try:
+                os.makedirs(self.path_to_models)
+            except OSError:
+                #Another process created it
+                if not os.path.isdir(self.path_to_models):
+                    raise
+
+    def __index_file(self, name):
+        return os.path.join(self.folder, 'index_{}.npy'.format(name))
+
+    def __read_index(self):
+        path = self.__index_file('parcel_id')
+        if not os.path.exists(path):
+            return (np.array([], dtype='S1'), np.array([], dtype='M8[D]'))
+        return (np.load(path, mmap_mode='r'),
+                np.load(self.__index_file('inspection_date'), mmap_mode='r'))
+
+    def __save_index_file(self, name, values):
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, values)
+        os.rename(tmp, self.__index_file(name))
+
+    def __positions(self, parcel_id, inspection_date):
+        '''
+            Positions of the (parcel_id, inspection_date) pairs in the
+            index, pairs that are not in the index are appended to it
+        '''
+        with open(os.path.join(self.folder, 'index.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index_parcel_id, index_inspection_date = self.__read_index()
+            index = pd.MultiIndex.from_arrays([index_parcel_id,
+                                               index_inspection_date])
+            keys = pd.MultiIndex.from_arrays([parcel_id, inspection_date])
+            positions = index.get_indexer(keys)
+
+            missing = positions == -1
+            if missing.any():
+                new = keys[missing].drop_duplicates()
+                new_parcel_id = np.array(new.get_level_values(0), dtype='S')
+                new_inspection_date = np.array(new.get_level_values(1),
+                                               dtype='M8[D]')
+                #The index is append only, readers that load an old copy
+                #still find the rows of every model saved before
+                self.__save_index_file('parcel_id',
+                        np.concatenate([index_parcel_id, new_parcel_id]))
+                self.__save_index_file('inspection_date',
+                        np.concatenate([index_inspection_date,
+                                        new_inspection_date]))
+                positions[missing] = (len(index_parcel_id) +
+                                      new.get_indexer(keys[missing]))
+        return positions.astype(np.int32)
+
+    def path_to_model(self, model_id):
+        return os.path.join(self.path_to_models, model_id)
+
+    def save(self, model_id, parcels, scores, labels=None):
+        '''
+            Save scores for a model, parcels is a list of
+            (parcel_id, inspection_date) tuples in the same order as
+            scores (and labels, if not None). Replaces previous scores
+            for the same model_id
+        '''
+        parcels = list(parcels)
+        parcel_id = np.array([p[0] for p in parcels], dtype='S')
+        inspection_date = np.array(pd.to_datetime([p[1] for p in parcels]),
+                                   dtype='M8[D]')
+        positions = self.__positions(parcel_id, inspection_date)
+
+        scores = np.asarray(scores, dtype=np.float32)
+        order = np.argsort(-scores, kind='mergesort')
+
+        tmp = tempfile.mkdtemp(dir=self.path_to_models)
+        np.save(os.path.join(tmp, 'positions.npy'), positions[order])
+        np.save(os.path.join(tmp, 'scores.npy'), scores[order])
+        if labels is not None:
+            labels = np.asarray(labels, dtype=np.float32)
+            np.save(os.path.join(tmp, 'labels.npy'), labels[order])
+
+        path = self.path_to_model(model_id)
+        try:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(tmp, path)
+        except OSError:
+            #Another process saved the same model at the same time
+            if not os.path.isdir(path):
+                raise
+            shutil.rmtree(tmp, ignore_errors=True)
+        logger.debug('Saved {} predictions for {}'.format(len(scores),
+                                                         model_id))
+
+    def legacy_ids(self):
+        '''
+            Ids of models with predictions in CSV files
+        '''
+        return sorted(name for name in os.listdir(self.folder)
+                      if _LEGACY_CSV.match(name)
+                      and os.path.isfile(os.path.join(self.folder, name)))
+
+    def import_csv(self, model_id):
+        '''
+            Save the predictions in the CSV file for model_id (written
+            before the store existed) in the store
+        '''
+        df = pd.read_csv(os.path.join(self.folder, model_id),
+                         parse_dates=['inspection_date'])
+        labels = df.viol_outcome.values if 'viol_outcome' in df else None
+        self.save(model_id, zip(df.parcel_id.astype(str), df.inspection_date),
+                  df.prediction.values, labels=labels)
+        logger.info('Imported predictions for {} from CSV'.format(model_id))
+
+    def model_ids(self):
+        return sorted(name for name in os.listdir(self.path_to_models)
+                      if not name.startswith('tmp'))
+
+    def __load_model(self, model_id, top=None):
+        path = self.path_to_model(model_id)
+        if (not os.path.exists(path) and _LEGACY_CSV.match(model_id)
+                and os.path.isfile(os.path.join(self.folder, model_id))):
+            self.import_csv(model_id)
+        if not os.path.exists(path):
+            raise KeyError('There are no predictions for {}'.format(model_id))
+        files = {}
+        for name in ('positions', 'scores', 'labels'):
+            filename = os.path.join(path, '{}.npy'.format(name))
+            if os.path.exists(filename):
+                files[name] = np.array(np.load(filename, mmap_mode='r')[:top])
+        return files
+
+    def load(self, model_id, top=None):
+        '''
+            Predictions of a model as a DataFrame indexed by parcel_id and
+            inspection_date with a prediction column (and viol_outcome if
+            labels were saved), sorted by prediction in descending order.
+            If top is not None, only the top predictions are loaded.
+            Raises KeyError if there are no predictions for model_id
+        '''
+        model = self.__load_model(model_id, top)
+        #Read the index after the model, so it contains the model's rows
+        index_parcel_id, index_inspection_date = self.__read_index()
+        positions = model['positions']
+        df = pd.DataFrame({'parcel_id': index_parcel_id[positions].astype(object),
+                           'inspection_date': index_inspection_date[positions],
+                           'prediction': model['scores']})
+        columns = ['parcel_id', 'inspection_date', 'prediction']
+        if 'labels' in model:
+            df['viol_outcome'] = model['labels']
+            columns.append('viol_outcome')
+        return df[columns].set_index(['parcel_id', 'inspection_date'])
+
+    def load_matrix(self, model_ids, top=None):
+        '''
+            Scores of several models as one matrix. Returns a
+            (parcel_id, inspection_date) MultiIndex with every pair
+            predicted by at least one of the models and a float32
+            (models x pairs) matrix, NaN where a model has no prediction
+            for the pair. If top is not None, only the top predictions of
+            every model are loaded
+        '''
+        models = [self.__load_model(model_id, top) for model_id in model_ids]
+        index_parcel_id, index_inspection_date = self.__read_index()
+        positions = [m['positions'] for m in models]
+        used = np.unique(np.concatenate(positions)) if positions else \
+               np.array([], dtype=np.int32)
+
+        matrix = np.empty((len(models), len(used)), dtype=np.float32)
+        matrix.fill(np.nan)
+        for i, model in enumerate(models):
+            matrix[i, np.searchsorted(used, model['positions'])] = model['scores']
+
+        index = pd.MultiIndex.from_arrays([index_parcel_id[used].astype(object),
+                                           index_inspection_date[used]],
+                                          names=['parcel_id', 'inspection_date'])
+        return index, matrix
+
+    def prune(self, keep_ids):
+        '''
+            Delete predictions for every model not in keep_ids (in the
+            store or in CSV files), returns the number of models deleted.
+            The shared index is not changed
+        '''
+        keep_ids = set(keep_ids)
+        to_delete = [m for m in self.model_ids() if m not in keep_ids]
+        for model_id in to_delete:
+            shutil.rmtree(self.path_to_model(model_id))
+        csv_to_delete = [m for m in self.legacy_ids() if m not in keep_ids]
+        for model_id in csv_to_delete:
+            os.remove(os.path.join(self.folder, model_id))
+        to_delete = set(to_delete) | set(csv_to_delete)
+        logger.info('Removed predictions for {} models from {}'
+                    .format(len(to_delete), self.folder))
+        return len(to_delete)
@@ -4,6 +4,7 @@ import logging.config
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
+import scipy.sparse
 from sqlalchemy import create_engine
 import datetime
 from lib_cinci.config import load
@@ -47,7 +48,32 @@ def make_short_zip(year, df):
     return df
 
 
-def get_dummies(series, possible_values):
+#Categorical features saved as one binary column per category. Feature
+#generators and FeatureLoader.resolve_dummy_variables both use these
+#lists, so the columns that are saved and loaded are always the same
+dummy_variables = {"home_use": ["single-family", "two-family",
+                                "three-family", "multi-family", "mixed-use"]}
+
+
+def dummy_codes(series, possible_values):
+    """
+    Position of every value in possible_values, -1 for missing values.
+
+    :param series:
+    :param possible_values: The list of values the categorical variable
+    can take.
+    :return: A numpy array of integers
+    """
+    values = np.asarray(series, dtype=object)
+    codes = pd.Index(possible_values).get_indexer(values)
+    illegal = (codes == -1) & ~pd.isnull(values)
+    if illegal.any():
+        raise ValueError("{} is not in allowed list of values {}".format(
+                         values[illegal][0], possible_values))
+    return codes
+
+
+def get_dummies(series, possible_values, dtype=None, sparse=False):
     """
     Converts a categorical variable to a set of binary variables.
 
@@ -67,25 +93,34 @@ def get_dummies(series, possible_values):
     :param series:
     :param possible_values: The list of values the categorical variable
     can take.
+    :param dtype: Type of the binary columns. By default int64, or
+    float64 if there are missing values (their rows are all NaN). With an
+    integer dtype, rows for missing values are all 0.
+    :param sparse: Return a scipy.sparse CSR matrix (rows for missing
+    values are all 0) instead of a data frame.
     :return: A pandas dataframe with as many binary columns as there
     are possible values.
     """
+    codes = dummy_codes(series, possible_values)
+    missing = codes == -1
 
-    def make_dummies(value):
-        if isinstance(value, float) and np.isnan(value):
-            dummy = pd.Series(np.nan, index=possible_values)
-            return dummy
-        else:
-            if value not in possible_values:
-                raise ValueError("{} is not in allowed list of values {}".format(value, possible_values))
-            dummy = pd.Series(0, index=possible_values)
-            dummy[value] = 1
-            return dummy
+    if sparse:
+        rows = np.where(~missing)[0]
+        data = np.ones(len(rows), dtype=dtype or np.uint8)
+        return scipy.sparse.csr_matrix((data, (rows, codes[rows])),
+                                       shape=(len(codes), len(possible_values)))
 
     if len(series) == 0:
         return pd.DataFrame([], columns=possible_values)
-    else:
-        return series.apply(make_dummies)
+
+    if dtype is None:
+        dtype = np.float64 if missing.any() else np.int64
+    dummies = (codes[:, np.newaxis] == np.arange(len(possible_values)))
+    dummies = dummies.astype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        dummies[missing] = np.nan
+
+    return pd.DataFrame(dummies, index=series.index, columns=possible_values)
 
 
 def mean_impute_series(series):
@@ -134,6 +169,26 @@ def mean_impute_frame(frame, subset=None):
     return frame_imputed
 
 
+def compact_dtypes(frame):
+    """
+    Downcast float64 columns to float32 and int64 columns to int32
+    (if their values fit), other columns are left as they are.
+
+    :param frame: DataFrame, modified in place
+    :return: frame
+    """
+    int32 = np.iinfo(np.int32)
+    for col in frame.columns:
+        values = frame[col].values
+        if values.dtype == np.float64:
+            frame[col] = values.astype(np.float32)
+        elif values.dtype == np.int64:
+            if len(values) == 0 or (values.min() >= int32.min and
+                                    values.max() <= int32.max):
+                frame[col] = values.astype(np.int32)
+    return frame
+
+
 def population_in_tracts():
     engine = create_engine(uri)
     populations = ("SELECT tract, sum(\"P0010001\") AS population "
@@ -1,9 +1,52 @@
 from pymongo import MongoClient
 from utils import get_model_name
+import os
+import time
+import json
+import hashlib
 import datetime
 import pymongo
+from multiprocessing.util import Finalize
 from bson.objectid import ObjectId
 
+#MongoClient objects are reused by every Logger for the same host in the
+#same process (clients cannot be shared with forked processes)
+_clients = {}
+
+def _get_client(host):
+    key = (os.getpid(), host)
+    if key not in _clients:
+        _clients[key] = MongoClient(host)
+    return _clients[key]
+
+#Collections that already have their indexes, per process
+_indexed = set()
+
+#Keys in config that change between temporal splits
+_SPLIT_KEYS = ['start_date', 'fake_today', 'experiment_name']
+
+def _split_key(doc):
+    """
+    Returns a (config_hash, train_months) tuple for a model document, models
+    trained with the same sklearn model, parameters and config (except for
+    start_date, fake_today and experiment_name) have the same config_hash,
+    train_months is the length of the training interval. Returns None if
+    the document does not have start_date and fake_today.
+    """
+    config = dict(doc.get('config') or {})
+    if 'start_date' not in config or 'fake_today' not in config:
+        return None
+    start_date = datetime.datetime.strptime(config['start_date'], '%d%b%Y')
+    fake_today = datetime.datetime.strptime(config['fake_today'], '%d%b%Y')
+    train_months = int((fake_today - start_date).days/30)
+    for key in _SPLIT_KEYS:
+        config.pop(key, None)
+    match = {'name': doc['name'], 'parameters': doc['parameters'],
+             'config': config}
+    config_hash = hashlib.md5(json.dumps(match, sort_keys=True,
+                                         default=str)).hexdigest()
+    return config_hash, train_months
+
 def _flatten_dict(mydict, joinfunc=lambda a,b: '.'.join([a,b])):
     """
     Helper function to take a dictionary and flatten it. Key-value pairs
@@ -45,13 +88,52 @@ def _flatten_dict(mydict, joinfunc=lambda a,b: '.'.join([a,b])):
 
 
 class Logger:
-    def __init__(self, host, db, collection):
-        client = MongoClient(host)
-        self.collection = client[db][collection]
+    def __init__(self, host, db, collection, buffer_size=None,
+                 flush_interval=None):
+        '''
+            If buffer_size is not None, log_model buffers documents and
+            inserts them with a single insert_many when there are
+            buffer_size documents in the buffer, when flush_interval seconds
+            have passed since the last insert (checked when logging a model)
+            or when the process exits. Buffered documents are not visible
+            to queries until they are flushed
+        '''
+        self.collection = _get_client(host)[db][collection]
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.time()
+        if buffer_size is not None:
+            #Finalize also runs when multiprocessing workers exit
+            #normally, atexit does not
+            Finalize(None, self.flush, exitpriority=10)
+
+    def create_indexes(self):
+        '''
+            Index experiment_name and (config_hash, train_months), once
+            per collection and process (called by methods that query them)
+        '''
+        key = (os.getpid(), self.collection.full_name)
+        if key not in _indexed:
+            self.collection.create_index('experiment_name')
+            self.collection.create_index([('config_hash', pymongo.ASCENDING),
+                                          ('train_months', pymongo.ASCENDING)])
+            _indexed.add(key)
+
+    def flush(self):
+        '''
+            Insert buffered documents
+        '''
+        if self.buffer:
+            self.collection.insert_many(self.buffer)
+            self.buffer = []
+        self.last_flush = time.time()
 
     def log_model(self, model, **keywords):
         '''
-            Log a model to the database
+            Log a model to the database, returns the id of the document.
+            Ids are generated here, so they are valid even if the document
+            is still in the buffer
         '''
         params = model.get_params()
         name = get_model_name(model)
@@ -63,23 +145,36 @@ class Logger:
                 new_key = old_key.replace('.','_')
                 mym[new_key] = mym.pop(old_key)
         model.update(keywords)
-        inserted_id = self.collection.insert_one(model).inserted_id
-        return str(inserted_id)
+        model['_id'] = ObjectId()
+        #Models that cannot be matched across splits get a null
+        #config_hash so add_config_hashes does not look at them again
+        model['config_hash'], model['train_months'] = (_split_key(model)
+                                                       or (None, None))
+        if self.buffer_size is None:
+            self.collection.insert_one(model)
+        else:
+            self.buffer.append(model)
+            if (len(self.buffer) >= self.buffer_size or
+                (self.flush_interval is not None and
+                 time.time() - self.last_flush >= self.flush_interval)):
+                self.flush()
+        return str(model['_id'])
 
     def experiment_exists(self, experiment_name):
         '''
             Check if an experiment already exists
         '''
+        self.create_indexes()
         model = {'experiment_name':experiment_name}
-        model_count = self.collection.find(model).count()
-        return model_count > 0
+        return self.collection.find_one(model, {'_id': 1}) is not None
 
     def experiment_counts(self, experiment_name):
         '''
             Count how many times an experiment has been logged in the DB.
         '''
+        self.create_indexes()
         model = {'experiment_name':experiment_name}
-        model_count = self.collection.find(model).count()
+        model_count = self.collection.count(model)
         return model_count
 
     def get_best_from_experiment(self, experiment_name, key):
@@ -90,25 +185,26 @@ class Logger:
         return (self.collection.find({"experiment_name": experiment_name})
                     .sort(key, pymongo.DESCENDING)[0])
 
-    def get_all_from_experiment(self, experiment_name):
+    def get_all_from_experiment(self, experiment_name, fields=None):
         '''
-           Returns all models from one experiment.
+           Returns all models from one experiment. If fields is not None,
+           only those fields (and _id) are returned.
            Note: The returned list includes both different hyperparameter 
                  sets (from the various sklearn models), but also full duplicate
                  runs (except for random seed) if the experiment was run multiple 
                  times.
         '''
-        models = self.collection.find({"experiment_name": experiment_name})
-        n_models = models.count() 
-        return ( list(models[:]))
+        self.create_indexes()
+        models = self.collection.find({"experiment_name": experiment_name},
+                                      fields)
+        return list(models)
 
     def delete_experiment(self, experiment_name):
         ''' 
             Delete an experiment by key
         '''
-        to_delete = [c['_id'] for c in 
-                self.collection.find({'experiment_name': experiment_name})]
-        self.collection.delete_many({ '_id': { '$in': to_delete }})
+        self.create_indexes()
+        self.collection.delete_many({'experiment_name': experiment_name})
 
     def get_model_across_splits(self, model_id):
         """
@@ -136,48 +232,72 @@ class Logger:
                               across temporal splits.
         """
 
-        # fetch the document for this model_id
-        model_cfg = list(self.collection.find({'_id':ObjectId(model_id)}))
-        if len(model_cfg) > 1:
-            raise ValueError("There is more than one model config for '%s'!"%model_id)
-        else:
-            model_cfg = model_cfg[0]
-
-        # we will match documents by 'name' (the sklearn model name),
-        # 'parameters' (the sklearn model parameters), and 'config' (the YAML),
-        # *except* 'start_date' and 'fake_today', and 'experiment_name' 
-        # in the YAML
-        start_date = datetime.datetime.strptime(
-                model_cfg['config'].pop('start_date'), '%d%b%Y')
-        fake_today = datetime.datetime.strptime(
-                model_cfg['config'].pop('fake_today'), '%d%b%Y')
-        train_len = int((fake_today - start_date).days/30)
-        experiment_name = model_cfg['config'].pop('experiment_name')
-
-        # we want all documents that are identical in a subset of 
-        # the fields
-        match_keys = ['name','parameters','config'] 
-
-        # translate the nested documents to Mongo's dot-syntax
-        searchdict = _flatten_dict({k: model_cfg[k] for k in match_keys})
-
-        # get all the documents that match (but not model_id's one)
-        res = self.collection.find({
-                    '$and': [searchdict,
-                             {'_id': {'$ne': ObjectId(model_id)}}
-                            ] })
-
-        # now toss those out where the training interval has the wrong length
-        res_ids = []
-        for r in res:
-            this_start_date = datetime.datetime.strptime(r['config']['start_date'],
-                                                         '%d%b%Y')
-            this_fake_today = datetime.datetime.strptime(r['config']['fake_today'],
-                                                         '%d%b%Y')
-            if int((this_fake_today - this_start_date).days/30) == train_len:
-                res_ids.append(r['_id'])
-
-        return res_ids
+        self.create_indexes()
+        # documents logged before config_hash existed get one
+        self.add_config_hashes()
+
+        # fetch config_hash and train_months for this model_id
+        model_cfg = self.collection.find_one({'_id': ObjectId(model_id)},
+                                             {'config_hash': 1,
+                                              'train_months': 1})
+        if model_cfg is None:
+            raise ValueError("There is no model config for '%s'!"%model_id)
+        # models without start_date or fake_today cannot be matched
+        if model_cfg.get('config_hash') is None:
+            return []
+
+        # get all the documents with the same config_hash and the same
+        # training interval length (but not model_id's one)
+        res = self.collection.find({'config_hash': model_cfg['config_hash'],
+                                    'train_months': model_cfg['train_months'],
+                                    '_id': {'$ne': ObjectId(model_id)}},
+                                   {'_id': 1})
+        return [r['_id'] for r in res]
+
+    def add_config_hashes(self):
+        '''
+            Add config_hash and train_months to documents that do not have
+            them (logged before they were added), returns the number of
+            documents updated. Documents without start_date or fake_today
+            get null values, so they are only updated once
+        '''
+        docs = self.collection.find({'config_hash': {'$exists': False}},
+                                    {'name': 1, 'parameters': 1, 'config': 1})
+        updates = []
+        for doc in docs:
+            config_hash, train_months = _split_key(doc) or (None, None)
+            updates.append(pymongo.UpdateOne({'_id': doc['_id']},
+                                {'$set': {'config_hash': config_hash,
+                                          'train_months': train_months}}))
+        if updates:
+            self.collection.bulk_write(updates, ordered=False)
+        return len(updates)
+
+    def group_models_across_splits(self, model_ids=None):
+        """
+        Same as get_model_across_splits, for every model at once.
+        Args:
+            model_ids ([str]): Only group these models, if None, all models
+                               in the collection are grouped.
+        Returns ([[ObjectId]]): A list of groups, every group is a list of
+                        the MongoDB IDs of models with identical YAML configs
+                        and sklearn parameters (except for their start_date,
+                        fake_today and experiment_name) and the same distance
+                        between start_date and fake_today. Models without
+                        start_date or fake_today are not returned.
+        """
+        self.create_indexes()
+        self.add_config_hashes()
+
+        match = {'config_hash': {'$ne': None}}
+        if model_ids is not None:
+            match['_id'] = {'$in': [ObjectId(m) for m in model_ids]}
+        pipeline = [{'$match': match},
+                    {'$group': {'_id': {'config_hash': '$config_hash',
+                                        'train_months': '$train_months'},
+                                'ids': {'$push': '$_id'}}}]
+        groups = self.collection.aggregate(pipeline, allowDiskUse=True)
+        return [group['ids'] for group in groups]
 
     def get_doc_from_id(self, model_id):
         """ Fetch the document for a given model_id """
@@ -1,44 +1,132 @@
 import numpy as np
-from sklearn.metrics import precision_score
 
-def precision_at(labels, scores, percent=0.01, ignore_nas=False):
+def metrics_at_percents(y_true, y_score, percents, ignore_nas=False):
     '''
-    Calculates precision at a given percent.
+    Calculates metrics at several percents with a single sort of y_score.
     Only supports binary classification.
+
+    For every percent, the cutoff is the score of the element at that
+    percent (when sorted in descending order) and every score greater or
+    equal than the cutoff is considered a positive prediction.
+
+    Returns a dictionary with numpy arrays (one value per percent): percent,
+    cutoff, tp, fp, tn, fn, precision and recall. Missing values in y_true
+    are ignored when ignore_nas is True (they are neither positives nor
+    negatives), otherwise they raise a ValueError.
     '''
-    #Sort scores in descending order    
-    scores_sorted = np.sort(scores)[::-1]
+    y_score = np.asarray(y_score).ravel()
+    metrics = metrics_at_percents_for_models(y_true, y_score[np.newaxis, :],
+                                             percents=percents,
+                                             ignore_nas=ignore_nas)
+    return {key: (value if key in ('percent', 'k') else value[0])
+            for key, value in metrics.items()}
+
+def metrics_at_percents_for_models(y_true, y_scores, percents=None, ks=None,
+                                   ignore_nas=False, chunksize=None):
+    '''
+    Same as metrics_at_percents, for many models at once. y_scores is a
+    (models x examples) matrix, every row has the scores of one model for
+    the examples in y_true. Instead of percents, the number of examples
+    at the top (ks) can be given, ks greater than the number of examples
+    are evaluated with every example.
 
-    #Based on the percent, get the index to split the data
-    #if value is negative, return 0
-    cutoff_index = max(int(len(labels) * percent) - 1, 0)
-    #Get the cutoff value
-    cutoff_value = scores_sorted[cutoff_index]
-
-    #Convert scores to binary, by comparing them with the cutoff value
-    scores_binary = np.array(map(lambda x: int(x>=cutoff_value), scores))
-    #Calculate precision using sklearn function
-    if ignore_nas:
-        precision = __precision(labels, scores_binary)
+    Rows are processed chunksize at a time (all at once if None), memory
+    used is proportional to chunksize x examples.
+
+    Returns the same dictionary as metrics_at_percents, with
+    (models x percents) matrices (percent and k are vectors)
+    '''
+    y_true = np.asarray(y_true, dtype=float).ravel()
+    y_scores = np.asarray(y_scores)
+    n_models, n = y_scores.shape
+
+    if not ignore_nas and np.isnan(y_true).any():
+        raise ValueError('y_true contains NAs, use ignore_nas=True')
+
+    if ks is None:
+        percents = np.atleast_1d(np.asarray(percents, dtype=float))
+        #Based on the percent, get the index to split the data
+        #if value is negative, return 0
+        cutoff_index = np.clip((n * percents).astype(int) - 1, 0, n - 1)
     else:
-        precision = precision_score(labels, scores_binary)
+        #ks greater than the number of examples use every example
+        cutoff_index = np.clip(np.atleast_1d(ks).astype(int) - 1, 0, n - 1)
+        percents = (cutoff_index + 1) / float(n)
+
+    chunksize = chunksize or max(n_models, 1)
+    names = ['cutoff', 'tp', 'fp', 'tn', 'fn']
+    chunks = dict((name, []) for name in names)
+    positions = np.arange(n)
+    for start in range(0, n_models, chunksize):
+        scores = y_scores[start:start+chunksize]
+        rows = np.arange(len(scores))[:, np.newaxis]
+
+        #Sort scores in descending order, keep labels in the same order
+        order = np.argsort(scores, axis=1, kind='mergesort')[:, ::-1]
+        scores_sorted = scores[rows, order]
+        y_true_sorted = y_true[order]
+
+        cutoff = scores_sorted[:, cutoff_index]
+
+        #Scores equal to the cutoff are also positives, the number of
+        #positives is the position of the last score equal to the cutoff
+        is_last = np.ones(scores_sorted.shape, dtype=bool)
+        is_last[:, :-1] = scores_sorted[:, :-1] != scores_sorted[:, 1:]
+        last = np.where(is_last, positions, n)
+        last = np.minimum.accumulate(last[:, ::-1], axis=1)[:, ::-1]
+        n_positive = last[:, cutoff_index] + 1
+
+        #Cumulative counts of labels, from the highest score to the lowest
+        tp_cum = np.cumsum(y_true_sorted == 1, axis=1)
+        fp_cum = np.cumsum(y_true_sorted == 0, axis=1)
+        tp = tp_cum[rows, n_positive - 1]
+        fp = fp_cum[rows, n_positive - 1]
+
+        chunks['cutoff'].append(cutoff)
+        chunks['tp'].append(tp)
+        chunks['fp'].append(fp)
+        chunks['fn'].append(tp_cum[:, -1:] - tp)
+        chunks['tn'].append(fp_cum[:, -1:] - fp)
+
+    metrics = dict((name, np.concatenate(chunks[name])) for name in names)
+    tp, fp, fn = metrics['tp'], metrics['fp'], metrics['fn']
+
+    #Same as sklearn, precision and recall are 0 when undefined
+    predicted = tp + fp
+    metrics['precision'] = np.where(predicted > 0,
+                                    tp / np.maximum(predicted, 1).astype(float), 0.0)
+    actual = tp + fn
+    metrics['recall'] = np.where(actual > 0,
+                                 tp / np.maximum(actual, 1).astype(float), 0.0)
+    metrics['percent'] = percents
+    metrics['k'] = cutoff_index + 1
+    return metrics
 
-    return precision, cutoff_value
+def precision_at(labels, scores, percent=0.01, ignore_nas=False):
+    '''
+    Calculates precision at a given percent.
+    Only supports binary classification.
+    '''
+    metrics = metrics_at_percents(labels, scores, [percent],
+                                  ignore_nas=ignore_nas)
+    return metrics['precision'][0], metrics['cutoff'][0]
 
 
 def __threshold_at_percent(y_score, percent):
-    #Sort scores in descending order    
-    scores_sorted = np.sort(y_score)[::-1]
+    y_score = np.asarray(y_score)
+    n = len(y_score)
     #Based on the percent, get the index to split the data
-    #if value is negative, return 0
-    threshold_index = max(int(len(y_score) * percent) - 1, 0)
-    #Get the cutoff value
-    threshold_value = scores_sorted[threshold_index]
+    #(in descending order), if value is negative, return 0
+    threshold_index = max(int(n * percent) - 1, 0)
+    #Same position in ascending order, partition puts the value there
+    #without sorting the whole array
+    position = n - 1 - threshold_index
+    threshold_value = np.partition(y_score, position)[position]
     return threshold_value
 
 def __binarize_scores_at_percent(y_score, percent):
     threshold_value = __threshold_at_percent(y_score, percent)
-    y_score_binary = np.array(map(lambda x: int(x>=threshold_value), y_score))
+    y_score_binary = (np.asarray(y_score) >= threshold_value).astype(int)
     return y_score_binary
 
 def __precision(y_true, y_pred):
@@ -46,39 +134,25 @@ def __precision(y_true, y_pred):
         Precision metric tolerant to unlabeled data in y_true,
         NA values are ignored for the precision calculation
     '''
-    #make copies of the arrays to avoid modifying the original ones
-    y_true = np.copy(y_true)
-    y_pred = np.copy(y_pred)
-
     #precision = tp/(tp+fp)
-    #True nehatives do not affect precision value, so for every missing
-    #value in y_true, replace it with 0 and also replace the value
-    #in y_pred with 0
-    is_nan = np.isnan(y_true)
-    y_true[is_nan] = 0
-    y_pred[is_nan] = 0
-    precision = precision_score(y_true, y_pred)
-    return precision
+    #True negatives do not affect precision value, so predictions
+    #for missing values in y_true are not counted
+    y_true = np.asarray(y_true, dtype=float)
+    predicted = (np.asarray(y_pred) == 1) & ~np.isnan(y_true)
+    tp = (predicted & (y_true == 1)).sum()
+    return tp / float(predicted.sum()) if predicted.sum() else 0.0
 
 def tp_at_percent(y_true, y_score, percent):
-    y_pred = __binarize_scores_at_percent(y_score, percent)
-    tp = (y_pred == 1) & (y_true == 1)
-    return tp.sum()
+    return metrics_at_percents(y_true, y_score, [percent], ignore_nas=True)['tp'][0]
 
 def fp_at_percent(y_true, y_score, percent):
-    y_pred = __binarize_scores_at_percent(y_score, percent)
-    fp = (y_pred == 1) & (y_true == 0)
-    return fp.sum()
+    return metrics_at_percents(y_true, y_score, [percent], ignore_nas=True)['fp'][0]
 
 def tn_at_percent(y_true, y_score, percent):
-    y_pred = __binarize_scores_at_percent(y_score, percent)
-    tn = (y_pred == 0) & (y_true == 0)
-    return tn.sum()
+    return metrics_at_percents(y_true, y_score, [percent], ignore_nas=True)['tn'][0]
 
 def fn_at_percent(y_true, y_score, percent):
-    y_pred = __binarize_scores_at_percent(y_score, percent)
-    fn = (y_pred == 0) & (y_true == 1)
-    return fn.sum()
+    return metrics_at_percents(y_true, y_score, [percent], ignore_nas=True)['fn'][0]
 
 def labels_at_percent(y_true, y_score, percent, normalize=False):
     '''
@@ -102,4 +176,4 @@ def labels_at_percent(y_true, y_score, percent, normalize=False):
     if normalize:
         values = float(values)/(~np.isnan(y_true)).sum()
         
-    return values
\ No newline at end of file
+    return values
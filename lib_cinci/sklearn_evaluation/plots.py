@@ -12,7 +12,7 @@ from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 import tables
-from metrics import precision_at
+from metrics import metrics_at_percents
 
 from sklearn.preprocessing import label_binarize
 
@@ -237,8 +237,7 @@ def precision_at_proportions(test_labels, test_predictions, ax=None, **kwargs):
 
     #Calculate points
     percents = [0.01 * i for i in range(1, 101)]
-    precs_and_cutoffs = [precision_at(test_labels, test_predictions, percent=p) for p in percents]
-    precs, cutoffs = zip(*precs_and_cutoffs)
+    precs = metrics_at_percents(test_labels, test_predictions, percents)['precision']
 
     #Plot and set nice defaults for title and axis labels
     ax.plot(percents, precs, **kwargs)
@@ -0,0 +1,49 @@
+"""
+Tests for the COPY based writer (only the parts that do not need a database)
+"""
+import datetime
+import unittest
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, types
+
+from lib_cinci.bulk_writer import frame_to_csv, create_table_statement
+
+
+class TestFrameToCSV(unittest.TestCase):
+
+    def test_nulls_are_empty_fields(self):
+        df = pd.DataFrame({"a": [1.0, np.nan], "b": ["x", None]},
+                          columns=["a", "b"])
+        self.assertEqual("1,x\n,\n", frame_to_csv(df).read())
+
+    def test_floats_keep_every_digit(self):
+        value = 0.1 + 0.2
+        df = pd.DataFrame({"a": [value]})
+        self.assertEqual(value, float(frame_to_csv(df).read()))
+
+    def test_dates(self):
+        df = pd.DataFrame({"a": [datetime.datetime(2015, 1, 2)]})
+        self.assertEqual("2015-01-02\n", frame_to_csv(df).read())
+
+
+class TestCreateTableStatement(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('postgresql://user@localhost/db')
+
+    def test_same_types_as_to_sql(self):
+        df = pd.DataFrame({"parcel_id": ["a"], "total": [1],
+                           "mean": [0.5],
+                           "inspection_date": [datetime.datetime(2015, 1, 2)]},
+                          columns=["parcel_id", "total", "mean", "inspection_date"])
+        statement = create_table_statement(df, "crime_1000m_3months", self.engine,
+                    schema="features",
+                    dtype={"inspection_date": types.TIMESTAMP(timezone=False)})
+        self.assertIn("CREATE TABLE features.crime_1000m_3months", statement)
+        self.assertIn("parcel_id TEXT", statement)
+        self.assertIn("total BIGINT", statement)
+        self.assertIn("mean FLOAT(53)", statement)
+        self.assertIn("inspection_date TIMESTAMP WITHOUT TIME ZONE", statement)
+        self.assertNotIn("INDEX", statement)
@@ -0,0 +1,23 @@
+import pandas as pd
+import numpy as np
+
+from lib_cinci.util import compact_dtypes
+
+
+def test_downcasts_numbers():
+    frame = pd.DataFrame({"count": [1, 2], "mean": [0.5, np.nan],
+                          "name": ["a", "b"]})
+    actual = compact_dtypes(frame).dtypes
+    assert actual["count"] == np.int32
+    assert actual["mean"] == np.float32
+    assert actual["name"] == np.object
+
+
+def test_keeps_large_integers():
+    frame = pd.DataFrame({"value": [1, 2**40]})
+    assert compact_dtypes(frame).dtypes["value"] == np.int64
+
+
+def test_empty_frame():
+    frame = pd.DataFrame({"value": np.array([], dtype=np.int64)})
+    assert compact_dtypes(frame).dtypes["value"] == np.int32
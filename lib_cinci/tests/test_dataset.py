@@ -322,4 +322,62 @@ class TestImputationFrame(unittest.TestCase):
         expected = self.make_expected(index, [expected0, expected1, expected2])
 
         actual = util.mean_impute_frame(self.make_input(index, [values0, values1, values2]), subset=subset)
-        assert_frame_equal(expected, actual)
\ No newline at end of file
+        assert_frame_equal(expected, actual)
+
+class InMemoryLoader():
+    '''
+        Serves labels and feature groups from DataFrames, with the same
+        interface load_dataset and make_dataset use from FeatureLoader
+    '''
+    def __init__(self, labels, tables):
+        self.labels = labels
+        self.tables = tables
+
+    def load_parcels_inspections(self, only_residential):
+        return self.labels.set_index(["parcel_id", "inspection_date"])
+
+    def load_feature_group(self, table_name, features_to_load):
+        table = self.tables[table_name].set_index(["parcel_id", "inspection_date"])
+        return table[features_to_load]
+
+    def impute_feature_group(self, table_name, df, dtypes):
+        return dataset.FeatureLoader.generic_imputer.__func__(self, df, dtypes)
+
+
+class TestSplitDataset(unittest.TestCase):
+
+    def setUp(self):
+        dates = [date("01Jan2015"), date("01Feb2015"), date("01Mar2015"),
+                 date("01Apr2015"), date("01May2015")]
+        labels = pd.DataFrame({"parcel_id": ["a", "b", "c", "d", "e"],
+                               "inspection_date": dates,
+                               "viol_outcome": [0, 1, 0, 1, 0]})
+        tax = pd.DataFrame({"parcel_id": ["a", "b", "c", "d", "e"],
+                            "inspection_date": dates,
+                            "value": [1.0, 3.0, np.nan, 10.0, np.nan]})
+        self.loader = InMemoryLoader(labels, {"tax": tax})
+        self.features = [("tax", "value")]
+
+    def test_subsets_are_imputed_separately(self):
+        df, groups = dataset.load_dataset(self.loader, self.features,
+                                          self.features, False)
+        train = dataset.make_dataset(df.iloc[:3].copy(), self.loader, groups,
+                                     self.features)
+        test = dataset.make_dataset(df.iloc[3:].copy(), self.loader, groups,
+                                    self.features)
+
+        self.assertEqual(2.0, train.x.loc[("c", date("01Mar2015")), "tax_value"])
+        self.assertEqual(10.0, test.x.loc[("e", date("01May2015")), "tax_value"])
+        self.assertEqual(["tax_value"], list(train.x.columns))
+
+    @raises(dataset.UnknownFeatureError)
+    def test_unknown_feature(self):
+        dataset.load_dataset(self.loader, [("tax", "unknown")], self.features,
+                             False)
+
+    def test_compact_dtypes_are_imputed(self):
+        self.loader.tables["tax"]["value"] = self.loader.tables["tax"]["value"].astype(np.float32)
+        df, groups = dataset.load_dataset(self.loader, self.features,
+                                          self.features, False)
+        actual = dataset.make_dataset(df, self.loader, groups, self.features)
+        self.assertEqual(0, actual.x["tax_value"].isnull().sum())
@@ -0,0 +1,84 @@
+"""
+Tests for the local feature cache
+"""
+import shutil
+import tempfile
+import datetime
+import unittest
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+from nose.tools import raises
+
+from lib_cinci.feature_cache import FeatureCache
+
+
+def save_many(args):
+    folder, version = args
+    features = pd.DataFrame({'parcel_id': ['a', 'b'],
+                             'inspection_date': [datetime.date(2015, 1, 1)]*2,
+                             'count': [1, 2]})
+    for _ in range(10):
+        FeatureCache(folder).save('features', 'crime', version, features)
+
+
+class TestFeatureCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = FeatureCache(self.folder)
+        self.features = pd.DataFrame({
+            'parcel_id': ['c', 'a', 'b', 'a'],
+            'inspection_date': [datetime.date(2015, 3, 1), datetime.date(2014, 1, 1),
+                                datetime.date(2015, 1, 1), datetime.date(2016, 1, 1)],
+            'count': [3, 1, 2, 4],
+            'mean': [0.3, np.nan, 0.2, 0.4],
+            'category': ['x', None, 'y', 'z']},
+            columns=['parcel_id', 'inspection_date', 'count', 'mean', 'category'])
+        self.cache.save('features', 'crime', 'v1', self.features)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_load_date_range_and_columns(self):
+        actual = self.cache.load('features', 'crime', 'v1', ['mean', 'count'],
+                                 '2015-01-01', '2016-01-01')
+        expected = self.features.iloc[[2, 0]][['parcel_id', 'inspection_date',
+                                               'mean', 'count']]
+        assert_frame_equal(expected.reset_index(drop=True), actual)
+
+    def test_keeps_types(self):
+        actual = self.cache.load('features', 'crime', 'v1', ['count', 'category'],
+                                 '1970-01-01', '2080-01-01')
+        self.assertEqual(np.dtype('int64'), actual['count'].dtype)
+        self.assertEqual(datetime.date(2014, 1, 1), actual.inspection_date[0])
+        self.assertEqual(['a', 'b', 'c', 'a'], list(actual.parcel_id))
+        self.assertEqual([None, 'y', 'x', 'z'], list(actual.category))
+
+    def test_different_version_is_not_loaded(self):
+        actual = self.cache.load('features', 'crime', 'v2', ['count'],
+                                 '1970-01-01', '2080-01-01')
+        self.assertIsNone(actual)
+
+    def test_missing_table_is_not_loaded(self):
+        actual = self.cache.load('features', 'fire', 'v1', ['count'],
+                                 '1970-01-01', '2080-01-01')
+        self.assertIsNone(actual)
+
+    @raises(KeyError)
+    def test_unknown_column(self):
+        self.cache.load('features', 'crime', 'v1', ['unknown'],
+                        '1970-01-01', '2080-01-01')
+
+    def test_concurrent_writers(self):
+        pool = Pool(4)
+        try:
+            pool.map(save_many, [(self.folder, 'v2')]*4)
+        finally:
+            pool.close()
+            pool.join()
+        actual = self.cache.load('features', 'crime', 'v2', ['count'],
+                                 '1970-01-01', '2080-01-01')
+        self.assertEqual([1, 2], list(actual['count']))
@@ -3,7 +3,7 @@ from pandas.util.testing import assert_frame_equal
 import numpy as np
 from nose.tools import raises
 
-from lib_cinci.util import get_dummies
+from lib_cinci.util import get_dummies, dummy_variables
 
 
 
@@ -67,4 +67,35 @@ def test_only_nan():
                              (np.nan, np.nan, np.nan)], columns=possible_values)
 
     actual = get_dummies(data, possible_values)
-    assert_frame_equal(expected, actual)
\ No newline at end of file
+    assert_frame_equal(expected, actual)
+
+def test_uint8_missing_values_are_zero():
+    possible_values = ["val1", "val2", "val3"]
+    data = pd.Series(["val3", np.nan, "val1"], index=["a", "b", "c"])
+    expected = pd.DataFrame([(0, 0, 1), (0, 0, 0), (1, 0, 0)],
+                            index=["a", "b", "c"], columns=possible_values,
+                            dtype=np.uint8)
+
+    actual = get_dummies(data, possible_values, dtype=np.uint8)
+    assert_frame_equal(expected, actual)
+
+
+def test_sparse_same_as_dense():
+    possible_values = ["val1", "val2", "val3"]
+    data = pd.Series(["val1", "val3", np.nan, "val2", "val3"])
+    dense = get_dummies(data, possible_values, dtype=np.uint8)
+
+    actual = get_dummies(data, possible_values, sparse=True)
+    np.testing.assert_array_equal(dense.values, actual.toarray())
+
+
+@raises(ValueError)
+def test_illegal_value_sparse():
+    get_dummies(pd.Series(["val4"]), ["val1"], sparse=True)
+
+
+def test_registry_columns_match_loader():
+    from lib_cinci.dataset import FeatureLoader
+    features = FeatureLoader.resolve_dummy_variables(["home_use", "area"],
+                                                     dummy_variables)
+    assert features == dummy_variables["home_use"] + ["area"]
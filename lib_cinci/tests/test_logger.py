@@ -0,0 +1,125 @@
+"""
+Tests for buffered logging in sklearn_evaluation.Logger
+"""
+import unittest
+
+from sklearn.linear_model import LogisticRegression
+
+from sklearn_evaluation.Logger import Logger, _split_key
+
+
+class InMemoryCollection(object):
+    '''
+        Records inserts instead of sending them to MongoDB
+    '''
+    def __init__(self):
+        self.inserts = []
+
+    def insert_one(self, document):
+        self.inserts.append([document])
+
+    def insert_many(self, documents):
+        self.inserts.append(list(documents))
+
+
+class BackfillCollection(object):
+    '''
+        Documents in memory, supports the queries used by
+        add_config_hashes
+    '''
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query, projection):
+        return [d for d in self.documents if 'config_hash' not in d]
+
+    def bulk_write(self, requests, ordered):
+        by_id = dict((d['_id'], d) for d in self.documents)
+        for request in requests:
+            by_id[request._filter['_id']].update(request._doc['$set'])
+
+
+def make_logger(**kwargs):
+    logger = Logger('mongodb://localhost:27017', 'db', 'collection', **kwargs)
+    logger.collection = InMemoryCollection()
+    return logger
+
+
+def log(logger):
+    return logger.log_model(LogisticRegression(), config={'models': []},
+                            experiment_name='test')
+
+
+class TestLogger(unittest.TestCase):
+
+    def test_unbuffered_inserts_every_model(self):
+        logger = make_logger()
+        ids = [log(logger) for _ in range(3)]
+        self.assertEqual([len(i) for i in logger.collection.inserts], [1, 1, 1])
+        self.assertEqual(ids, [str(i[0]['_id'])
+                               for i in logger.collection.inserts])
+
+    def test_buffered_inserts_in_batches(self):
+        logger = make_logger(buffer_size=2)
+        ids = [log(logger) for _ in range(3)]
+        self.assertEqual([len(i) for i in logger.collection.inserts], [2])
+        logger.flush()
+        self.assertEqual([len(i) for i in logger.collection.inserts], [2, 1])
+        inserted = [str(d['_id']) for i in logger.collection.inserts for d in i]
+        self.assertEqual(ids, inserted)
+
+    def test_flush_interval(self):
+        logger = make_logger(buffer_size=100, flush_interval=0)
+        log(logger)
+        self.assertEqual([len(i) for i in logger.collection.inserts], [1])
+
+    def test_client_is_shared(self):
+        a = Logger('mongodb://localhost:27017', 'db', 'a')
+        b = Logger('mongodb://localhost:27017', 'db', 'b')
+        self.assertIs(a.collection.database.client, b.collection.database.client)
+
+
+class TestSplitKey(unittest.TestCase):
+
+    def doc(self, start_date, fake_today, experiment_name='a', C=1.0):
+        return {'name': 'LogisticRegression', 'parameters': {'C': C},
+                'config': {'start_date': start_date, 'fake_today': fake_today,
+                           'experiment_name': experiment_name,
+                           'features': ['tax.%', 'crime.%']}}
+
+    def test_same_config_in_other_split(self):
+        a = _split_key(self.doc('01Jan2012', '01Jan2014'))
+        b = _split_key(self.doc('01Jan2013', '01Jan2015', experiment_name='b'))
+        self.assertEqual(a, b)
+
+    def test_different_training_length(self):
+        a = _split_key(self.doc('01Jan2012', '01Jan2014'))
+        b = _split_key(self.doc('01Jan2013', '01Jan2014'))
+        self.assertEqual(a[0], b[0])
+        self.assertNotEqual(a[1], b[1])
+
+    def test_different_parameters(self):
+        a = _split_key(self.doc('01Jan2012', '01Jan2014'))
+        b = _split_key(self.doc('01Jan2012', '01Jan2014', C=0.1))
+        self.assertNotEqual(a[0], b[0])
+
+    def test_log_model_adds_split_key(self):
+        logger = make_logger()
+        log(logger)
+        self.assertIsNone(logger.collection.inserts[0][0]['config_hash'])
+        logger.log_model(LogisticRegression(), config={
+            'models': [], 'start_date': '01Jan2012', 'fake_today': '01Jan2014'})
+        self.assertEqual(logger.collection.inserts[1][0]['train_months'], 24)
+
+    def test_add_config_hashes_once(self):
+        logger = make_logger()
+        logger.collection = BackfillCollection([
+            dict(self.doc('01Jan2012', '01Jan2014'), _id=1),
+            {'_id': 2, 'name': 'LogisticRegression', 'parameters': {},
+             'config': {}}])
+        self.assertEqual(logger.add_config_hashes(), 2)
+        docs = logger.collection.documents
+        self.assertEqual(docs[0]['train_months'], 24)
+        self.assertIsNone(docs[1]['config_hash'])
+        #Documents that cannot be hashed are not updated again
+        self.assertEqual(logger.add_config_hashes(), 0)
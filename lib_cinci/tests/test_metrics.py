@@ -1,5 +1,6 @@
 from unittest import TestCase
-from sklearn_evaluation.metrics import (precision_at, labels_at_percent,
+from sklearn_evaluation.metrics import (precision_at, labels_at_percent, metrics_at_percents,
+    metrics_at_percents_for_models,
     tp_at_percent, fp_at_percent)
 
 from sklearn_evaluation.metrics import __threshold_at_percent as threshold_at_percent
@@ -7,6 +8,7 @@ from sklearn_evaluation.metrics import __binarize_scores_at_percent as binarize_
 
 import numpy as np
 from numpy import nan
+from sklearn.metrics import precision_score, recall_score
 from random import shuffle
 
 class Test_threshold_at_percent(TestCase):
@@ -263,4 +265,83 @@ class Test_fp_at_percent(TestCase):
         y_true = np.array([0, 0, 0, 0, 1, 0, 0, 1, 1, 1])
         y_score = np.array([1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1])
         fps = fp_at_percent(y_true, y_score, percent=1.0)
-        self.assertEqual(fps, 6)
\ No newline at end of file
+        self.assertEqual(fps, 6)
+class Test_metrics_at_percents(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        #Rounded scores to have ties
+        self.y_score = np.round(rng.rand(500), 2)
+        self.y_true = rng.randint(0, 2, 500).astype(float)
+        self.percents = [0.01 * i for i in range(1, 101)]
+
+    def test_same_as_binarizing_at_every_percent(self):
+        metrics = metrics_at_percents(self.y_true, self.y_score, self.percents)
+        for i, percent in enumerate(self.percents):
+            y_pred = binarize_scores_at_percent(self.y_score, percent)
+            self.assertEqual(metrics['cutoff'][i],
+                             threshold_at_percent(self.y_score, percent))
+            self.assertAlmostEqual(metrics['precision'][i],
+                                   precision_score(self.y_true, y_pred))
+            self.assertAlmostEqual(metrics['recall'][i],
+                                   recall_score(self.y_true, y_pred))
+            self.assertEqual(metrics['tp'][i] + metrics['fp'][i], y_pred.sum())
+            self.assertEqual(metrics['tn'][i] + metrics['fn'][i],
+                             len(y_pred) - y_pred.sum())
+
+    def test_nas_are_ignored(self):
+        y_true = np.copy(self.y_true)
+        y_true[::3] = nan
+        metrics = metrics_at_percents(y_true, self.y_score, [0.2, 0.5],
+                                      ignore_nas=True)
+        for i, percent in enumerate([0.2, 0.5]):
+            #Unlabeled inspections count as true negatives
+            y_pred = binarize_scores_at_percent(self.y_score, percent)
+            is_nan = np.isnan(y_true)
+            y_pred[is_nan] = 0
+            expected = precision_score(np.where(is_nan, 0, y_true), y_pred)
+            self.assertAlmostEqual(expected, metrics['precision'][i])
+        labeled = (~np.isnan(y_true)).sum()
+        totals = metrics['tp'] + metrics['fp'] + metrics['tn'] + metrics['fn']
+        np.testing.assert_equal(totals, [labeled, labeled])
+
+    def test_nas_raise_if_not_ignored(self):
+        y_true = np.array([1, nan, 0])
+        self.assertRaises(ValueError, metrics_at_percents, y_true,
+                          np.array([0.3, 0.2, 0.1]), [0.5])
+
+
+class Test_metrics_at_percents_for_models(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.y_scores = np.round(rng.rand(7, 300), 2)
+        self.y_true = rng.randint(0, 2, 300).astype(float)
+        self.y_true[::5] = nan
+        self.percents = [0.01, 0.1, 0.33, 1.0]
+
+    def test_same_as_one_model_at_a_time(self):
+        metrics = metrics_at_percents_for_models(self.y_true, self.y_scores,
+                                                 self.percents, ignore_nas=True,
+                                                 chunksize=3)
+        for i, y_score in enumerate(self.y_scores):
+            expected = metrics_at_percents(self.y_true, y_score, self.percents,
+                                           ignore_nas=True)
+            for key in ['cutoff', 'tp', 'fp', 'tn', 'fn', 'precision', 'recall']:
+                np.testing.assert_equal(expected[key], metrics[key][i])
+
+    def test_top_k(self):
+        y_true = np.array([1, 0, 1, 0])
+        y_scores = np.array([[0.9, 0.8, 0.7, 0.6],
+                             [0.6, 0.7, 0.8, 0.9]])
+        metrics = metrics_at_percents_for_models(y_true, y_scores, ks=[1, 2])
+        np.testing.assert_equal(metrics['precision'], [[1.0, 0.5], [0.0, 0.5]])
+        np.testing.assert_equal(metrics['recall'], [[0.5, 0.5], [0.0, 0.5]])
+        np.testing.assert_equal(metrics['percent'], [0.25, 0.5])
+
+    def test_k_greater_than_examples(self):
+        y_true = np.array([1, 0, 1, 0])
+        y_scores = np.array([[0.9, 0.8, 0.7, 0.6]])
+        metrics = metrics_at_percents_for_models(y_true, y_scores, ks=[2, 10])
+        np.testing.assert_equal(metrics['k'], [2, 4])
+        np.testing.assert_equal(metrics['precision'], [[0.5, 0.5]])
+        np.testing.assert_equal(metrics['recall'], [[0.5, 1.0]])
+        np.testing.assert_equal(metrics['percent'], [0.5, 1.0])
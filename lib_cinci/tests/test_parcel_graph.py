@@ -0,0 +1,18 @@
+"""
+Tests for the parcel neighbour graph
+"""
+import unittest
+
+from nose.tools import raises
+
+from lib_cinci.parcel_graph import check_max_dist
+
+
+class TestMaxDist(unittest.TestCase):
+
+    def test_max_dist_in_graph(self):
+        check_max_dist(1000)
+
+    @raises(ValueError)
+    def test_max_dist(self):
+        check_max_dist(1500)
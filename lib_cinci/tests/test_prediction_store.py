@@ -0,0 +1,101 @@
+"""
+Tests for the binary prediction store
+"""
+import os
+import shutil
+import tempfile
+import datetime
+import unittest
+
+import numpy as np
+import pandas as pd
+from nose.tools import raises
+
+from lib_cinci.prediction_store import PredictionStore
+
+
+class TestPredictionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = PredictionStore(self.folder)
+        self.date = datetime.date(2015, 1, 1)
+        self.store.save('a', [('p1', self.date), ('p2', self.date),
+                              ('p3', self.date)],
+                        [0.1, 0.9, 0.5], labels=[1, 0, 1])
+        self.store.save('b', [('p3', self.date),
+                              ('long_parcel', datetime.date(2015, 2, 1))],
+                        [0.7, 0.2])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_load_sorts_by_prediction(self):
+        df = self.store.load('a')
+        self.assertEqual(list(df.index.get_level_values('parcel_id')),
+                         ['p2', 'p3', 'p1'])
+        np.testing.assert_allclose(df.prediction, [0.9, 0.5, 0.1], rtol=1e-6)
+        np.testing.assert_array_equal(df.viol_outcome, [0, 1, 1])
+
+    def test_load_top(self):
+        df = self.store.load('b', top=1)
+        self.assertEqual(list(df.index), [('p3', np.datetime64('2015-01-01'))])
+        self.assertNotIn('viol_outcome', df.columns)
+
+    def test_index_is_shared(self):
+        #p3 on 2015-01-01 is only saved once
+        parcel_id = np.load('{}/index_parcel_id.npy'.format(self.folder))
+        self.assertEqual(sorted(parcel_id), ['long_parcel', 'p1', 'p2', 'p3'])
+
+    def test_load_matrix(self):
+        index, matrix = self.store.load_matrix(['a', 'b'], top=2)
+        self.assertEqual(list(index.get_level_values('parcel_id')),
+                         ['p2', 'p3', 'long_parcel'])
+        np.testing.assert_allclose(matrix, [[0.9, 0.5, np.nan],
+                                            [np.nan, 0.7, 0.2]], rtol=1e-6)
+
+    def test_save_replaces_model(self):
+        self.store.save('a', [('p4', self.date)], [0.3])
+        self.assertEqual(list(self.store.load('a').index.get_level_values(0)),
+                         ['p4'])
+
+    def test_prune(self):
+        self.assertEqual(self.store.prune(['b']), 1)
+        self.assertEqual(self.store.model_ids(), ['b'])
+
+    @raises(KeyError)
+    def test_missing_model(self):
+        self.store.load('c')
+
+
+class TestLegacyCSV(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.model_id = '5a1b2c3d4e5f60718293a4b5'
+        #Same format model.py used to write
+        df = pd.DataFrame({'parcel_id': ['p1', 'p2'],
+                           'inspection_date': ['2015-01-01', '2015-02-01'],
+                           'viol_outcome': [1, 0],
+                           'prediction': [0.2, 0.8]})
+        df.to_csv(os.path.join(self.folder, self.model_id))
+        self.store = PredictionStore(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_csv_is_imported_on_load(self):
+        df = self.store.load(self.model_id)
+        self.assertEqual(list(df.index.get_level_values('parcel_id')),
+                         ['p2', 'p1'])
+        np.testing.assert_array_equal(df.viol_outcome, [0, 1])
+        self.assertEqual(self.store.model_ids(), [self.model_id])
+
+    def test_csv_is_imported_on_load_matrix(self):
+        index, matrix = self.store.load_matrix([self.model_id], top=1)
+        self.assertEqual(list(index.get_level_values('parcel_id')), ['p2'])
+
+    def test_prune_removes_csv(self):
+        self.assertEqual(self.store.prune([]), 1)
+        self.assertEqual(self.store.legacy_ids(), [])
+        self.assertTrue(os.path.exists(os.path.join(self.folder, 'models')))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Run every experiment config in a folder (e.g. experiments/splits/medium_models).
+
+Configs that only differ in their models or grid share the same train, test
+(and prediction) sets, so they are grouped by (features, start_date,
+fake_today, validation_window, residential_only). Every group's datasets are
+loaded, imputed and scaled once and then all the models from every config in
+the group are trained in a pool of worker processes, which get the datasets
+from the parent process when they are forked.
+
+Example:
+    python batch.py -c experiments/splits/medium_models/01Jan2013_30Jun2015 -j 8
+"""
+import os
+import argparse
+import logging
+import logging.config
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from lib_cinci.config import load
+import model as model_runner
+
+logging.config.dictConfig(load('logger_config.yaml'))
+logger = logging.getLogger()
+
+#Keys that define the datasets used in an experiment
+DATASET_KEYS = ['features', 'start_date', 'fake_today', 'validation_window',
+                'residential_only']
+
+#Datasets for the group being run, set before starting the workers
+#so they are shared with them
+shared_datasets = None
+
+def list_configs(folder):
+    '''
+        Every .yaml file in folder and its subfolders, sorted by path
+    '''
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        paths.extend(os.path.join(root, f) for f in files if f.endswith('.yaml'))
+    return sorted(paths)
+
+def dataset_key(config):
+    return tuple(tuple(config[k]) if isinstance(config[k], list) else config[k]
+                 for k in DATASET_KEYS)
+
+def group_configs(configs):
+    '''
+        Group (config, config_raw) pairs with the same datasets, groups
+        keep the order in which configs are listed
+    '''
+    groups = OrderedDict()
+    for config, config_raw in configs:
+        groups.setdefault(dataset_key(config), []).append((config, config_raw))
+    return groups.values()
+
+def fit_in_worker(task):
+    config, config_raw, model, options = task
+    train, test, preds, imputer, scaler = shared_datasets
+    logger.info("{} - Training {}".format(config['experiment_name'], model))
+    return model_runner.fit_model(model, config, config_raw, train, test, preds,
+                                  imputer, scaler, **options)
+
+def run_group(group, jobs, options, dump=False):
+    global shared_datasets
+    #Datasets only depend on the group key, use the first config
+    config = group[0][0]
+    logger.info('Loading datasets for {} configs ({})'.format(len(group),
+                                    ', '.join(c['experiment_name'] for c, _ in group)))
+    shared_datasets = model_runner.prepare_datasets(config,
+                                    predicttop=options['predicttop'],
+                                    dump=dump)
+
+    tasks = [(config, config_raw, model, options)
+             for config, config_raw in group
+             for model in model_runner.get_models_from_config(config['models'],
+                                                              config['grid_size'])]
+    logger.info('Training {} models with {} jobs'.format(len(tasks), jobs))
+    if jobs > 1:
+        pool = Pool(jobs)
+        try:
+            model_ids = pool.map(fit_in_worker, tasks, chunksize=1)
+            #Let workers exit normally, so they insert their buffered
+            #MongoDB documents
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        model_ids = [fit_in_worker(task) for task in tasks]
+    shared_datasets = None
+    return model_ids
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--configs_folder", type=str, required=True,
+                        help="Folder with yaml configuration files (subfolders "
+                        "are also searched)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of models trained at the same time")
+    parser.add_argument("-n", "--n_jobs", type=int, default=1,
+                        help=("n_jobs flag passed to scikit-learn models, "
+                              "defaults to 1 since models already run in "
+                              "parallel"))
+    parser.add_argument("-nl", "--notlog", action="store_true",
+                        help="Do not log results to MongoDB")
+    parser.add_argument("-ol", "--overwritelog", action="store_true",
+                        help="If an experiment already exists "
+                        "in the MongoDB, overwrite it.")
+    parser.add_argument("-p", "--pickle", action="store_true",
+                        help="Pickle models, imputers and scalers, "
+                        "only valid if logging is activated")
+    parser.add_argument("-d", "--dump", action="store_true",
+                        help="Dump train and test sets for the first "
+                        "config in every group")
+    parser.add_argument("-pt", "--predicttop", type=int, default=None,
+                        help="Make predictions on all parcels, and "
+                        "store the top X percent")
+    args = parser.parse_args()
+
+    if args.predicttop and args.notlog:
+        raise ValueError("You cannot save the top X predictions "
+                "on all parcels without also logging.")
+
+    configs = [model_runner.configure_model(path)
+               for path in list_configs(args.configs_folder)]
+
+    #Check every experiment before training anything
+    if not args.notlog:
+        for config, _ in configs:
+            model_runner.check_experiment_is_new(config, args.overwritelog)
+
+    options = dict(n_jobs=args.n_jobs, notlog=args.notlog, pickle=args.pickle,
+                   predicttop=args.predicttop)
+    groups = group_configs(configs)
+    logger.info('{} configs, {} different datasets'.format(len(configs),
+                                                          len(groups)))
+    for group in groups:
+        run_group(group, args.jobs, options, dump=args.dump)
@@ -6,7 +6,9 @@ from pymongo import DESCENDING
 from lib_cinci.config import main
 from lib_cinci.config import load
 from lib_cinci.folders import (path_to_predictions, path_to_pickled_models,
-    path_to_pickled_scalers, path_to_pickled_imputers)
+    path_to_pickled_scalers, path_to_pickled_imputers,
+    path_to_top_predictions_on_all_parcels)
+from lib_cinci.prediction_store import PredictionStore
 import os
 import logging
 import logging.config
@@ -22,11 +24,14 @@ logging.config.dictConfig(load('logger_config.yaml'))
 logger = logging.getLogger()
 
 #Directories to check for files
-directories = [path_to_predictions,
-                path_to_pickled_models,
+directories = [path_to_pickled_models,
                 path_to_pickled_scalers,
                 path_to_pickled_imputers]
 
+#Prediction stores to prune
+stores = [path_to_predictions,
+          path_to_top_predictions_on_all_parcels]
+
 #db connection
 client = MongoClient(main['logger']['uri'])
 db = client['models']
@@ -84,3 +89,8 @@ def delete_from_not_in(path, files_to_keep):
 for directory in directories:
     delete_from_not_in(directory, ids_to_keep)
 
+#Remove predictions of deleted models (also CSV files written before
+#the prediction store existed), the shared index is kept
+for store in stores:
+    if os.path.exists(store):
+        PredictionStore(store).prune(ids_to_keep)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Benchmark the in-memory spatial engine (feature_utils.find_neighbours)
+against the PostGIS join the inspections_*_xmonths templates run,
+using a synthetic city with random parcels and events.
+
+Without --db only the in-memory engine is timed. With --db the synthetic
+city is uploaded to a scratch schema, the same matching is done with
+ST_DWithin and both results are compared. The schema is dropped at
+the end.
+
+Example:
+    python benchmark_spatial_index.py -p 20000 -e 200000 --db
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from lib_cinci.db import uri
+from feature_utils import find_neighbours, FOOT_PER_METER
+
+SCHEMA = 'benchmark_spatial_index'
+
+def make_synthetic_city(n_parcels, n_events, size_km=20, seed=0):
+    '''
+        Parcels and events uniformly distributed in a square of
+        size_km x size_km (coordinates in feet). Every parcel is
+        inspected once in 2015, events happen between 2014 and 2015
+    '''
+    rng = np.random.RandomState(seed)
+    size = size_km*1000*FOOT_PER_METER
+    inspections = pd.DataFrame({'parcel_id': ['{:08d}'.format(i) for i in range(n_parcels)],
+                                'x': rng.uniform(0, size, n_parcels),
+                                'y': rng.uniform(0, size, n_parcels)})
+    inspections['inspection_date'] = (pd.Timestamp('2015-01-01') +
+                    pd.to_timedelta(rng.randint(0, 365, n_parcels), unit='D'))
+    events = pd.DataFrame({'id': np.arange(n_events),
+                           'x': rng.uniform(0, size, n_events),
+                           'y': rng.uniform(0, size, n_events)})
+    events['event_date'] = (pd.Timestamp('2014-01-01') +
+                    pd.to_timedelta(rng.randint(0, 730, n_events), unit='D'))
+    return inspections, events
+
+def upload_synthetic_city(engine, inspections, events):
+    con = engine.raw_connection()
+    cur = con.cursor()
+    cur.execute('DROP SCHEMA IF EXISTS {} CASCADE;'.format(SCHEMA))
+    cur.execute('CREATE SCHEMA {};'.format(SCHEMA))
+    con.commit()
+    inspections.to_sql('inspections', engine, schema=SCHEMA, index=False, chunksize=50000)
+    events.to_sql('events', engine, schema=SCHEMA, index=False, chunksize=50000)
+    for table in ['inspections', 'events']:
+        cur.execute(('ALTER TABLE {schema}.{table} ADD COLUMN geom geometry(Point, 3735);'
+                     'UPDATE {schema}.{table} SET geom=ST_SetSRID(ST_MakePoint(x, y), 3735);'
+                     'CREATE INDEX ON {schema}.{table} USING GIST (geom);'
+                     'ANALYZE {schema}.{table};').format(schema=SCHEMA, table=table))
+    con.commit()
+    return con
+
+def find_neighbours_in_db(con, n_months, max_dist):
+    query = ('SELECT insp.parcel_id, insp.inspection_date, '
+             'ST_Distance(insp.geom, event.geom)/{foot} AS dist_m, event.id '
+             'FROM {schema}.inspections AS insp '
+             'JOIN {schema}.events AS event '
+             'ON ST_DWithin(insp.geom, event.geom, {max_dist}*{foot}) '
+             'AND (insp.inspection_date - \'{n_months} month\'::interval) <= event.event_date '
+             'AND event.event_date < insp.inspection_date').format(schema=SCHEMA,
+                                        foot=FOOT_PER_METER, max_dist=max_dist,
+                                        n_months=n_months)
+    return pd.read_sql(query, con)
+
+def as_set(df):
+    return set(zip(df.parcel_id, pd.to_datetime(df.inspection_date), df.id))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--parcels", type=int, default=20000,
+                        help="Number of parcels in the synthetic city")
+    parser.add_argument("-e", "--events", type=int, default=100000,
+                        help="Number of events in the synthetic city")
+    parser.add_argument("-m", "--months", type=int, default=3)
+    parser.add_argument("-md", "--maxdist", type=int, default=1000)
+    parser.add_argument("--db", action="store_true",
+                        help="Also run the PostGIS join and compare results")
+    args = parser.parse_args()
+
+    inspections, events = make_synthetic_city(args.parcels, args.events)
+
+    start = time.time()
+    memory = find_neighbours(inspections, events, args.months, args.maxdist)
+    print 'In-memory engine: {:.1f}s, {} rows'.format(time.time()-start, len(memory))
+
+    if args.db:
+        engine = create_engine(uri)
+        con = upload_synthetic_city(engine, inspections, events)
+        try:
+            start = time.time()
+            db = find_neighbours_in_db(con, args.months, args.maxdist)
+            print 'PostGIS join: {:.1f}s, {} rows'.format(time.time()-start, len(db))
+            print 'Same neighbours: {}'.format(as_set(memory) == as_set(db))
+        finally:
+            cur = con.cursor()
+            cur.execute('DROP SCHEMA IF EXISTS {} CASCADE;'.format(SCHEMA))
+            con.commit()
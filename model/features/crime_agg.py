@@ -3,28 +3,21 @@ import logging
 import numpy as np
 import pandas as pd
 import util
+from lib_cinci.features import columns_for_table_in_schema
 
 logger = logging.getLogger()
 
-first_ever_crime = {"year": 2004, "month": 1}
-last_ever_crime = {"year": 2014, "month": 12}
-months_with_crime = 11*12
 
-
-def number_of_months_since_first_crime(date_year, date_month):
-    years_passed = date_year - first_ever_crime["year"]
-    months_passed = date_month - first_ever_crime["month"]
-    # above line only works because first ever crime in January
-    months_passed = years_passed*12 + months_passed
-
-    months_passed = max(0, months_passed)
-    months_passed = min(months_with_crime - 1, months_passed)
-    return months_passed
+def month_number(years, months):
+    """
+    Number of months since January of year 0, works with arrays
+    """
+    return np.asarray(years, dtype=int)*12 + np.asarray(months, dtype=int) - 1
 
 
-def make_fast_crime_lookup_table(crimes):
+def make_crime_lookup_table(crimes):
     """
-    Create a fast crime-rate lookup function
+    Create a crime count lookup table
     :param crimes: A dataframe with crimes aggregated per month and area, e.g.
                   year_reported  month_reported  count
         agg_area
@@ -33,84 +26,61 @@ def make_fast_crime_lookup_table(crimes):
         001119             2008               9     53
         192920             2004               1     66
         122726             2004               1     27
-    :return: A dict of lists
+    :return: A tuple (areas, first_month, cumulative). areas is an Index with
+             every area, first_month the month_number of the first month
+             with crimes, cumulative an (areas x months + 1) matrix where
+             cumulative[i, j] is the number of crimes in areas[i] before
+             month first_month + j. Crimes in months [start, end) are
+             cumulative[:, end] - cumulative[:, start]
     """
+    months = month_number(crimes["year_reported"].values,
+                          crimes["month_reported"].values)
+    areas = pd.Index(pd.unique(crimes.index.values))
+    first_month = months.min() if len(months) else 0
+    n_months = months.max() - first_month + 1 if len(months) else 0
 
-    # a naive lookup of crimes in the given pandas crime data frame is O(n^2)
-    #   1. find all rows for the given area O(n)
-    #   2. of these, find all rows that fall into the time window O(n)
-
-    # this is too slow, transform the crimes data frame as follows
-    #  A. make a dict of {area: crimes_for_area} -> O(1)
-    #  B. convert crimes_for_area into an array where each
-    #     entry corresponds to a month such as
-    #        [num_crimes_Jan_2004, num_crimes_Feb_2004,
-    #         num_crimes_Mar_2004, ..., num_crimes_Dec_2014]
-    #     now counting the number of crimes in a time window
-    #     is simply to sum up the relevant months -> O(1)
-
-    # this implements B from above
-    index = pd.Index(range(months_with_crime))
-
-    def make_lookup_array(crimes_for_area):
-        crimes_for_area = crimes_for_area.copy()
-        crimes_for_area["num_months_passed"] = \
-            crimes_for_area[["year_reported", "month_reported"]].apply(
-                lambda row: number_of_months_since_first_crime(
-                    row["year_reported"], row["month_reported"]), axis=1)
-        crimes_for_area = crimes_for_area.set_index("num_months_passed")
-        crimes_for_area = crimes_for_area.reindex(index).fillna(0)
-        return crimes_for_area["count"].values
-
-    # this implements A from above
-    crimes = {area: make_lookup_array(grp) for area, grp
-              in crimes.groupby(crimes.index)}
-
-    return crimes
-
-
-def configure_population_lookup(population_tracts):
-    def perform(tract):
-        if not tract in population_tracts.index:
-            return np.nan
-        return population_tracts.loc[tract]
-    return perform
+    counts = np.zeros((len(areas), n_months))
+    np.add.at(counts, (areas.get_indexer(crimes.index), months - first_month),
+              crimes["count"].values)
+    cumulative = np.zeros((len(areas), n_months + 1))
+    np.cumsum(counts, axis=1, out=cumulative[:, 1:])
+    return areas, first_month, cumulative
 
 
 def load_tract_data(db_connection, only_guncrimes=False):
     def load_crimes():
         logger.debug("Read crimes per census tract")
-        if only_guncrimes:
-            crimes = ("SELECT EXTRACT(YEAR FROM date_reported) AS "
-                      "year_reported, "
-                      "       EXTRACT(MONTH FROM date_reported) AS "
-                      "month_reported,  "
-                      "       tract AS agg_area, "
-                      "       count(*) "
-                      "FROM public.crime_geocoded "
-                      "WHERE weapon LIKE '%%GUN%%'"
-                      "GROUP BY year_reported, month_reported, tract")
-        else:
-            crimes = ("SELECT EXTRACT(YEAR FROM date_reported) "
-                      "AS year_reported, "
-                      "       EXTRACT(MONTH FROM date_reported) "
-                      "AS month_reported,  "
-                      "       tract AS agg_area, "
-                      "       count(*) "
-                      "FROM public.crime_geocoded "
-                      "GROUP BY year_reported, month_reported, tract")
-
-        crimes = pd.read_sql(crimes, con=db_connection)
+        # crimes are geocoded to public.address, census tracts have
+        # the same SRID
+        crimes = ("SELECT EXTRACT(YEAR FROM crime.occurred_on) "
+                  "AS year_reported, "
+                  "       EXTRACT(MONTH FROM crime.occurred_on) "
+                  "AS month_reported,  "
+                  "       tracts.tractce10 AS agg_area, "
+                  "       count(*) "
+                  "FROM public.crime AS crime "
+                  "JOIN public.address AS address "
+                  "ON crime.address_id = address.id "
+                  "JOIN shape_files.census_tracts AS tracts "
+                  "ON ST_Contains(tracts.geom, address.geom) "
+                  "{where}"
+                  "GROUP BY year_reported, month_reported, agg_area")
+        where = "WHERE crime.weapon LIKE '%%GUN%%' " if only_guncrimes else ""
+
+        crimes = pd.read_sql(crimes.format(where=where), con=db_connection)
         crimes = crimes.dropna(subset=["agg_area"]).set_index("agg_area")
         return crimes
 
     def load_parcels():
         logger.debug("Read parcels")
+        # some parcels are mapped to two tracts, keep one, inspections
+        # without tract get NaN
         parcels = ("SELECT parcel_id, "
                    "       inspection_date, "
-                   "       tract AS agg_area "
+                   "       shape.tract AS agg_area "
                    "FROM parcels_inspections AS parcels "
-                   "JOIN shape_files.parcelid_blocks_grp_tracts_nhoods "
+                   "LEFT JOIN (SELECT DISTINCT ON (parcelid) parcelid, tract "
+                   "           FROM shape_files.parcelid_blocks_grp_tracts_nhoods) "
                    "AS shape "
                    "ON parcels.parcel_id = shape.parcelid")
 
@@ -122,14 +92,18 @@ def load_tract_data(db_connection, only_guncrimes=False):
 
 def load_blockgroup_data(db_connection):
     def load_crimes():
-        crimes = ("SELECT EXTRACT(YEAR FROM date_reported) "
+        crimes = ("SELECT EXTRACT(YEAR FROM crime.occurred_on) "
                   "AS year_reported, "
-                  "       EXTRACT(MONTH FROM date_reported) "
+                  "       EXTRACT(MONTH FROM crime.occurred_on) "
                   "AS month_reported,  "
-                  "       CONCAT(tract, blkgrp) AS agg_area, "
+                  "       CONCAT(groups.tractce10, groups.blkgrpce10) AS agg_area, "
                   "       count(*) "
-                  "FROM public.crime_geocoded "
-                  "GROUP BY year_reported, month_reported, tract, blkgrp")
+                  "FROM public.crime AS crime "
+                  "JOIN public.address AS address "
+                  "ON crime.address_id = address.id "
+                  "JOIN shape_files.census_blocks_groups AS groups "
+                  "ON ST_Contains(groups.geom, address.geom) "
+                  "GROUP BY year_reported, month_reported, agg_area")
 
         crimes = pd.read_sql(crimes, con=db_connection)
         crimes = crimes.dropna(subset=["agg_area"]).set_index("agg_area")
@@ -138,9 +112,11 @@ def load_blockgroup_data(db_connection):
     def load_parcels():
         parcels = ("SELECT parcel_id, "
                    "       inspection_date, "
-                   "       CONCAT(tract, blkgrp) AS agg_area "
+                   "       CONCAT(shape.tract, shape.block_group) AS agg_area "
                    "FROM parcels_inspections AS parcels "
-                   "JOIN shape_files.parcelid_blocks_grp_tracts_nhoods "
+                   "LEFT JOIN (SELECT DISTINCT ON (parcelid) parcelid, tract, "
+                   "                  block_group "
+                   "           FROM shape_files.parcelid_blocks_grp_tracts_nhoods) "
                    "AS shape "
                    "ON parcels.parcel_id = shape.parcelid")
 
@@ -151,35 +127,39 @@ def load_blockgroup_data(db_connection):
 
 
 def crimerate_in_aggregation_area(parcels, crimes, population, window_size):
-
-    crimes = make_fast_crime_lookup_table(crimes)
-
-    def count_crimes_for_inspection(row):
-
-        if not row["agg_area"] in crimes:
-            return 0.0
-
-        start_time = row["inspection_date"] - window_size
-        start_index = number_of_months_since_first_crime(start_time.year,
-                                                         start_time.month)
-
-        end_time = row["inspection_date"]
-        end_index = number_of_months_since_first_crime(end_time.year,
-                                                       end_time.month)
-
-        relevant_crimes = crimes[row["agg_area"]]
-        num_crimes = sum(relevant_crimes[start_index:end_index])
-        return num_crimes
-
-    parcels["crimes"] = parcels.apply(count_crimes_for_inspection, axis=1)
-
-    tract_lookup = configure_population_lookup(population)
-    parcels["population"] = parcels["agg_area"].apply(tract_lookup)
-    parcels["crime_rate"] = parcels["crimes"] / parcels["population"]
-
-    parcels = parcels.set_index(["parcel_id", "inspection_date"])
-
-    return parcels["crime_rate"]
+    """
+    Crimes per person in the area of every inspection, counting crimes
+    from the month of inspection_date - window_size up to the month
+    before the inspection (all inspections are computed at once).
+    Inspections in areas without population get NaN.
+    """
+    areas, first_month, cumulative = make_crime_lookup_table(crimes)
+    n_months = cumulative.shape[1] - 1
+
+    end_time = pd.to_datetime(parcels["inspection_date"])
+    start_time = end_time - window_size
+    end_index = month_number(end_time.dt.year, end_time.dt.month) - first_month
+    start_index = month_number(start_time.dt.year,
+                               start_time.dt.month) - first_month
+    end_index = np.clip(end_index, 0, n_months)
+    start_index = np.clip(start_index, 0, n_months)
+
+    # inspections in areas without crimes get 0
+    rows = areas.get_indexer(parcels["agg_area"])
+    has_crimes = rows >= 0
+    num_crimes = np.zeros(len(parcels))
+    num_crimes[has_crimes] = (cumulative[rows[has_crimes], end_index[has_crimes]] -
+                              cumulative[rows[has_crimes], start_index[has_crimes]])
+
+    if isinstance(population, pd.DataFrame):
+        population = population["population"]
+    population = population.reindex(parcels["agg_area"].values).values
+
+    index = pd.MultiIndex.from_arrays([parcels["parcel_id"].values,
+                                       parcels["inspection_date"].values],
+                                      names=["parcel_id", "inspection_date"])
+    return pd.Series(num_crimes / population.astype(float), index=index,
+                     name="crime_rate")
 
 
 def make_crime_features(db_connection):
@@ -198,36 +178,28 @@ def make_crime_features(db_connection):
 
     crimes, parcels, population = load_tract_data(db_connection)
 
-    logger.debug("Calculate crime rate last year")
-    window = timedelta(days=365)
-    rate = crimerate_in_aggregation_area(parcels, crimes, population, window)
-    rate.name = "crime_rate_1yr"
-    crime_features.append(rate)
-    logger.debug("... finished")
-
-    logger.debug("Calculate crime rate last 3 years")
-    window = timedelta(days=365*3)
-    rate = crimerate_in_aggregation_area(parcels, crimes, population, window)
-    rate.name = "crime_rate_3yr"
-    crime_features.append(rate)
-    logger.debug("... finished")
-
-    crimes, parcels, population = load_tract_data(db_connection,
-                                                  only_guncrimes=True)
-
-    logger.debug("Calculate gun crime rate last year")
-    window = timedelta(days=365)
-    rate = crimerate_in_aggregation_area(parcels, crimes, population, window)
-    rate.name = "crime_rate_1yr_guns"
-    crime_features.append(rate)
-    logger.debug("... finished")
-
-    logger.debug("Calculate gun crime rate last 3 years")
-    window = timedelta(days=365*3)
-    rate = crimerate_in_aggregation_area(parcels, crimes, population, window)
-    rate.name = "crime_rate_3yr_guns"
-    crime_features.append(rate)
-    logger.debug("... finished")
+    for years in (1, 3):
+        logger.debug("Calculate crime rate last {} years".format(years))
+        window = timedelta(days=365*years)
+        rate = crimerate_in_aggregation_area(parcels, crimes, population, window)
+        rate.name = "crime_rate_{}yr".format(years)
+        crime_features.append(rate)
+
+    # older crime tables had the weapon, skip gun crimes if it's not there
+    columns = [c for c, _ in columns_for_table_in_schema('crime', 'public')]
+    if 'weapon' in columns:
+        crimes, parcels, population = load_tract_data(db_connection,
+                                                      only_guncrimes=True)
+        for years in (1, 3):
+            logger.debug("Calculate gun crime rate last {} years".format(years))
+            window = timedelta(days=365*years)
+            rate = crimerate_in_aggregation_area(parcels, crimes, population,
+                                                 window)
+            rate.name = "crime_rate_{}yr_guns".format(years)
+            crime_features.append(rate)
+    else:
+        logger.info("public.crime has no weapon column, "
+                    "skipping gun crime rates")
 
     crime_features = pd.concat(crime_features, axis=1)
     return crime_features
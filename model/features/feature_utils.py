@@ -1,7 +1,11 @@
 import pandas as pd
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy import sparse
 from string import Template
 import os
 from sqlalchemy import create_engine
+from sqlalchemy import types
 from lib_cinci.db import uri
 from lib_cinci.config import load
 import logging
@@ -11,12 +15,32 @@ import logging
 import logging.config
 from lib_cinci.config import load
 from lib_cinci.features import tables_in_schema, columns_for_table_in_schema
+from lib_cinci.features import check_date_boundaries
+from lib_cinci.bulk_writer import copy_to_sql
+from lib_cinci.util import get_dummies
+from lib_cinci.parcel_graph import FOOT_PER_METER
 from psycopg2 import ProgrammingError, InternalError
 
 #Config logger
 logging.config.dictConfig(load('logger_config.yaml'))
 logger = logging.getLogger()
 
+#Engines available to build the insp2{dataset} tables. 'sql' runs the
+#PostGIS templates, 'kdtree' loads coordinates once and matches
+#inspections with events in memory (see find_neighbours)
+SPATIAL_ENGINES = ['sql', 'kdtree']
+spatial_engine = 'sql'
+
+#(min months, max months, max distance) when several windows and
+#distances are generated in the same run, see set_neighbour_windows
+neighbour_windows = None
+
+def set_spatial_engine(engine):
+    global spatial_engine
+    if engine not in SPATIAL_ENGINES:
+        raise ValueError('Unknown spatial engine {}, valid values are {}'.format(engine, SPATIAL_ENGINES))
+    spatial_engine = engine
+
 #This file provides generic functions
 #to generate spatiotemporal features
 def format_column_names(columns, prefix=None):
@@ -30,10 +54,15 @@ def format_column_names(columns, prefix=None):
 def make_nmonths_table_from_template(con, dataset, date_column,
                                     min_insp_date, max_insp_date,
                                     n_months, max_dist,
-                                    template, load=False,  columns='all'):
+                                    template, load=False,  columns='all',
+                                    location='address'):
     '''
         Load inspections table matched with events that happened X months
         before. Returns pandas dataframe with the data loaded
+
+        If the spatial engine is set to 'kdtree' the table is built
+        in memory (see make_nmonths_table_from_index) and the template
+        is not used, location tells where to find the event coordinates
     '''
     #Create a cursor
     cur = con.cursor()
@@ -49,44 +78,16 @@ def make_nmonths_table_from_template(con, dataset, date_column,
                                          max_dist=max_dist)
     #Check if table already exists in current schema
     #If not, create it
-    if table_name not in tables_in_schema(current_schema):
-        logger.info('Table {} does not exist... Creating it'.format(table_name))
-        path_to_template = os.path.join(os.environ['ROOT_FOLDER'],
-                        'model',
-                        'features',
-                        template)
-        #Load template with SQL statement
-        with open(path_to_template, 'r') as f:
-            sql_script = Template(f.read())
-        #Replace values in template
-        sql_script = sql_script.substitute(TABLE_NAME=table_name,
-                                           DATASET=dataset,
-                                           DATE_COLUMN=date_column,
-                                           N_MONTHS=n_months,
-                                           MAX_DIST=max_dist,
-                                           MIN_INSP_DATE=min_insp_date,
-                                           MAX_INSP_DATE=max_insp_date)
-        #Run the code using the connection
-        #this is going to take a while
-        cur.execute(sql_script)
-        #Commit changes to db
-        con.commit()
-
-        #If table created has a geom column which type USER DEFINED,
-        #delete it, we don't need it here
-        cols = columns_for_table_in_schema(table_name, current_schema)
-        if ('geom', 'USER-DEFINED') in cols:
-            #Important: this is not prouction ready since it's
-            #vulnerable to SQL injection, I haven't found any solution
-            #to dynamically pass table names as parameters in psycopg2
-            #it seems like the only solution is to prevent SQL injection
-            #in the code
-            q = ('ALTER TABLE {} DROP COLUMN geom').format(table_name)
-            cur.execute(q)
-            con.commit()
-            logger.info('Table {} has a PostGIS column, deleting...'.format(table_name))
-    else:
+    if table_name in tables_in_schema(current_schema):
         logger.info('Table {} already exists. Skipping...'.format(table_name))
+    elif use_base_table(n_months, max_dist):
+        make_nmonths_table_from_base(con, table_name, dataset, date_column,
+                                     min_insp_date, max_insp_date,
+                                     n_months, max_dist, template, location)
+    else:
+        build_nmonths_table(con, table_name, dataset, date_column,
+                            min_insp_date, max_insp_date,
+                            n_months, max_dist, template, location)
 
     cur.close()
     #Load data
@@ -110,6 +111,151 @@ def make_nmonths_table_from_template(con, dataset, date_column,
         return df
 
 
+def build_nmonths_table(con, table_name, dataset, date_column,
+                        min_insp_date, max_insp_date,
+                        n_months, max_dist, template, location='address',
+                        event_date=False):
+    '''
+        Create table_name matching inspections with events, using
+        the SQL template or the in-memory index depending on
+        the spatial engine. If event_date is True, the table
+        also gets an event_date column
+    '''
+    if spatial_engine == 'kdtree':
+        logger.info('Table {} does not exist... Creating it in memory'.format(table_name))
+        event_columns = ['id', 'event_date'] if event_date else ['id']
+        make_nmonths_table_from_index(con, table_name, dataset, date_column,
+                                      min_insp_date, max_insp_date,
+                                      n_months, max_dist, location,
+                                      event_columns)
+        return
+
+    logger.info('Table {} does not exist... Creating it'.format(table_name))
+    cur = con.cursor()
+    cur.execute('SELECT current_schema;')
+    current_schema = cur.fetchone()[0]
+
+    path_to_template = os.path.join(os.environ['ROOT_FOLDER'],
+                    'model',
+                    'features',
+                    template)
+    #Load template with SQL statement
+    with open(path_to_template, 'r') as f:
+        sql_script = Template(f.read())
+    extra_columns = (', event.{} AS event_date'.format(date_column)
+                     if event_date else '')
+    #Replace values in template
+    sql_script = sql_script.substitute(TABLE_NAME=table_name,
+                                       DATASET=dataset,
+                                       DATE_COLUMN=date_column,
+                                       N_MONTHS=n_months,
+                                       MAX_DIST=max_dist,
+                                       MIN_INSP_DATE=min_insp_date,
+                                       MAX_INSP_DATE=max_insp_date,
+                                       EXTRA_COLUMNS=extra_columns)
+    #Run the code using the connection
+    #this is going to take a while
+    cur.execute(sql_script)
+    #Commit changes to db
+    con.commit()
+
+    #If table created has a geom column which type USER DEFINED,
+    #delete it, we don't need it here
+    cols = columns_for_table_in_schema(table_name, current_schema)
+    if ('geom', 'USER-DEFINED') in cols:
+        #Important: this is not prouction ready since it's
+        #vulnerable to SQL injection, I haven't found any solution
+        #to dynamically pass table names as parameters in psycopg2
+        #it seems like the only solution is to prevent SQL injection
+        #in the code
+        q = ('ALTER TABLE {} DROP COLUMN geom').format(table_name)
+        cur.execute(q)
+        con.commit()
+        logger.info('Table {} has a PostGIS column, deleting...'.format(table_name))
+    cur.close()
+
+def set_neighbour_windows(months, distances):
+    '''
+        Tell feature generators that features for every combination
+        of months and distances are going to be generated. In that
+        case, events are matched with inspections only once, using the
+        longest window and largest distance, and the insp2{dataset} table
+        for each combination is derived from that (see make_nmonths_table_from_base)
+    '''
+    global neighbour_windows
+    if len(months)*len(distances) > 1:
+        neighbour_windows = (min(months), max(months), max(distances))
+    else:
+        neighbour_windows = None
+
+def use_base_table(n_months, max_dist):
+    if neighbour_windows is None:
+        return False
+    min_months, max_months, base_dist = neighbour_windows
+    return min_months <= n_months <= max_months and max_dist <= base_dist
+
+def base_table_name(dataset):
+    '''
+        Name for the table that has the neighbours for every window
+        and distance set in set_neighbour_windows
+        e.g. insp2crime_3to12months_1000m
+    '''
+    min_months, max_months, base_dist = neighbour_windows
+    return ('insp2{dataset}_{min_months}to{max_months}months'
+            '_{max_dist}m').format(dataset=dataset, min_months=min_months,
+                                   max_months=max_months, max_dist=base_dist)
+
+def make_nmonths_table_from_base(con, table_name, dataset, date_column,
+                                 min_insp_date, max_insp_date,
+                                 n_months, max_dist, template, location='address'):
+    '''
+        Create table_name by filtering the base table (see
+        set_neighbour_windows), the base table is created if needed
+    '''
+    cur = con.cursor()
+    cur.execute('SELECT current_schema;')
+    current_schema = cur.fetchone()[0]
+    cur.close()
+
+    min_months, max_months, base_dist = neighbour_windows
+    base_table = base_table_name(dataset)
+    if base_table not in tables_in_schema(current_schema):
+        #Shorter windows can generate features for earlier inspections,
+        #the base table must have those too
+        base_min, base_max = check_date_boundaries(con, min_months, dataset, date_column)
+        build_nmonths_table(con, base_table, dataset, date_column,
+                            base_min, base_max, max_months, base_dist,
+                            template, location, event_date=True)
+    derive_nmonths_table(con, base_table, table_name, n_months, max_dist,
+                         min_insp_date, max_insp_date)
+
+def derive_nmonths_table(con, base_table, table_name, n_months, max_dist,
+                         min_insp_date, max_insp_date,
+                         columns=['id'], indexes=['id']):
+    '''
+        Create table_name with the rows in base_table within max_dist
+        and n_months before the inspection date. base_table
+        must have an event_date column.
+    '''
+    logger.info('Creating {} from {}'.format(table_name, base_table))
+    query = ('CREATE TABLE {table_name} AS ('
+             'SELECT parcel_id, inspection_date, dist_m, {columns} '
+             'FROM {base_table} '
+             'WHERE dist_m <= {max_dist} '
+             "AND inspection_date BETWEEN '{min_date}' AND '{max_date}' "
+             "AND (inspection_date - '{n_months} month'::interval) <= event_date);"
+             'CREATE INDEX ON {table_name} (parcel_id, inspection_date);')
+    for column in indexes:
+        query += 'CREATE INDEX ON {table_name} (%s);' % column
+    query = query.format(table_name=table_name, base_table=base_table,
+                         columns=', '.join(columns), max_dist=max_dist,
+                         min_date=min_insp_date, max_date=max_insp_date,
+                         n_months=n_months)
+    cur = con.cursor()
+    cur.execute(query)
+    con.commit()
+    cur.close()
+
 def make_inspections_address_nmonths_table(con, dataset, date_column,
                                            min_insp_date, max_insp_date,
                                            n_months, max_dist, load=False,
@@ -118,7 +264,7 @@ def make_inspections_address_nmonths_table(con, dataset, date_column,
                             min_insp_date, max_insp_date,
                             n_months, max_dist,
                             'inspections_address_xmonths.template.sql',
-                            load, columns)
+                            load, columns, location='address')
 
 def make_inspections_latlong_nmonths_table(con, dataset, date_column,
                                            min_insp_date, max_insp_date,
@@ -128,13 +274,184 @@ def make_inspections_latlong_nmonths_table(con, dataset, date_column,
                             min_insp_date, max_insp_date,
                             n_months, max_dist,
                             'inspections_latlong_xmonths.template.sql',
-                            load, columns)
+                            load, columns, location='latlong')
+
+def load_inspections_coordinates(con, min_insp_date, max_insp_date):
+    '''
+        Load inspections in parcels_inspections (current schema) along
+        with the coordinates for the centroid of their parcel
+    '''
+    query = ('SELECT insp.parcel_id, insp.inspection_date, '
+             'ST_X(ST_Centroid(parcels.geom)) AS x, '
+             'ST_Y(ST_Centroid(parcels.geom)) AS y '
+             'FROM parcels_inspections AS insp '
+             'JOIN shape_files.parcels_cincy AS parcels '
+             'ON insp.parcel_id = parcels.parcelid '
+             'WHERE insp.inspection_date BETWEEN %(min_date)s AND %(max_date)s '
+             'AND parcels.geom IS NOT NULL')
+    return pd.read_sql(query, con, params={'min_date': str(min_insp_date),
+                                           'max_date': str(max_insp_date)})
+
+def load_events_coordinates(con, dataset, date_column, min_date, max_date,
+                            location='address'):
+    '''
+        Load id, date and coordinates for events in dataset that happened
+        between min_date (inclusive) and max_date (exclusive).
+        If location is 'address', coordinates are taken from public.address,
+        if it's 'latlong' from the geom column in the dataset
+    '''
+    if location == 'address':
+        query = ('SELECT event.id, event.{date_column} AS event_date, '
+                 'ST_X(address.geom) AS x, ST_Y(address.geom) AS y '
+                 'FROM public.{dataset} AS event '
+                 'JOIN public.address '
+                 'ON event.address_id = address.id '
+                 'WHERE address.geom IS NOT NULL ')
+    elif location == 'latlong':
+        query = ('SELECT event.id, event.{date_column} AS event_date, '
+                 'ST_X(event.geom) AS x, ST_Y(event.geom) AS y '
+                 'FROM public.{dataset} AS event '
+                 'WHERE event.geom IS NOT NULL ')
+    else:
+        raise ValueError('location must be address or latlong')
+    query += ('AND event.{date_column} >= %(min_date)s '
+              'AND event.{date_column} < %(max_date)s')
+    query = query.format(dataset=dataset, date_column=date_column)
+    df = pd.read_sql(query, con, params={'min_date': str(min_date),
+                                         'max_date': str(max_date)})
+    df['event_date'] = pd.to_datetime(df.event_date)
+    return df
+
+def months_before(dates, n_months):
+    '''
+        Subtract n_months from every date, same as doing
+        date - 'n month'::interval in Postgres (days past the end of
+        the month are clipped). The offset is computed once per
+        distinct date since inspections share dates a lot
+    '''
+    dates = pd.to_datetime(pd.Series(dates))
+    unique = pd.Series(dates.unique())
+    shifted = pd.Series(unique.map(lambda d: d - pd.DateOffset(months=n_months)).values,
+                        index=unique.values)
+    return dates.map(shifted).values
+
+def month_number(dates):
+    '''
+        Number of months since year 0 for every date, used to bucket
+        dates by calendar month
+    '''
+    dates = pd.DatetimeIndex(dates)
+    return np.asarray(dates.year*12 + dates.month - 1)
+
+def find_neighbours(inspections, events, n_months, max_dist,
+                    event_columns=['id'], chunksize=20000):
+    '''
+        Match every inspection with the events that happened within
+        max_dist meters and during the n_months before the inspection.
+
+        Input:
+        inspections: DataFrame with parcel_id, inspection_date, x and y
+        events: DataFrame with event_date, x, y and event_columns
+        x and y are expected to be in feet (SRID 3735)
+
+        Output:
+        DataFrame with parcel_id, inspection_date, dist_m and
+        event_columns. One row per (inspection, event) pair, same as
+        the tables built by the inspections_*_xmonths templates.
+    '''
+    columns = ['parcel_id', 'inspection_date', 'dist_m'] + event_columns
+    if not len(inspections) or not len(events):
+        return pd.DataFrame([], columns=columns)
+
+    insp_xy = inspections[['x', 'y']].values.astype(float)
+    insp_date = pd.to_datetime(inspections.inspection_date).values
+    window_start = months_before(insp_date, n_months)
+    insp_month = month_number(insp_date)
+
+    events_xy = events[['x', 'y']].values.astype(float)
+    events_date = pd.to_datetime(events.event_date).values
+    events_month = month_number(events_date)
+
+    #Events are split by calendar month and indexed separately, this way
+    #every inspection only queries the n_months+1 indexes that overlap
+    #with its time window instead of every event in the dataset
+    order = np.argsort(events_month, kind='mergesort')
+    months, first = np.unique(events_month[order], return_index=True)
+    members = dict(zip(months, np.split(order, first[1:])))
+    trees = {}
+
+    radius = max_dist*FOOT_PER_METER
+    insp_idx, event_idx, dist_m = [], [], []
+    for month in np.unique(insp_month):
+        positions = np.where(insp_month == month)[0]
+        for event_month in xrange(month-n_months, month+1):
+            if event_month not in members:
+                continue
+            if event_month not in trees:
+                trees[event_month] = cKDTree(events_xy[members[event_month]])
+            for start in xrange(0, len(positions), chunksize):
+                chunk = positions[start:start+chunksize]
+                matches = trees[event_month].query_ball_point(insp_xy[chunk], radius)
+                counts = np.array([len(m) for m in matches])
+                if counts.sum() == 0:
+                    continue
+                i = np.repeat(chunk, counts)
+                e = members[event_month][np.concatenate([m for m in matches if len(m)]).astype(int)]
+                d = np.sqrt(((insp_xy[i] - events_xy[e])**2).sum(axis=1))/FOOT_PER_METER
+                keep = ((d <= max_dist) &
+                        (window_start[i] <= events_date[e]) &
+                        (events_date[e] < insp_date[i]))
+                insp_idx.append(i[keep])
+                event_idx.append(e[keep])
+                dist_m.append(d[keep])
+
+    if not insp_idx:
+        return pd.DataFrame([], columns=columns)
+    insp_idx = np.concatenate(insp_idx)
+    event_idx = np.concatenate(event_idx)
+    df = pd.DataFrame({'parcel_id': inspections.parcel_id.values[insp_idx],
+                       'inspection_date': insp_date[insp_idx],
+                       'dist_m': np.concatenate(dist_m)})
+    for col in event_columns:
+        df[col] = events[col].values[event_idx]
+    return df[columns]
+
+def make_nmonths_table_from_index(con, table_name, dataset, date_column,
+                                  min_insp_date, max_insp_date,
+                                  n_months, max_dist, location='address',
+                                  event_columns=['id']):
+    '''
+        Build insp2{dataset}_{n_months}months_{max_dist}m table using
+        an in-memory KD-tree instead of the PostGIS templates.
+        Distances are measured from the parcel centroid.
+    '''
+    inspections = load_inspections_coordinates(con, min_insp_date, max_insp_date)
+    min_event_date = pd.Timestamp(min_insp_date) - pd.DateOffset(months=n_months)
+    events = load_events_coordinates(con, dataset, date_column,
+                                     min_event_date, max_insp_date, location)
+    logger.info(('Matching {} inspections with {} events '
+                 'in memory').format(len(inspections), len(events)))
+    df = find_neighbours(inspections, events, n_months, max_dist, event_columns)
+    logger.info('{} has {} rows'.format(table_name, len(df)))
+
+    cur = con.cursor()
+    cur.execute('SELECT current_schema;')
+    current_schema = cur.fetchone()[0]
+    e = create_engine(uri)
+    #Same indexes as the ones created in the templates
+    copy_to_sql(df, table_name, e, if_exists='fail',
+                index=False, schema=current_schema,
+                dtype={'inspection_date': types.TIMESTAMP(timezone=False)},
+                indexes=[['parcel_id', 'inspection_date'], ['id']])
+    cur.close()
+
+def insp2_table_name(dataset, n_months, max_dist):
+    return ('insp2{dataset}_{n_months}months'
+            '_{max_dist}m').format(dataset=dataset, n_months=n_months,
+                                   max_dist=max_dist)
 
 def group_and_count_from_db(con, dataset, n_months, max_dist):
-    table_name = ('insp2{dataset}_{n_months}months'
-                  '_{max_dist}m').format(dataset=dataset,
-                                         n_months=n_months,
-                                         max_dist=max_dist)
+    table_name = insp2_table_name(dataset, n_months, max_dist)
     q = ('SELECT parcel_id, inspection_date, COUNT(*) AS total '
          'FROM {} '
          'GROUP BY parcel_id, inspection_date;').format(table_name)
@@ -159,15 +476,38 @@ def compute_frequency_features(df, columns,
     cross['total'] = cross.sum(axis=1)
     return cross
 
-def load_colpivot(con):
-    # add the colpivot function to our Postgres schema
-    with open(os.path.join(os.environ['ROOT_FOLDER'], 
-                'model','features', 'colpivot.sql'), 'r') as fin:
-        query = fin.read()
+def lock_shared_object(cur, name):
+    '''
+        Take a transaction level advisory lock on name. Used before
+        creating objects that several featurebot workers may create at
+        the same time (e.g. public.frequent* tables), the lock is
+        released on commit or rollback
+    '''
+    cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s));', (name,))
 
-    cur = con.cursor()
-    cur.execute(query)
-    con.commit()
+def sql_literal(value):
+    if isinstance(value, (int, long, float, np.number)):
+        return str(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+def sql_identifier(name):
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+def case_when_columns(column, levels, template='sum({case})', name='{level}'):
+    '''
+        Select expressions to pivot column, one per level (in the same
+        order), so a pivot table can be computed in a single GROUP BY with
+        a fixed set of columns. In template, {case} is replaced with
+        CASE WHEN column = level THEN 1 ELSE 0 END, columns are named
+        name.format(level=level)
+    '''
+    expressions = []
+    for level in levels:
+        case = 'CASE WHEN {} = {} THEN 1 ELSE 0 END'.format(column,
+                                                          sql_literal(level))
+        expressions.append('{} AS {}'.format(template.format(case=case),
+                           sql_identifier(name.format(level=level))))
+    return expressions
 
 def make_table_of_frequent_codes(con, col, intable, outtable, dropifexists=True,
         coalesceto="'missing'", rnum=15, to_other="'other'"):
@@ -181,10 +521,13 @@ def make_table_of_frequent_codes(con, col, intable, outtable, dropifexists=True,
 
     cur = con.cursor()
 
+    #Drop and create in the same transaction, holding a lock so
+    #other workers never see the table missing or half created
+    lock_shared_object(cur, outtable)
+
     if dropifexists:
         query = "DROP TABLE IF EXISTS {outtable};".format(outtable=outtable)
         cur.execute(query)
-        con.commit()
 
     # create a table of the most common types,
     # so we can limit the pivot later to them
@@ -216,3 +559,155 @@ def make_table_of_frequent_codes(con, col, intable, outtable, dropifexists=True,
         logger.warning(" - CONTINUING, NOT RE-RUNNING {outtable} table QUERY.".format(
             outtable=outtable))
         con.rollback()
+
+#Functions to aggregate the events matched with every inspection
+#(the insp2{dataset} tables) in memory. The (inspection, event) pairs
+#are a sparse (inspections x events) matrix, counts by category are the
+#product of that matrix and an (events x levels) one hot matrix, sums
+#and averages the product with the event values
+AGGREGATES = ['sum', 'avg', 'max', 'min', 'stddev']
+
+def clean_column_name(name):
+    #Lower case, underscores instead of spaces and only alphanumeric characters
+    name = name.replace(' ', '_').lower()
+    return ''.join(c for c in name if c.isalnum() or c == '_')
+
+def frequent_levels(con, table):
+    '''
+        Sorted levels in a table created by make_table_of_frequent_codes
+    '''
+    df = pd.read_sql('SELECT DISTINCT level FROM {};'.format(table), con)
+    return sorted(df.level.dropna())
+
+def neighbour_event_matrix(pairs, event_ids):
+    '''
+        Sparse matrix with the events matched with every inspection
+
+        Input:
+        pairs: DataFrame with parcel_id, inspection_date and id, one row
+               per (inspection, event) pair
+        event_ids: ids for the columns in the matrix
+
+        Output:
+        A tuple with a (parcel_id, inspection_date) MultiIndex with every
+        inspection in pairs (sorted), the number of pairs for every
+        inspection and a CSR (inspections x events) matrix. Pairs whose
+        id is not in event_ids are counted but they are not in the matrix
+    '''
+    inspections = (pairs[['parcel_id', 'inspection_date']].drop_duplicates()
+                   .sort_values(['parcel_id', 'inspection_date']))
+    index = pd.MultiIndex.from_arrays([inspections.parcel_id.values,
+                                       inspections.inspection_date.values],
+                                      names=['parcel_id', 'inspection_date'])
+    keys = pd.MultiIndex.from_arrays([pairs.parcel_id.values,
+                                      pairs.inspection_date.values])
+    rows = index.get_indexer(keys)
+    total = np.bincount(rows, minlength=len(index))
+
+    cols = pd.Index(event_ids).get_indexer(pairs.id.values)
+    found = cols >= 0
+    matrix = sparse.csr_matrix((np.ones(found.sum()), (rows[found], cols[found])),
+                               shape=(len(index), len(event_ids)))
+    return index, total, matrix
+
+def aggregate_values(matrix, values, function):
+    '''
+        Aggregate values (one per event) over the events in every row of
+        matrix, nulls are ignored, rows without non-null values get NaN
+        (same as the SQL aggregates). stddev is the sample standard
+        deviation
+    '''
+    values = np.asarray(values, dtype=float)
+    present = ~np.isnan(values)
+    n = matrix.dot(present.astype(float))
+    total = matrix.dot(np.where(present, values, 0))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if function == 'sum':
+            result = total
+        elif function == 'avg':
+            result = total/n
+        elif function == 'stddev':
+            squares = matrix.dot(np.where(present, values, 0)**2)
+            variance = (squares - total**2/n)/(n - 1)
+            result = np.sqrt(np.clip(variance, 0, None))
+            result[n < 2] = np.nan
+        elif function in ('max', 'min'):
+            #Reduce the values in every row of the CSR matrix
+            row = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+            grouped = pd.Series(values[matrix.indices]).groupby(row)
+            reduced = grouped.max() if function == 'max' else grouped.min()
+            result = reduced.reindex(np.arange(matrix.shape[0])).values
+        else:
+            raise ValueError('function must be one of {}'.format(AGGREGATES))
+    result = np.asarray(result, dtype=float)
+    result[n == 0] = np.nan
+    return result
+
+def aggregate_events(pairs, events, categories=None, aggregates=None):
+    '''
+        Make features for every inspection from the events matched with it
+
+        Input:
+        pairs: DataFrame with parcel_id, inspection_date and id, one row
+               per (inspection, event) pair (an insp2{dataset} table)
+        events: DataFrame indexed by event id
+        categories: dict mapping columns in events to the list of their
+                    levels, every level gets a column {column}_{level}
+                    with the number of events, values that are not in
+                    levels are not counted
+        aggregates: list of (name, column, function) tuples, function is
+                    one of AGGREGATES
+
+        Output:
+        A pandas dataframe, with one row per inspection in pairs, a
+        total column with the number of events and one column per
+        aggregate and level. If pairs is empty, the dataframe has the
+        same columns and no rows.
+    '''
+    if not len(pairs):
+        #No inspection has events (np.bincount cannot count an empty
+        #index), return the columns without rows
+        index = pd.MultiIndex(levels=[[], []], labels=[[], []],
+                              names=['parcel_id', 'inspection_date'])
+        names = (['total'] + [name for name, _, _ in aggregates or []] +
+                 ['{}_{}'.format(column, level) for column, levels
+                  in sorted((categories or {}).items()) for level in levels])
+        return pd.DataFrame(index=index,
+                            columns=[clean_column_name(c) for c in names])
+
+    index, total, matrix = neighbour_event_matrix(pairs, events.index)
+    features = [pd.Series(total, index=index, name='total')]
+
+    for name, column, function in aggregates or []:
+        values = aggregate_values(matrix, events[column].values, function)
+        features.append(pd.Series(values, index=index, name=name))
+
+    for column, levels in sorted((categories or {}).items()):
+        values = events[column].where(events[column].isin(levels))
+        dummies = get_dummies(values, levels, sparse=True)
+        counts = matrix.dot(dummies).toarray().astype(int)
+        names = ['{}_{}'.format(column, level) for level in levels]
+        features.append(pd.DataFrame(counts, index=index, columns=names))
+
+    df = pd.concat(features, axis=1)
+    df.columns = [clean_column_name(c) for c in df.columns]
+    return df
+
+def make_event_features(con, dataset, n_months, max_dist, events_query,
+                        categories=None, aggregates=None):
+    '''
+        Load the insp2{dataset}_{n_months}months_{max_dist}m table and the
+        events in it and aggregate them (see aggregate_events).
+        events_query must select an id column and the columns used in
+        categories and aggregates, {insp2} in it is replaced with the name
+        of the insp2 table, so events can be filtered
+    '''
+    table_name = insp2_table_name(dataset, n_months, max_dist)
+    pairs = pd.read_sql('SELECT parcel_id, inspection_date, id '
+                        'FROM {};'.format(table_name), con)
+    events = pd.read_sql(events_query.format(insp2=table_name), con,
+                         index_col='id')
+    logger.info('Aggregating {} pairs of inspections and {} events'.format(
+                len(pairs), dataset))
+    return aggregate_events(pairs, events, categories, aggregates)
@@ -3,6 +3,7 @@ import datetime
 import logging
 import logging.config
 from collections import namedtuple
+from multiprocessing import Pool
 import argparse
 
 import pandas as pd
@@ -16,10 +17,13 @@ from lib_cinci.config import load
 
 from lib_cinci.exceptions import MaxDateError, NoFeaturesSelected
 from lib_cinci.features import existing_feature_schemas, tables_in_schema
+from lib_cinci.bulk_writer import copy_to_sql
 
 #Features
 import ner, parcel, outcome, tax, crime_agg, census, three11
 import fire, permits, crime, sales, violation_density, weather, quarter
+import feature_utils
+import incremental
 
 logging.config.dictConfig(load('logger_config.yaml'))
 logger = logging.getLogger()
@@ -33,8 +37,7 @@ FeatureToGenerate = namedtuple("FeatureToGenerate",
 
 # list all existing feature-sets
 existing_features = [FeatureToGenerate("tax", tax.make_tax_features),
-                         # Deprecated - data schema changed in the spring 2016 update
-                         # FeatureToGenerate("crime_agg", crime_agg.make_crime_features),
+                         FeatureToGenerate("crime_agg", crime_agg.make_crime_features),
                          FeatureToGenerate("named_entities",
                                            ner.make_owner_features),
                          FeatureToGenerate("house_type",
@@ -60,17 +63,45 @@ existing_features = [FeatureToGenerate("tax", tax.make_tax_features),
                          FeatureToGenerate("quarter",
                                            quarter.make_quarter_features),
                          FeatureToGenerate("sixweeksweather",
-                                           weather.make_weather_features)]
+                                           weather.make_weather_features),
+                         FeatureToGenerate("weather",
+                                           weather.make_weather_window_features)]
 
 def generate_features(features_to_generate, n_months, max_dist,
-                     inspection_date=None, insp_set='all_inspections'):
+                     inspection_date=None, insp_set='all_inspections',
+                     spatial_engine='sql', jobs=1, refresh=False):
     """
     Generate labels and features for all inspections
     in the inspections database.
 
     If inspection_date is passed, features will be generated as if
     an inspection will occur on that day
+
+    n_months and max_dist can be lists, in that case spatiotemporal
+    features are generated for every combination. Events are matched
+    with inspections only once for the longest window and largest
+    distance, tables for the rest of combinations are derived from it
+
+    spatial_engine selects how spatiotemporal features match inspections
+    with nearby events: 'sql' (PostGIS) or 'kdtree' (in memory)
+
+    If jobs > 1, feature groups are generated in parallel using
+    that number of processes
+
+    If refresh is True, spatiotemporal features that already exist are
+    only recomputed for inspections affected by events added since they
+    were generated (see incremental.py). New inspections are added to
+    parcels_inspections in the features schema and the daily weather
+    table is rebuilt
     """
+    feature_utils.set_spatial_engine(spatial_engine)
+
+    n_months = n_months if isinstance(n_months, list) else [n_months]
+    max_dist = max_dist if isinstance(max_dist, list) else [max_dist]
+    feature_utils.set_neighbour_windows(n_months, max_dist)
+    windows = [(m, d) for m in sorted(n_months, reverse=True)
+                      for d in sorted(max_dist, reverse=True)]
+
     #select schema
     #depending on the value of inspection date
     
@@ -106,10 +137,7 @@ def generate_features(features_to_generate, n_months, max_dist,
     else:
         logging.info('Using existing schema')
 
-    #Note on SQL injection: schema is either features or features_DATE
-    #date is generated using datetime.datetime.strptime, so if somebody
-    #tries to inject SQL there, it will fail
-    con.cursor().execute("SET SCHEMA '{}'".format(schema))
+    set_schema(con, schema)
 
     #Print the current schema by reading it from the db
     cur = con.cursor()    
@@ -119,11 +147,6 @@ def generate_features(features_to_generate, n_months, max_dist,
                  'n_months={}. max_dist={}').format(current_schema, n_months, max_dist))
     #Get existing tables
     existing_tables =  tables_in_schema(schema)
-    
-    # set the search path, otherwise won't find ST_DWithin()
-    cur = con.cursor()
-    cur.execute("SET search_path TO {schema}, public;".format(schema=schema))
-    con.commit()
 
     # make a new table that contains one row for every parcel in Cincinnati
     # this table has three columns: parcel_id, inspection_date, viol_outcome
@@ -140,26 +163,70 @@ def generate_features(features_to_generate, n_months, max_dist,
           elif insp_set=='field_test':
             inspections = outcome.load_inspections_from_field_test(inspection_date)
 
-        inspections.to_sql("parcels_inspections", engine, chunksize=50000,
-                      if_exists='fail', index=False, schema=schema)
+        #Create indexes to make joins with events_Xmonths_* tables faster
+        copy_to_sql(inspections, "parcels_inspections", engine,
+                    if_exists='fail', index=False, schema=schema,
+                    indexes=[['parcel_id'], ['inspection_date'],
+                             ['parcel_id', 'inspection_date']])
         logging.debug("... table has {} rows".format(len(inspections)))
-        #Create an index to make joins with events_Xmonths_* tables faster
-        cur.execute('CREATE INDEX ON parcels_inspections (parcel_id);')
-        cur.execute('CREATE INDEX ON parcels_inspections (inspection_date);')
-        cur.execute('CREATE INDEX ON parcels_inspections (parcel_id, inspection_date);')
-        con.commit()
+    elif refresh and inspection_date is None and insp_set=='all_inspections':
+        logger.info('Adding new inspections to parcels_inspections table...')
+        incremental.update_inspections(con, engine, schema, outcome.generate_labels())
     else:
         logger.info('parcels_inspections table already exists, skipping...')
 
-    for feature in features_to_generate:
-        logging.info("Generating {} features".format(feature.table))
+    #Weather features share a table with daily averages, rebuild it
+    #once here instead of in every feature group
+    if refresh and any(f.generator_function in (weather.make_weather_features,
+                                                weather.make_weather_window_features)
+                       for f in features_to_generate):
+        weather.make_rolling_weather_table(con, refresh=True)
+
+    if jobs > 1:
+        tasks = [(feature, windows, schema, existing_tables,
+                  spatial_engine, n_months, max_dist, refresh)
+                 for feature in features_to_generate]
+        logger.info('Generating {} feature groups using {} workers'.format(len(tasks), jobs))
+        pool = Pool(jobs)
+        try:
+            for table in pool.imap_unordered(generate_feature_group_in_worker, tasks):
+                logger.info('Done generating {} features'.format(table))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for feature in features_to_generate:
+            generate_feature_group(feature, windows, schema, existing_tables,
+                                   engine, con, refresh)
+
+def set_schema(con, schema):
+    #Note on SQL injection: schema is either features or features_DATE
+    #date is generated using datetime.datetime.strptime, so if somebody
+    #tries to inject SQL there, it will fail
+    cur = con.cursor()
+    cur.execute("SET SCHEMA '{}'".format(schema))
+    # set the search path, otherwise won't find ST_DWithin()
+    cur.execute("SET search_path TO {schema}, public;".format(schema=schema))
+    con.commit()
+
+def generate_feature_group(feature, windows, schema, existing_tables, engine, con,
+                           refresh=False):
+    """
+    Generate and save the tables for one feature, for every
+    (n_months, max_dist) in windows if the feature is spatiotemporal
+    """
+    logging.info("Generating {} features".format(feature.table))
+    for months, dist in windows:
+        if refresh and incremental.refresh_features(feature, months, dist,
+                                                    schema, engine, con):
+            continue
         #Try generating features with the n_months argument
         try:
             logging.info(("Generating {} "
                           "features for {} months "
-                          "and within {} m").format(feature.table, n_months, max_dist))
-            feature_data = feature.generator_function(con, n_months, max_dist)
-            table_to_save = '{}_{}m_{}months'.format(feature.table, max_dist, n_months)
+                          "and within {} m").format(feature.table, months, dist))
+            feature_data = feature.generator_function(con, months, dist)
+            table_to_save = '{}_{}m_{}months'.format(feature.table, dist, months)
         #If it fails, feature is not spatiotemporal, send only connection
         except Exception, e:
             table_to_save = feature.table
@@ -170,14 +237,42 @@ def generate_features(features_to_generate, n_months, max_dist,
         #corresponding parcels_inspections table in the schema being used
         # TO DO: check that feature_data has the right shape and indexes
         if table_to_save in existing_tables:
-            logger.info('Features table {} already exists. Replacing...'.format(feature.table))
+            logger.info('Features table {} already exists. Replacing...'.format(table_to_save))
 
-        feature_data.to_sql(table_to_save, engine, chunksize=50000,
+        copy_to_sql(feature_data, table_to_save, engine,
           if_exists='replace', index=True, schema=schema,
           #Force saving inspection_date as timestamp without timezone
           dtype={'inspection_date': types.TIMESTAMP(timezone=False)})
         logging.debug("{} table has {} rows".format(table_to_save, len(feature_data)))
 
+        #Features that are not spatiotemporal only need to be generated once
+        if table_to_save == feature.table:
+            break
+        incremental.record_watermark(con, feature.table, months, dist)
+
+def generate_feature_group_in_worker(args):
+    """
+    Run generate_feature_group in a worker process. Every worker
+    uses its own engine and connection to the database
+    """
+    (feature, windows, schema, existing_tables,
+     spatial_engine, n_months, max_dist, refresh) = args
+    feature_utils.set_spatial_engine(spatial_engine)
+    feature_utils.set_neighbour_windows(n_months, max_dist)
+    engine = create_engine(uri)
+    con = engine.raw_connection()
+    set_schema(con, schema)
+    try:
+        generate_feature_group(feature, windows, schema, existing_tables,
+                               engine, con, refresh)
+    finally:
+        con.close()
+        engine.dispose()
+    return feature.table
+
+def int_list(s):
+    return [int(x) for x in s.split(',')]
+
 if __name__ == '__main__':
     #Get the table names for existing features
     tables = [t.table for t in existing_features]
@@ -196,14 +291,16 @@ if __name__ == '__main__':
                         help=("Count events that happened m months "
                               "before inspection took place. "
                               "Only supported by spatiotemporal features. "
-			                  "Defaults to 3 months"), type=int,
-			                  default=3)
+                              "Accepts a comma separated list (e.g. 3,12). "
+			                  "Defaults to 3 months"), type=int_list,
+			                  default=[3])
     parser.add_argument("-md", "--maxdist",
                         help=("Count events that happened max m meters "
                               "from inspection. "
                               "Only supported by spatiotemporal features. "
-                              "Defaults to 1000 m (max value posible)"), type=int,
-                        default=1000)
+                              "Accepts a comma separated list (e.g. 50,400,1000). "
+                              "Defaults to 1000 m (max value posible)"), type=int_list,
+                        default=[1000])
     parser.add_argument("-s", "--set", type=str,
                         choices=['all_inspections', 'field_test'],
                         help=("Which inspections set to use, "
@@ -211,6 +308,22 @@ if __name__ == '__main__':
                           "field_test will use public.field_test table. Defaults "
                           "to all_inspections"),
                         default='all_inspections')
+    parser.add_argument("-e", "--engine", type=str,
+                        choices=feature_utils.SPATIAL_ENGINES,
+                        help=("How to match inspections with nearby events "
+                              "in spatiotemporal features, sql uses PostGIS, "
+                              "kdtree loads coordinates and does it in memory. "
+                              "Defaults to sql"),
+                        default='sql')
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=("Number of feature groups to generate in "
+                              "parallel, each one in a separate process "
+                              "with its own database connection. Defaults to 1"))
+    parser.add_argument("-r", "--refresh", action="store_true",
+                        help=("Only recompute spatiotemporal features for "
+                              "inspections affected by events added since "
+                              "the last run, add new inspections and "
+                              "rebuild the daily weather table"))
     args = parser.parse_args()
 
     #Based on user selection create an array with the features to generate
@@ -229,4 +342,5 @@ if __name__ == '__main__':
     print "Selected features: %s" % selected
     d = datetime.datetime.strptime(args.date, '%d%b%Y') if args.date not in [None, "None"] else None
 
-    generate_features(selected_features, args.months, args.maxdist, d, args.set)
+    generate_features(selected_features, args.months, args.maxdist, d, args.set,
+                      args.engine, args.jobs, args.refresh)
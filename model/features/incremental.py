@@ -0,0 +1,340 @@
+import re
+import logging
+import logging.config
+
+from lib_cinci.config import load
+from lib_cinci.features import tables_in_schema, columns_for_table_in_schema
+from lib_cinci.features import check_date_boundaries
+from lib_cinci.bulk_writer import copy_to_sql
+import feature_utils
+
+#Config logger
+logging.config.dictConfig(load('logger_config.yaml'))
+logger = logging.getLogger()
+
+#This file provides functions to refresh spatiotemporal features
+#after new events are added, without recomputing every inspection.
+#Every feature table remembers the last event id used to generate it
+#(last_updated_feature table in the features schema, same idea as
+#last_updated_event in the ETL) and the last inspection added to
+#parcels_inspections when it was generated (inspections added on refresh
+#are logged in parcels_inspections_added). On refresh, only inspections
+#whose window overlaps new events, and inspections added since the table
+#was generated, are recomputed and their rows replaced.
+
+#Feature table -> (dataset, date column, location)
+#Location is 'address' if events are matched with parcels using
+#public.parcel2address and 'latlong' if using public.parcel2{dataset}
+DATASETS = {'crime': ('crime', 'occurred_on', 'address'),
+            'fire': ('fire', 'incident_date', 'address'),
+            'permits': ('permits', 'issueddate', 'address'),
+            'sales': ('sales', 'date_of_sale', 'address'),
+            'three11': ('three11', 'requested_datetime', 'latlong')}
+
+TEMPLATES = {'address': 'inspections_address_xmonths.template.sql',
+             'latlong': 'inspections_latlong_xmonths.template.sql'}
+
+def make_watermarks_table(con):
+    cur = con.cursor()
+    cur.execute('CREATE TABLE IF NOT EXISTS last_updated_feature ('
+                'table_name varchar(100) NOT NULL UNIQUE, '
+                'dataset varchar(50) NOT NULL, '
+                'event_id integer DEFAULT 0, '
+                'inspection_id integer DEFAULT 0);')
+    #Watermarks saved before inspections were tracked
+    cur.execute("SELECT 1 FROM information_schema.columns "
+                "WHERE table_schema = current_schema "
+                "AND table_name = 'last_updated_feature' "
+                "AND column_name = 'inspection_id';")
+    if cur.fetchone() is None:
+        cur.execute('ALTER TABLE last_updated_feature '
+                    'ADD COLUMN inspection_id integer DEFAULT 0;')
+    cur.execute('CREATE TABLE IF NOT EXISTS parcels_inspections_added ('
+                'id serial PRIMARY KEY, '
+                'parcel_id text NOT NULL, '
+                'inspection_date timestamp NOT NULL);')
+    con.commit()
+
+def get_watermark(con, table_name):
+    '''
+        Last event id and last added inspection id used to generate
+        table_name, None if the table was never generated with a watermark
+    '''
+    make_watermarks_table(con)
+    cur = con.cursor()
+    cur.execute(('SELECT event_id, inspection_id FROM last_updated_feature '
+                 'WHERE table_name=%s;'), (table_name,))
+    row = cur.fetchone()
+    return None if row is None else (row[0], row[1])
+
+def set_watermark(con, table_name, dataset, event_id, inspection_id):
+    make_watermarks_table(con)
+    cur = con.cursor()
+    cur.execute('DELETE FROM last_updated_feature WHERE table_name=%s;', (table_name,))
+    cur.execute(('INSERT INTO last_updated_feature (table_name, dataset, '
+                 'event_id, inspection_id) VALUES (%s, %s, %s, %s);'),
+                (table_name, dataset, event_id, inspection_id))
+    con.commit()
+
+def max_inspection_id(con):
+    '''
+        Id of the last inspection added to parcels_inspections on refresh
+    '''
+    make_watermarks_table(con)
+    cur = con.cursor()
+    cur.execute('SELECT coalesce(max(id), 0) FROM parcels_inspections_added;')
+    return cur.fetchone()[0]
+
+def max_event_id(con, dataset):
+    cur = con.cursor()
+    cur.execute('SELECT coalesce(max(id), 0) FROM public.{};'.format(dataset))
+    return cur.fetchone()[0]
+
+def record_watermark(con, feature_table, n_months, max_dist):
+    '''
+        Save the watermark for a feature table generated from scratch.
+        The insp2 table may come from a previous run, so the last event id
+        in it is used instead of the last one in the dataset (ids are
+        serial, events added after the table was built have greater ids)
+    '''
+    if feature_table not in DATASETS:
+        return
+    dataset = DATASETS[feature_table][0]
+    insp2_table = ('insp2{dataset}_{n_months}months'
+                   '_{max_dist}m').format(dataset=dataset, n_months=n_months,
+                                          max_dist=max_dist)
+    cur = con.cursor()
+    cur.execute('SELECT coalesce(max(id), 0) FROM {};'.format(insp2_table))
+    event_id = cur.fetchone()[0]
+    table_name = '{}_{}m_{}months'.format(feature_table, max_dist, n_months)
+    set_watermark(con, table_name, dataset, event_id, max_inspection_id(con))
+
+def update_inspections(con, engine, schema, inspections):
+    '''
+        Add new inspections to parcels_inspections (and log them in
+        parcels_inspections_added) and update the outcome for existing
+        ones (outcomes change when violations are added after the
+        inspection)
+    '''
+    make_watermarks_table(con)
+    copy_to_sql(inspections, 'parcels_inspections_refresh', engine,
+                if_exists='replace', index=False, schema=schema)
+    cur = con.cursor()
+    cur.execute('''
+        UPDATE {schema}.parcels_inspections p
+        SET viol_outcome = r.viol_outcome
+        FROM {schema}.parcels_inspections_refresh r
+        WHERE p.parcel_id = r.parcel_id
+        AND p.inspection_date = r.inspection_date
+        AND p.viol_outcome IS DISTINCT FROM r.viol_outcome;
+    '''.format(schema=schema))
+    cur.execute('''
+        WITH added AS (
+            INSERT INTO {schema}.parcels_inspections (parcel_id, inspection_date, viol_outcome)
+            SELECT r.parcel_id, r.inspection_date, r.viol_outcome
+            FROM {schema}.parcels_inspections_refresh r
+            LEFT JOIN {schema}.parcels_inspections p
+            USING (parcel_id, inspection_date)
+            WHERE p.parcel_id IS NULL
+            RETURNING parcel_id, inspection_date
+        )
+        INSERT INTO {schema}.parcels_inspections_added (parcel_id, inspection_date)
+        SELECT parcel_id, inspection_date FROM added;
+    '''.format(schema=schema))
+    logger.info('Added {} new inspections'.format(cur.rowcount))
+    cur.execute('DROP TABLE {schema}.parcels_inspections_refresh;'.format(schema=schema))
+    con.commit()
+
+def make_affected_inspections(con, schema, dataset, date_column,
+                              location, watermark, inspection_watermark,
+                              n_months, max_dist, min_insp, max_insp):
+    '''
+        Create a temporary parcels_inspections table with the inspections
+        that need to be recomputed: the ones with new events (id > watermark)
+        within max_dist and n_months before them and the ones added to
+        parcels_inspections after the table was generated (id in
+        parcels_inspections_added > inspection_watermark). Since temporary
+        tables are searched first, feature generators will only see these
+        inspections.
+        Returns the number of inspections
+    '''
+    if location == 'address':
+        event_to_parcel = ('JOIN public.parcel2address AS p2e '
+                           'ON p2e.address_id = event.address_id')
+    else:
+        event_to_parcel = ('JOIN public.parcel2{dataset} AS p2e '
+                           'ON p2e.event_id = event.id').format(dataset=dataset)
+
+    query = '''
+        CREATE TEMP TABLE parcels_inspections AS
+            SELECT insp.*
+            FROM public.{dataset} AS event
+            {event_to_parcel}
+            JOIN {schema}.parcels_inspections AS insp
+            ON insp.parcel_id = p2e.parcel_id
+            AND event.{date_column} < insp.inspection_date
+            AND (insp.inspection_date - '{n_months} month'::interval) <= event.{date_column}
+            WHERE event.id > {watermark}
+            AND p2e.dist_m <= {max_dist}
+            AND insp.inspection_date BETWEEN '{min_insp}' AND '{max_insp}'
+            UNION
+            SELECT insp.*
+            FROM {schema}.parcels_inspections AS insp
+            JOIN {schema}.parcels_inspections_added AS added
+            USING (parcel_id, inspection_date)
+            WHERE added.id > {inspection_watermark}
+            AND insp.inspection_date BETWEEN '{min_insp}' AND '{max_insp}'
+        ;
+        CREATE INDEX ON parcels_inspections (parcel_id, inspection_date);
+    '''.format(dataset=dataset, event_to_parcel=event_to_parcel, schema=schema,
+               date_column=date_column, n_months=n_months, watermark=watermark,
+               max_dist=max_dist, min_insp=min_insp, max_insp=max_insp,
+               inspection_watermark=inspection_watermark)
+    cur = con.cursor()
+    cur.execute(query)
+    cur.execute('SELECT count(*) FROM parcels_inspections;')
+    n_affected = cur.fetchone()[0]
+    con.commit()
+    return n_affected
+
+def drop_base_tables(con, schema, dataset):
+    '''
+        Tables with neighbours for several windows (see
+        feature_utils.set_neighbour_windows) are not refreshed,
+        drop them so they are rebuilt next time they are needed
+    '''
+    pattern = re.compile('^insp2{}_\d+to\d+months_\d+m$'.format(dataset))
+    cur = con.cursor()
+    for table in tables_in_schema(schema):
+        if pattern.match(table):
+            logger.info('Dropping {}, it is outdated'.format(table))
+            cur.execute('DROP TABLE {}.{};'.format(schema, table))
+    con.commit()
+
+def refresh_features(feature, n_months, max_dist, schema, engine, con):
+    '''
+        Recompute the rows in {feature}_{max_dist}m_{n_months}months
+        affected by events added since the last run and replace them.
+        Returns False if the table cannot be refreshed and has to be
+        generated from scratch (not a spatiotemporal table, no watermark
+        or the refreshed rows have different columns)
+    '''
+    table_name = '{}_{}m_{}months'.format(feature.table, max_dist, n_months)
+    if (feature.table not in DATASETS or
+        table_name not in tables_in_schema(schema)):
+        return False
+    watermarks = get_watermark(con, table_name)
+    if watermarks is None:
+        logger.info('{} has no watermark, generating it from scratch'.format(table_name))
+        return False
+    watermark, inspection_watermark = watermarks
+
+    dataset, date_column, location = DATASETS[feature.table]
+    #Take the watermarks before computing, events and inspections
+    #added while this runs will be picked up next time
+    event_id = max_event_id(con, dataset)
+    inspection_id = max_inspection_id(con)
+    min_insp, max_insp = check_date_boundaries(con, n_months, dataset, date_column)
+    drop_base_tables(con, schema, dataset)
+
+    insp2_table = ('insp2{dataset}_{n_months}months'
+                   '_{max_dist}m').format(dataset=dataset, n_months=n_months,
+                                          max_dist=max_dist)
+    try:
+        n_affected = make_affected_inspections(con, schema, dataset,
+                                               date_column, location, watermark,
+                                               inspection_watermark, n_months,
+                                               max_dist, min_insp, max_insp)
+        logger.info(('Refreshing {}: {} new events, {} '
+                     'inspections affected').format(table_name, event_id-watermark,
+                                                    n_affected))
+        if n_affected > 0:
+            df = recompute_affected(feature, n_months, max_dist, schema, con,
+                                    dataset, date_column, location, insp2_table,
+                                    min_insp, max_insp)
+            if df is None:
+                return False
+            replace_affected(df, table_name, schema, engine, con)
+    finally:
+        #Make sure other generators using this connection
+        #don't see the temporary tables
+        con.rollback()
+        cur = con.cursor()
+        cur.execute('DROP TABLE IF EXISTS pg_temp.parcels_inspections;')
+        cur.execute('DROP TABLE IF EXISTS pg_temp.{};'.format(insp2_table))
+        con.commit()
+
+    set_watermark(con, table_name, dataset, event_id, inspection_id)
+    return True
+
+def recompute_affected(feature, n_months, max_dist, schema, con,
+                       dataset, date_column, location, insp2_table,
+                       min_insp, max_insp):
+    '''
+        Run the feature generator only for the inspections in the
+        temporary parcels_inspections table. Returns None if the
+        columns don't match the ones in the existing feature table
+    '''
+    #Match affected inspections with events, update the insp2 table in
+    #the schema and shadow it with a temporary table that only has
+    #the affected inspections
+    scratch_table = insp2_table + '_refresh'
+    cur = con.cursor()
+    cur.execute('DROP TABLE IF EXISTS {}.{};'.format(schema, scratch_table))
+    con.commit()
+    feature_utils.build_nmonths_table(con, scratch_table, dataset, date_column,
+                                      min_insp, max_insp, n_months, max_dist,
+                                      TEMPLATES[location], location)
+    if insp2_table in tables_in_schema(schema):
+        cur.execute('''
+            DELETE FROM {schema}.{insp2} AS i2e
+            USING parcels_inspections AS insp
+            WHERE i2e.parcel_id = insp.parcel_id
+            AND i2e.inspection_date = insp.inspection_date;
+            INSERT INTO {schema}.{insp2} SELECT * FROM {schema}.{scratch};
+        '''.format(schema=schema, insp2=insp2_table, scratch=scratch_table))
+    else:
+        cur.execute('CREATE TABLE {schema}.{insp2} AS SELECT * FROM {schema}.{scratch};'.format(
+                    schema=schema, insp2=insp2_table, scratch=scratch_table))
+    cur.execute('''
+        CREATE TEMP TABLE {insp2} AS SELECT * FROM {schema}.{scratch};
+        CREATE INDEX ON {insp2} (parcel_id, inspection_date);
+        CREATE INDEX ON {insp2} (id);
+        DROP TABLE {schema}.{scratch};
+    '''.format(schema=schema, insp2=insp2_table, scratch=scratch_table))
+    con.commit()
+
+    df = feature.generator_function(con, n_months, max_dist)
+
+    table_name = '{}_{}m_{}months'.format(feature.table, max_dist, n_months)
+    existing = [c for c, _ in columns_for_table_in_schema(table_name, schema)
+                if c not in ['parcel_id', 'inspection_date']]
+    if sorted(existing) != sorted(df.columns):
+        #Usually happens when the most frequent levels for a
+        #categorical column change
+        logger.warning(('Refreshed rows for {} have different columns, '
+                        'generating it from scratch').format(table_name))
+        return None
+    return df[existing]
+
+def replace_affected(df, table_name, schema, engine, con):
+    '''
+        Replace rows for the inspections in the temporary parcels_inspections
+        table with the ones in df, in a single transaction
+    '''
+    copy_to_sql(df, table_name+'_refresh', engine,
+                if_exists='replace', index=True, schema=schema)
+    cols = ', '.join('"{}"'.format(c) for c in
+                     ['parcel_id', 'inspection_date'] + list(df.columns))
+    cur = con.cursor()
+    cur.execute('''
+        DELETE FROM {schema}.{table} AS feature
+        USING parcels_inspections AS insp
+        WHERE feature.parcel_id = insp.parcel_id
+        AND feature.inspection_date = insp.inspection_date;
+        INSERT INTO {schema}.{table} ({cols})
+        SELECT {cols} FROM {schema}.{table}_refresh;
+        DROP TABLE {schema}.{table}_refresh;
+    '''.format(schema=schema, table=table_name, cols=cols))
+    con.commit()
+    logger.info('{} rows replaced in {}'.format(len(df), table_name))
@@ -12,7 +12,7 @@ CREATE TABLE ${TABLE_NAME} AS (
     SELECT
         insp.parcel_id, insp.inspection_date,
         p2a.dist_m,
-        event.id --columns to select from event
+        event.id${EXTRA_COLUMNS} --columns to select from event
     FROM parcels_inspections AS insp
     JOIN public.parcel2address AS p2a
     USING (parcel_id)
@@ -11,7 +11,7 @@ CREATE TABLE ${TABLE_NAME} AS (
 	--since the db connection should set one
 	--using SET SCHEMA
     SELECT insp.parcel_id, insp.inspection_date, p2e.dist_m,
-            event.id --columns to select from event, limited in WHERE clause below
+            event.id${EXTRA_COLUMNS} --columns to select from event, limited in WHERE clause below
     FROM parcels_inspections AS insp
     JOIN public.parcel2${DATASET} AS p2e
     USING (parcel_id)
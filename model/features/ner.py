@@ -1,7 +1,64 @@
 #!/usr/bin/env python
+import re
 import numpy as np
 import pandas as pd
-import colmap
+
+#Years before the inspection year that are counted
+OWNER_YEARS = 3
+
+
+def organization_owned_years(inspections, owners, n_years=OWNER_YEARS):
+    """
+    Number of years that the parcel of every inspection was owned by an
+    organization in the n_years before the inspection year.
+
+    Input:
+    inspections: DataFrame with parcel_id and inspection_date
+    owners: DataFrame with parcel_id and one owner_YYYY column per year
+            with the owner entity type (e.g. ORGANIZATION)
+
+    Output:
+    A Series indexed by inspection_date and parcel_id, inspections whose
+    parcel is not in owners are dropped, inspections without owner
+    data for any of the years get NaN.
+    """
+    columns = sorted([c for c in owners.columns if re.match('^owner_\d{4}$', c)])
+    years = np.array([int(c[-4:]) for c in columns], dtype=int)
+    first_year = years.min() if len(years) else 0
+
+    #(parcels x years) matrices, years without a column are all zeros
+    #in both (so they are not counted as available)
+    n_cols = years.max() - first_year + 1 if len(years) else 0
+    organization = np.zeros((len(owners), n_cols))
+    available = np.zeros((len(owners), n_cols))
+    organization[:, years - first_year] = owners[columns].values == 'ORGANIZATION'
+    available[:, years - first_year] = 1
+
+    #Cumulative sums with a leading zero, the count for years [lo, hi)
+    #is cumulative[:, hi] - cumulative[:, lo]
+    cum_organization = np.zeros((len(owners), n_cols + 1))
+    cum_available = np.zeros((len(owners), n_cols + 1))
+    np.cumsum(organization, axis=1, out=cum_organization[:, 1:])
+    np.cumsum(available, axis=1, out=cum_available[:, 1:])
+
+    parcels = pd.Index(owners['parcel_id'].values)
+    rows = parcels.get_indexer(inspections['parcel_id'].values)
+    inspections = inspections[rows >= 0]
+    rows = rows[rows >= 0]
+
+    insp_year = pd.to_datetime(inspections['inspection_date']).dt.year.values
+    hi = np.clip(insp_year - first_year, 0, n_cols)
+    lo = np.clip(insp_year - first_year - n_years, 0, n_cols)
+
+    count = cum_organization[rows, hi] - cum_organization[rows, lo]
+    n_available = cum_available[rows, hi] - cum_available[rows, lo]
+    count[n_available == 0] = np.nan
+
+    index = pd.MultiIndex.from_arrays([inspections['inspection_date'].values,
+                                       inspections['parcel_id'].values],
+                                      names=['inspection_date', 'parcel_id'])
+    return pd.Series(count, index=index, name='owner_ner')
+
 
 def make_owner_features(db_connection):
     """
@@ -17,29 +74,13 @@ def make_owner_features(db_connection):
     A pandas dataframe, with one row per inspection and one column per feature.
     """
 
-    query = ("SELECT inspections.inspection_date, taxes.* "
-             "FROM parcels_inspections AS inspections "
-             "JOIN public.taxes_owners AS taxes "
-             "ON inspections.parcel_id = taxes.parcel_id")
-    df = pd.read_sql(query, con=db_connection)
-
-    for year in colmap.insp_years:
-        indices_this_year = df.inspection_date.dt.year == int(year)
-        year_range = range(int(year[2:]) - 3, int(year[2:]))
-
-        if int(year) == 2008:
-            num_org = df[["owner_2007", "parcel_id"]]
-        elif int(year) == 2009:
-            num_org = df[["owner_2007", "owner_2008"]]
-        elif int(year) >= 2010:
-            num_org = df[['owner_20' + str(y).zfill(2) for y in year_range]]
-
-        try:
-            computation = num_org.apply(lambda row: 
-                                        len(row[row == 'ORGANIZATION']), axis=1)
-            df.ix[indices_this_year, "owner_ner"] = computation
-        except:
-            df.ix[indices_this_year, "owner_ner"] = np.nan
-
-    df.set_index(['inspection_date', 'parcel_id'], inplace=True)
-    return df['owner_ner']
+    inspections = pd.read_sql("SELECT parcel_id, inspection_date "
+                              "FROM parcels_inspections", con=db_connection)
+    #One row per parcel, instead of one per inspection
+    query = ("SELECT taxes.* "
+             "FROM public.taxes_owners AS taxes "
+             "WHERE taxes.parcel_id IN "
+             "(SELECT parcel_id FROM parcels_inspections)")
+    owners = pd.read_sql(query, con=db_connection)
+
+    return organization_owned_years(inspections, owners)
@@ -76,7 +76,7 @@ def make_house_type_features(db_connection):
     df = df.set_index("parcel_id")
 
     # map use code to type of home
-    use_codes = {423: "mixed-used",
+    use_codes = {423: "mixed-use",
                  510: "single-family",
                  520: "two-family",
                  530: "three-family",
@@ -84,13 +84,10 @@ def make_house_type_features(db_connection):
                  554: "multi-family",
                  552: "multi-family",
                  599: "multi-family"}
-    df["type"] = df["class"].apply(lambda cl: use_codes.get(cl, np.nan))
-
-    df = util.get_dummies(df["type"], possible_values=["single-family",
-                                                       "two-family",
-                                                       "three-family",
-                                                       "multi-family",
-                                                       "mixed-use"])
-    df = df.fillna(0)
+    df["type"] = df["class"].map(use_codes)
+
+    # parcels with other use codes get 0 in every column
+    df = util.get_dummies(df["type"], util.dummy_variables["home_use"],
+                          dtype=np.uint8)
 
     return df
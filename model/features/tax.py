@@ -37,70 +37,64 @@ def load_three_year_foreclosures(db_connection):
     return foreclosures
 
 
+VALUE_COLUMNS = ["mkt_total_val", "mkt_land_val", "mkt_impr_val"]
+
+
 def calculate_means(values):
-    values = values[["mkt_total_val", "mkt_land_val", "mkt_impr_val"]]
-    means = values.reset_index().groupby(["parcel_id",
-                                          "inspection_date"]).mean()
+    values = values[VALUE_COLUMNS]
+    means = values.groupby(level=["parcel_id", "inspection_date"]).mean()
     means = means.rename(columns={"mkt_total_val": "mean_market_value",
                                   "mkt_land_val": "mean_land_value",
                                   "mkt_impr_val": "mean_impr_value"})
     return means
 
 
-def calculate_value_changes(group):
+def first_and_last_year_values(values):
+    """
+    Values for the first and last tax year of every inspection (if there
+    are several rows for the same year, the first one is used). Returns
+    two DataFrames indexed by parcel_id and inspection_date, values are
+    NaN when there is only one tax year for the inspection
+    """
+    keys = ["parcel_id", "inspection_date"]
+    values = values[["taxyear"] + VALUE_COLUMNS].reset_index()
+    values["row"] = np.arange(len(values))
+    values["last_year"] = -values["taxyear"]
 
-    first_year = group["taxyear"].argmin()
-    last_year = group["taxyear"].argmax()
+    first = values.sort_values(keys + ["taxyear", "row"]).drop_duplicates(keys)
+    first = first.set_index(keys)
+    last = values.sort_values(keys + ["last_year", "row"]).drop_duplicates(keys)
+    last = last.set_index(keys).reindex(first.index)
 
     # tax data only for one year -> change is undefined
-    if first_year == last_year:
-        return pd.Series({"change_market_value": np.nan,
-                          "change_land_value": np.nan,
-                          "change_impr_value": np.nan})
-
-    first_year_values = group.loc[first_year][["mkt_total_val",
-                                               "mkt_land_val",
-                                               "mkt_impr_val"]]
-    last_year_values = group.loc[last_year][["mkt_total_val",
-                                             "mkt_land_val",
-                                             "mkt_impr_val"]]
+    one_year = (first["row"] == last["row"]).values
+    first = first[VALUE_COLUMNS].astype(float)
+    last = last[VALUE_COLUMNS].astype(float)
+    first.loc[one_year] = np.nan
+    last.loc[one_year] = np.nan
+    return first, last
 
-    value_changes = (last_year_values - first_year_values)
 
-    return pd.Series({"change_market_value": value_changes["mkt_total_val"],
-                      "change_land_value": value_changes["mkt_land_val"],
-                      "change_impr_value": value_changes["mkt_impr_val"]})
+def calculate_value_changes(first, last):
+    changes = last - first
+    return changes.rename(columns={"mkt_total_val": "change_market_value",
+                                   "mkt_land_val": "change_land_value",
+                                   "mkt_impr_val": "change_impr_value"})
 
 
-def calculate_relative_value_changes(group):
-    first_year = group["taxyear"].argmin()
-    last_year = group["taxyear"].argmax()
+def calculate_relative_value_changes(first, last):
+    changes = (last - first) / first
+    changes = changes.replace([np.inf, -np.inf], np.nan)
+    return changes.rename(columns={"mkt_total_val": "rel_change_market_value",
+                                   "mkt_land_val": "rel_change_land_value",
+                                   "mkt_impr_val": "rel_change_impr_value"})
 
-    # tax data only for one year -> change is undefined
-    if first_year == last_year:
-        return pd.Series({"rel_change_market_value": np.nan,
-                          "rel_change_land_value": np.nan,
-                          "rel_change_impr_value": np.nan})
 
-    first_year_values = group.loc[first_year][["mkt_total_val",
-                                               "mkt_land_val",
-                                               "mkt_impr_val"]]
-    last_year_values = group.loc[last_year][["mkt_total_val",
-                                             "mkt_land_val",
-                                             "mkt_impr_val"]]
-
-    value_changes = (last_year_values - first_year_values) / first_year_values
-    value_changes = value_changes.replace([np.inf, -np.inf], np.nan)
-
-    return pd.Series({"rel_change_market_value":
-                      value_changes["mkt_total_val"],
-                      "rel_change_land_value": value_changes["mkt_land_val"],
-                      "rel_change_impr_value": value_changes["mkt_impr_val"]})
-
-
-def count_foreclosed_years(group):
-    group = group["foreclosure"].replace({True: 1.0, False: 0.0})
-    return pd.Series({"tax_foreclosure": group.sum()})
+def count_foreclosed_years(foreclosures):
+    foreclosed = foreclosures["foreclosure"].replace({True: 1.0, False: 0.0})
+    foreclosed = foreclosed.groupby(level=["parcel_id",
+                                           "inspection_date"]).sum()
+    return foreclosed.to_frame("tax_foreclosure")
 
 
 def make_tax_features(db_connection):
@@ -125,24 +119,20 @@ def make_tax_features(db_connection):
     features.append(means["mean_land_value"])
     features.append(means["mean_impr_value"])
 
-    changes = values.reset_index().groupby(["parcel_id",
-                                            "inspection_date"]).apply(
-                                        calculate_value_changes)
+    first, last = first_and_last_year_values(values)
+
+    changes = calculate_value_changes(first, last)
     features.append(changes["change_market_value"])
     features.append(changes["change_land_value"])
     features.append(changes["change_impr_value"])
 
-    changes = values.reset_index().groupby(["parcel_id",
-                                            "inspection_date"]).apply(
-                                        calculate_relative_value_changes)
+    changes = calculate_relative_value_changes(first, last)
     features.append(changes["rel_change_market_value"])
     features.append(changes["rel_change_land_value"])
     features.append(changes["rel_change_impr_value"])
 
     foreclosures = load_three_year_foreclosures(db_connection)
-    foreclosures = foreclosures.reset_index().groupby(["parcel_id",
-                                                  "inspection_date"]).apply(
-                                                  count_foreclosed_years)
+    foreclosures = count_foreclosed_years(foreclosures)
     features.append(foreclosures["tax_foreclosure"])
 
     features = pd.concat(features, axis=1)
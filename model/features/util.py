@@ -6,6 +6,8 @@ import pandas as pd
 from sqlalchemy import create_engine
 import datetime
 from lib_cinci.db import uri
+#Shared with FeatureLoader, see lib_cinci.util
+from lib_cinci.util import get_dummies, dummy_variables
 
 logger = logging.getLogger()
 
@@ -45,47 +47,6 @@ def make_short_zip(year, df):
     return df
 
 
-def get_dummies(series, possible_values):
-    """
-    Converts a categorical variable to a set of binary variables.
-
-    This function is modeled after the pandas get_dummies function.
-    The difference to the pandas version is that this
-    function guarantees that there will be a column for each
-    possible value of the categorical variable, i.e. the number
-     (and ordering) of the binary columns is always the same
-
-    E.g. assume the variable can take values val1, val2 and val3
-    and but the input series only contains val1 and val3
-      - in pandas' get_dummies the resulting data frame will
-      have only two columns val1 and val3
-      - with this function the resulting data frame will
-      have three columns val1, val2, val3. val2 will be filled with 0
-
-    :param series:
-    :param possible_values: The list of values the categorical variable
-    can take.
-    :return: A pandas dataframe with as many binary columns as there
-    are possible values.
-    """
-
-    def make_dummies(value):
-        if isinstance(value, float) and np.isnan(value):
-            dummy = pd.Series(np.nan, index=possible_values)
-            return dummy
-        else:
-            if value not in possible_values:
-                raise ValueError("{} is not in allowed list of values {}".format(value, possible_values))
-            dummy = pd.Series(0, index=possible_values)
-            dummy[value] = 1
-            return dummy
-
-    if len(series) == 0:
-        return pd.DataFrame([], columns=possible_values)
-    else:
-        return series.apply(make_dummies)
-
-
 def mean_impute_series(series):
 
     is_finite = np.isfinite(series.values)
@@ -3,8 +3,16 @@ import logging
 import logging.config
 from feature_utils import make_inspections_latlong_nmonths_table, compute_frequency_features
 from feature_utils import format_column_names, group_and_count_from_db
+from feature_utils import load_inspections_coordinates, find_neighbours
+from feature_utils import derive_nmonths_table, case_when_columns
+import feature_utils
 from lib_cinci.config import load
 from lib_cinci.features import check_date_boundaries
+from lib_cinci.db import uri
+from lib_cinci.bulk_writer import copy_to_sql
+from lib_cinci import parcel_graph
+from lib_cinci.parcel_graph import FOOT_PER_METER
+from sqlalchemy import create_engine, types
 import pandas as pd
 
 #Config logger
@@ -30,25 +38,40 @@ def make_inspections_features(con, n_months, max_dist):
     ## Make the parcel_id-to-nearby-houses table, if it's not there yet.
     ## ------------------------------------------------------------------------
 
-    query = """
-        CREATE TABLE insp2houses_{max_dist}m AS
-            SELECT  
-                feature_y.parcel_id,
-                count(*) as parcels
-            FROM (
+    #Parcels near each other are matched using the parcel graph, the
+    #kdtree engine does not use it so the number of houses is computed
+    #with PostGIS
+    if feature_utils.spatial_engine == 'kdtree':
+        query = """
+            CREATE TABLE insp2houses_{max_dist}m AS
                 SELECT t.parcel_id,
-                       p.geom
+                       count(parcels.parcelid) as parcels
                 FROM (SELECT DISTINCT parcel_id FROM parcels_inspections) t
                 LEFT JOIN shape_files.parcels_cincy p
                 ON t.parcel_id=p.parcelid
-            ) feature_y
-            LEFT JOIN shape_files.parcels_cincy parcels
-            ON ST_DWithin(feature_y.geom, parcels.geom, {max_dist}*3.281::double precision)
-            AND feature_y.parcel_id <> parcels.parcelid
-            GROUP BY feature_y.parcel_id
-        ;
-        CREATE INDEX ON insp2houses_{max_dist}m (parcel_id);
-        """.format(max_dist=max_dist)
+                LEFT JOIN shape_files.parcels_cincy parcels
+                ON ST_DWithin(p.geom, parcels.geom, {max_dist}*{foot}::double precision)
+                AND t.parcel_id <> parcels.parcelid
+                GROUP BY t.parcel_id
+            ;
+            CREATE INDEX ON insp2houses_{max_dist}m (parcel_id);
+            """.format(max_dist=max_dist, foot=FOOT_PER_METER)
+    else:
+        parcel_graph.check_max_dist(max_dist)
+        parcel_graph.make_parcel_graph(con)
+        query = """
+            CREATE TABLE insp2houses_{max_dist}m AS
+                SELECT t.parcel_id,
+                       count(n.neighbour_id) as parcels
+                FROM (SELECT DISTINCT parcel_id FROM parcels_inspections) t
+                LEFT JOIN {graph} n
+                ON n.parcel_id = t.parcel_id
+                AND n.parcel_id <> n.neighbour_id
+                AND n.dist_m <= {max_dist}
+                GROUP BY t.parcel_id
+            ;
+            CREATE INDEX ON insp2houses_{max_dist}m (parcel_id);
+            """.format(max_dist=max_dist, graph=parcel_graph.GRAPH_TABLE)
 
     #Create a cursor
     cur = con.cursor()
@@ -76,91 +99,49 @@ def make_inspections_features(con, n_months, max_dist):
     #Get the time window for which you can generate features
     min_insp, max_insp = check_date_boundaries(con, n_months, dataset, date_column)
 
-    query = """
-        DROP TABLE IF EXISTS inspfeatures1_{n_months}months_{max_dist}m;
-        CREATE TEMP TABLE inspfeatures1_{n_months}months_{max_dist}m ON COMMIT DROP AS
-            SELECT t2.parcel_id, t2.inspection_date,
-                   t2.event,
-                   coalesce(t1.count, 0) as count,
-                   (coalesce(t1.count, 0)+1.0) / (coalesce(t2.parcels,0)+5.0) as regularized_count_per_houses 
-            FROM (
-                SELECT  
-                    feature_y.parcel_id,
-                    feature_y.inspection_date,
-                    coalesce(realinspections.event,'missing') as event,
-                    count(*) as count
-                FROM (
-                    SELECT t.*, p.geom, ih.parcels
-                    FROM parcels_inspections t
-                    LEFT JOIN shape_files.parcels_cincy p
-                    ON t.parcel_id=p.parcelid
-                    LEFT JOIN insp2houses_{max_dist}m ih
-                    USING (parcel_id)
-                ) feature_y
-                JOIN (
-                    SELECT insp.*, p.geom
-                    FROM inspections_views.events_parcel_id insp
-                    JOIN shape_files.parcels_cincy p
-                    ON insp.parcel_no=p.parcelid
-                ) realinspections
-                ON realinspections.date < feature_y.inspection_date
-                AND (feature_y.inspection_date - '{n_months} month'::interval) <= realinspections.date
-                AND ST_DWithin(feature_y.geom, realinspections.geom, {max_dist}*3.281::double precision)
-                WHERE feature_y.inspection_date BETWEEN '{min_date}' AND '{max_date}'
-                GROUP BY feature_y.parcel_id, feature_y.inspection_date, realinspections.event
-            ) t1
-            RIGHT JOIN
-            (SELECT parcel_id, inspection_date, ft.event, parcels
-                FROM parcels_inspections
-                JOIN 
-                    (select distinct coalesce(event,'missing') as event from inspections_views.events_parcel_id) ft
-                ON true
-                JOIN insp2houses_{max_dist}m
-                USING (parcel_id)
-            ) t2
-            USING (parcel_id, inspection_date, event)
-        ;
+    table_name = 'insp2events_{n_months}months_{max_dist}m'.format(n_months=n_months,
+                                                                 max_dist=max_dist)
+    if table_name not in tables_in_schema(current_schema):
+        logging.info("Table %s does not exist yet, generating."%table_name)
+        if feature_utils.use_base_table(n_months, max_dist):
+            #Several windows and distances are being generated, match
+            #events once and filter (see feature_utils.set_neighbour_windows)
+            min_months, max_months, base_dist = feature_utils.neighbour_windows
+            base_table = feature_utils.base_table_name('events')
+            if base_table not in tables_in_schema(current_schema):
+                base_min, base_max = check_date_boundaries(con, min_months,
+                                                           dataset, date_column)
+                make_events_table(con, base_table, max_months, base_dist,
+                                  base_min, base_max, event_date=True)
+            derive_nmonths_table(con, base_table, table_name, n_months, max_dist,
+                                 min_insp, max_insp, columns=['event'], indexes=[])
+        else:
+            make_events_table(con, table_name, n_months, max_dist, min_insp, max_insp)
+    else:
+        logging.info("Table %s already exists, skipping."%table_name)
 
-        CREATE TEMP TABLE inspfeatures2_{n_months}months_{max_dist}m ON COMMIT DROP AS (
-        SELECT parcel_id, inspection_date, event, count
-        FROM inspfeatures1_{n_months}months_{max_dist}m
-        UNION ALL (
-            SELECT parcel_id, inspection_date, 
-                   event||'_per_houses' as event,
-                   regularized_count_per_houses AS count
-            FROM inspfeatures1_{n_months}months_{max_dist}m
-            )
-        ) ;
-        CREATE INDEX ON inspfeatures2_{n_months}months_{max_dist}m (parcel_id, inspection_date);
-        
-        -- Now call the pivot function to create columns with the 
-        -- different inspection events
-        SELECT colpivot('insppivot_{n_months}months_{max_dist}m',
-                        'select * from inspfeatures2_{n_months}months_{max_dist}m',
-                        array['parcel_id','inspection_date'],
-                        array['event'],
-                        '#.count',
-                        null
-        ); -- Note: Not coalescing the counts, as the _per_houses shouldn't be
-           --       set to 0. We'll have to leave it to later imputation.
-        CREATE INDEX ON insppivot_{n_months}months_{max_dist}m (parcel_id, inspection_date);
-
-        -- still need to 'save' the tables into a permanent table
-        DROP TABLE IF EXISTS inspfeatures_{n_months}months_{max_dist}m;
-        CREATE TABLE inspfeatures_{n_months}months_{max_dist}m AS
-            SELECT * FROM insppivot_{n_months}months_{max_dist}m ip1
-        ;
-        """.format(n_months=str(n_months), max_dist=max_dist, 
-                   min_date=str(min_insp), max_date=str(max_insp))
+    #Count events by type, every type in the events table gets a column
+    #with the count and another one with the count per house nearby, the
+    #regularized count is (count + 1) / (houses + 5)
+    query = ("SELECT DISTINCT coalesce(event, 'missing') AS event "
+             "FROM inspections_views.events_parcel_id;")
+    events = sorted(pd.read_sql(query, con).event)
+    counts = case_when_columns('e.event', events)
+    per_houses = case_when_columns('e.event', events,
+                                   template='(sum({case})+1.0) / (h.parcels+5.0)',
+                                   name='{level}_per_houses')
 
-    cur.execute(query)
-    con.commit()
-    
-    # fetch the data
     query = """
-        SELECT * FROM inspfeatures_{n_months}months_{max_dist}m;
-    """.format(n_months=str(n_months),
-               max_dist=max_dist)
+        SELECT insp.parcel_id, insp.inspection_date,
+               {columns}
+        FROM parcels_inspections insp
+        JOIN insp2houses_{max_dist}m h
+        USING (parcel_id)
+        LEFT JOIN insp2events_{n_months}months_{max_dist}m e
+        USING (parcel_id, inspection_date)
+        GROUP BY insp.parcel_id, insp.inspection_date, h.parcels;
+        """.format(n_months=str(n_months), max_dist=max_dist,
+                   columns=',\n'.join(counts + per_houses))
 
     df = pd.read_sql(query, con, index_col=['parcel_id', 'inspection_date'])
 
@@ -169,11 +150,85 @@ def make_inspections_features(con, n_months, max_dist):
     df.columns = map(lambda x: ''.join(c for c in x if c.isalnum() or c=='_'),
                     df.columns)
 
-    # drop the last interim table
-    query = 'drop table inspfeatures_{n_months}months_{max_dist}m'.format(
-            n_months=str(n_months), max_dist=str(max_dist))
+    return df
+
+
+def make_events_table(con, table_name, n_months, max_dist, min_insp, max_insp,
+                      event_date=False):
+    """
+    Match every inspection with the inspection events that happened
+    within max_dist meters and n_months before it. Uses the parcel
+    graph (see lib_cinci.parcel_graph) or the in-memory index depending
+    on the spatial engine.
+    If event_date is True, the table also has an event_date column
+    """
+    if feature_utils.spatial_engine == 'kdtree':
+        make_events_table_from_index(con, table_name, n_months, max_dist,
+                                     min_insp, max_insp, event_date)
+        return
+
+    parcel_graph.check_max_dist(max_dist)
+
+    query = """
+        CREATE TABLE {table_name} AS
+            SELECT
+                insp.parcel_id,
+                insp.inspection_date,
+                n.dist_m,
+                coalesce(realinspections.event,'missing') as event
+                {extra_columns}
+            FROM parcels_inspections insp
+            JOIN {graph} n
+            ON n.parcel_id = insp.parcel_id
+            AND n.dist_m <= {max_dist}
+            JOIN inspections_views.events_parcel_id realinspections
+            ON realinspections.parcel_no = n.neighbour_id
+            AND realinspections.date < insp.inspection_date
+            AND (insp.inspection_date - '{n_months} month'::interval) <= realinspections.date
+            WHERE insp.inspection_date BETWEEN '{min_date}' AND '{max_date}'
+        ;
+        CREATE INDEX ON {table_name} (parcel_id, inspection_date);
+        """.format(table_name=table_name, n_months=str(n_months), max_dist=max_dist,
+                   min_date=str(min_insp), max_date=str(max_insp),
+                   graph=parcel_graph.GRAPH_TABLE,
+                   extra_columns=', realinspections.date AS event_date' if event_date else '')
+    cur = con.cursor()
     cur.execute(query)
     con.commit()
 
-    return df
+def make_events_table_from_index(con, table_name, n_months, max_dist,
+                                 min_insp, max_insp, event_date=False):
+    """
+    Same as make_events_table but the matching is done in memory
+    with a KD-tree over the parcel centroids
+    """
+    inspections = load_inspections_coordinates(con, min_insp, max_insp)
+
+    query = """
+        SELECT coalesce(insp.event, 'missing') AS event,
+               insp.date AS event_date,
+               ST_X(ST_Centroid(p.geom)) AS x,
+               ST_Y(ST_Centroid(p.geom)) AS y
+        FROM inspections_views.events_parcel_id insp
+        JOIN shape_files.parcels_cincy p
+        ON insp.parcel_no=p.parcelid
+        WHERE p.geom IS NOT NULL
+        AND insp.date >= %(min_date)s
+        AND insp.date < %(max_date)s
+    """
+    min_date = pd.Timestamp(min_insp) - pd.DateOffset(months=n_months)
+    events = pd.read_sql(query, con, params={'min_date': str(min_date),
+                                             'max_date': str(max_insp)})
 
+    event_columns = ['event', 'event_date'] if event_date else ['event']
+    df = find_neighbours(inspections, events, n_months, max_dist,
+                         event_columns=event_columns)
+
+    cur = con.cursor()
+    cur.execute('SELECT current_schema;')
+    current_schema = cur.fetchone()[0]
+    e = create_engine(uri)
+    copy_to_sql(df, table_name, e, if_exists='fail',
+                index=False, schema=current_schema,
+                dtype={'inspection_date': types.TIMESTAMP(timezone=False)},
+                indexes=[['parcel_id', 'inspection_date']])
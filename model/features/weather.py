@@ -3,6 +3,7 @@ import logging
 import logging.config
 from feature_utils import make_inspections_latlong_nmonths_table, compute_frequency_features
 from feature_utils import format_column_names, group_and_count_from_db, make_table_of_frequent_codes
+from feature_utils import lock_shared_object
 from lib_cinci.config import load
 from lib_cinci.features import check_date_boundaries
 import pandas as pd
@@ -11,9 +12,130 @@ import pandas as pd
 logging.config.dictConfig(load('logger_config.yaml'))
 logger = logging.getLogger()
 
+#Hourly columns in public.weather and the name of their features
+WEATHER_COLUMNS = [('air_temp', 'avg_air_temp'),
+                   ('wind_speed_rate', 'avg_wind_speed_rate'),
+                   ('sea_level_pressure', 'avg_sea_level_pressure'),
+                   ('liquid_precipitation_depth_dimension_one_hour',
+                    'avg_precipitation')]
+
+#Window sizes (in weeks) for the weather features
+WINDOWS = [2, 6, 12]
+
+#Daily table with the averages for every window, shared by all schemas
+ROLLING_TABLE = 'public.weather_rolling'
+#Fingerprint of public.weather used to build ROLLING_TABLE
+VERSION_TABLE = 'public.weather_rolling_version'
+
+def rolling_weather_columns(weeks=WINDOWS):
+    return ['{}_{}weeks'.format(feature, n)
+            for n in weeks for _, feature in WEATHER_COLUMNS]
+
+def weather_version(cur):
+    """
+    Fingerprint of public.weather (first and last date and number of
+    rows), it changes every time new weather data is loaded
+    """
+    cur.execute("SELECT min(date)::text || '/' || max(date)::text || '/' || "
+                "count(*)::text FROM public.weather;")
+    return cur.fetchone()[0]
+
+def rolling_table_version(cur):
+    """
+    Fingerprint of public.weather used to build ROLLING_TABLE, None if
+    the table was never built
+    """
+    cur.execute('SELECT to_regclass(%s);', (VERSION_TABLE,))
+    if cur.fetchone()[0] is None:
+        return None
+    cur.execute('SELECT version FROM {};'.format(VERSION_TABLE))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def make_rolling_weather_table(con, weeks=WINDOWS, refresh=False):
+    """
+    Create ROLLING_TABLE, with one row per day and the average of every
+    weather column over the hourly readings in the n weeks before that
+    day (the day itself is not included), for every n in weeks. Hourly
+    readings are summed and counted by day first, so every window is a
+    sum over the previous rows.
+    Days go from the first day with weather data until max(weeks) weeks
+    after the last one.
+    The table does not depend on the inspections, so it is only created
+    if it does not exist, it is missing some window or public.weather
+    changed since it was built (or refresh is True)
+    """
+    sums = ',\n'.join(['sum({c}) AS {c}_sum, count({c}) AS {c}_count'
+                       .format(c=column) for column, _ in WEATHER_COLUMNS])
+    averages = ',\n'.join([('(sum({c}_sum) OVER w{n})::float8 / '
+                            'NULLIF(sum({c}_count) OVER w{n}, 0) AS {f}_{n}weeks')
+                           .format(c=column, f=feature, n=n)
+                           for n in weeks for column, feature in WEATHER_COLUMNS])
+    windows = ',\n'.join(['w{n} AS (ORDER BY day ROWS BETWEEN {days} PRECEDING '
+                          'AND 1 PRECEDING)'.format(n=n, days=7*n)
+                          for n in weeks])
+    query = """
+        DROP TABLE IF EXISTS {table};
+        CREATE TABLE {table} AS
+        WITH daily AS (
+            SELECT date::date AS day,
+                   {sums}
+            FROM public.weather
+            GROUP BY day
+        ), days AS (
+            SELECT generate_series(min(day), max(day) + {max_days},
+                                   '1 day'::interval)::date AS day
+            FROM daily
+        )
+        SELECT day,
+               {averages}
+        FROM days
+        LEFT JOIN daily USING (day)
+        WINDOW {windows};
+        CREATE UNIQUE INDEX ON {table} (day);
+
+        DROP TABLE IF EXISTS {version_table};
+        CREATE TABLE {version_table} (version text,
+                                      created_at timestamp DEFAULT now());
+        INSERT INTO {version_table} (version) VALUES (%(version)s);
+        """.format(table=ROLLING_TABLE, version_table=VERSION_TABLE,
+                   sums=sums, averages=averages,
+                   windows=windows, max_days=7*max(weeks))
+
+    cur = con.cursor()
+    lock_shared_object(cur, ROLLING_TABLE)
+    schema, table = ROLLING_TABLE.split('.')
+    cur.execute("SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = %s AND table_name = %s;",
+                (schema, table))
+    existing = set(row[0] for row in cur.fetchall())
+    version = weather_version(cur)
+    if (refresh or not set(rolling_weather_columns(weeks)) <= existing
+            or rolling_table_version(cur) != version):
+        logging.info("Creating {}".format(ROLLING_TABLE))
+        cur.execute(query, {'version': version})
+    con.commit()
+    cur.close()
+
+def load_weather_features(con, columns):
+    """
+    Join columns in ROLLING_TABLE to every inspection in the current
+    schema by date
+    """
+    query = """
+        SELECT insp.parcel_id, insp.inspection_date, {columns}
+        FROM parcels_inspections insp
+        LEFT JOIN {table} w
+        ON w.day = insp.inspection_date::date;
+        """.format(table=ROLLING_TABLE,
+                   columns=', '.join('w.{} AS {}'.format(c, name)
+                                     for c, name in columns))
+    return pd.read_sql(query, con, index_col=['parcel_id', 'inspection_date'])
+
 def make_weather_features(con):
     """
-    Make weather features
+    Make weather features (averages over the 6 weeks before the
+    inspection)
 
     Input:
     db_connection: connection to postgres database.
@@ -24,33 +146,25 @@ def make_weather_features(con):
     A pandas dataframe, with one row per inspection and one column per feature.
     """
     logging.info("Making weather features")
+    make_rolling_weather_table(con)
+    columns = zip(rolling_weather_columns([6]),
+                  [feature for _, feature in WEATHER_COLUMNS])
+    return load_weather_features(con, columns)
 
-    query = """
-        SELECT insp.parcel_id, t.*
-        FROM parcels_inspections insp
-        LEFT JOIN
-        (SELECT inspection_date,
-                avg(air_temp) as avg_air_temp,
-                avg(wind_speed_rate) as avg_wind_speed_rate,
-                avg(sea_level_pressure) as avg_sea_level_pressure,
-                avg(liquid_precipitation_depth_dimension_one_hour) as avg_precipitation
-            FROM (select distinct inspection_date from parcels_inspections) pinsp
-            JOIN public.weather w
-            ON w.date < inspection_date
-            AND w.date >= (inspection_date - '6 weeks'::interval)
-            GROUP BY inspection_date
-        ) t
-        USING (inspection_date); 
-        """
-    
-    # fetch the data
-    df = pd.read_sql(query, con, index_col=['parcel_id', 'inspection_date'])
-
-    # clean up the column names
-    df.columns = map(lambda x: x.replace(' ','_').lower(), df.columns)
-    df.columns = map(lambda x: ''.join(c for c in x if c.isalnum() or c=='_'),
-                    df.columns)
-
-    return df
+def make_weather_window_features(con, weeks=WINDOWS):
+    """
+    Make weather features for every window in weeks, features are
+    named avg_air_temp_6weeks, avg_precipitation_2weeks, etc.
 
+    Input:
+    db_connection: connection to postgres database.
+                   "set schema ..." must have been called on this connection
+                   to select the correct schema from which to load inspections
 
+    Output:
+    A pandas dataframe, with one row per inspection and one column per feature.
+    """
+    logging.info("Making weather features for {} weeks windows".format(weeks))
+    make_rolling_weather_table(con, weeks=sorted(set(WINDOWS) | set(weeks)))
+    columns = [(c, c) for c in rolling_weather_columns(weeks)]
+    return load_weather_features(con, columns)
@@ -9,6 +9,9 @@ import logging
 import logging.config
 import copy
 import random
+import shutil
+import tempfile
+from multiprocessing import Pool
 import numpy as np
 from pydoc import locate
 from lib_cinci import dataset
@@ -18,8 +21,9 @@ import argparse
 from sklearn import preprocessing
 from sklearn.externals import joblib
 from sklearn_evaluation.Logger import Logger
-from sklearn_evaluation.metrics import precision_at
+from sklearn_evaluation.metrics import metrics_at_percents
 from grid_generator import grid_from_class, _generate_grid
+import parallel
 
 from lib_cinci.config import main as cfg_main
 from lib_cinci.config import load
@@ -29,8 +33,10 @@ from lib_cinci.folders import (path_to_predictions, path_to_pickled_models,
                                path_to_pickled_imputers,
                                path_to_dumps,
                                path_to_top_predictions_on_all_parcels)
+from lib_cinci.prediction_store import PredictionStore
 from lib_cinci.features import (check_nas_threshold,
-                                boundaries_for_table_and_column)
+                                boundaries_for_table_and_column,
+                                tables_and_columns_for_schemas)
 
 """
 Purpose: train a binary classifier to identify those homes that are likely
@@ -138,36 +144,40 @@ def make_datasets(config, predictset=False):
 
     only_residential = config["residential_only"]
 
-    #Train set is built with a list of features, parsed from the configuration
-    #file. Data is obtained between start date and fake today.
+    #Schemas to load data from, the prediction set (if needed) is built
+    #with data from the schema for the end of the validation window.
+    #Columns in both schemas are listed at once
+    schemas = ["features"]
+    if predictset:
+        schema = "features_{}".format(
+                    (test_end) 
+                        .strftime('%d%b%Y')).lower()
+        schemas.append(schema)
+    tables_and_columns = tables_and_columns_for_schemas(schemas)
+
+    #Train and test sets are built with a list of features, parsed from the
+    #configuration file. Every feature table is read once for inspections
+    #between start date and the end of the validation window, then split:
+    #train set has inspections until fake today, test set from fake today
+    #until the end of the validation window.
     #it is possible to select residential parcels only.
     #Data is obtained from features schema
-    train = dataset.get_training_dataset(
+    train, test = dataset.get_training_and_testing_datasets(
         features=features,
         start_date=start_date,
-        end_date=fake_today,
-        only_residential=only_residential)
-
-    #Test set is built in a similar way: list of features parsed from configuration
-    #file, but the start date is just where out trainin set finishes and the end date
-    #is the validation window. Residential flag also applies
-    #Data is obtained from features schema
-    test = dataset.get_testing_dataset(
-        features=features,
-        start_date=fake_today,
+        fake_today=fake_today,
         end_date=test_end,
-        only_residential=only_residential)
+        only_residential=only_residential,
+        tables_and_columns=tables_and_columns["features"])
 
     if not predictset:
         return train, test
     else:
-        schema = "features_{}".format(
-                    (test_end) 
-                        .strftime('%d%b%Y')).lower()
         preds = dataset.get_features_for_inspections_in_schema(
                 schema=schema,
                 features=features,
-                only_residential=only_residential)
+                only_residential=only_residential,
+                tables_and_columns=tables_and_columns[schema])
 
     return train, test, preds
 
@@ -182,12 +192,11 @@ def output_evaluation_statistics(test, predictions):
     evaluation.print_model_statistics(test.y, predictions_binary)
     evaluation.print_confusion_matrix(test.y, predictions_binary)
 
-    precision1 = precision_at(test.y, predictions, 0.01)
+    metrics = metrics_at_percents(test.y, predictions, [0.01, 0.1])
     logger.debug("Precision at 1%: {} (probability cutoff {})".format(
-                 round(precision1[0], 2), precision1[1]))
-    precision10 = precision_at(test.y, predictions, 0.1)
+                 round(metrics['precision'][0], 2), metrics['cutoff'][0]))
     logger.debug("Precision at 10%: {} (probability cutoff {})".format(
-                 round(precision10[0], 2), precision10[1]))
+                 round(metrics['precision'][1], 2), metrics['cutoff'][1]))
     #evaluation.plot_precision_at_varying_percent(test.y, predictions)
 
 def get_feature_importances(model):
@@ -206,35 +215,44 @@ def get_feature_importances(model):
 
 def log_predictions_on_all(preds, predictions_on_all, mongo_id, topx):
 
-    # Dump test_labels, test_predictions and test_parcels to a csv file
-    parcel_id = [record[0] for record in preds.parcels]
-    inspection_date = [record[1] for record in preds.parcels]
-    dump = pd.DataFrame({'parcel_id': parcel_id,
-                         'inspection_date': inspection_date,
-                         'prediction': predictions_on_all})
-
     # restrict to top X most risky predictions
-    dump = dump.sort_values(by='prediction', ascending=False)
-    dump = dump.head(int( pd.np.round( len(dump)*topx/100. ) ) )
+    top = np.argsort(-np.asarray(predictions_on_all), kind='mergesort')
+    top = top[:int(np.round(len(top)*topx/100.))]
+
+    # Save predictions in the prediction store
+    parcels = [preds.parcels[i] for i in top]
+    store = PredictionStore(path_to_top_predictions_on_all_parcels)
+    store.save(mongo_id, parcels, np.asarray(predictions_on_all)[top])
 
-    # Dump predictions to CSV
-    dump.to_csv(os.path.join(path_to_top_predictions_on_all_parcels, mongo_id))
+#Buffered MongoDB logger for each process, see get_mongo_logger
+mongo_loggers = {}
+
+def get_mongo_logger():
+    '''
+        Logger shared by every log_results call in this process, documents
+        are inserted in batches (see logger.buffer_size and
+        logger.flush_interval in config.yaml) and the rest are inserted
+        when the process exits
+    '''
+    pid = os.getpid()
+    if pid not in mongo_loggers:
+        cfg = cfg_main['logger']
+        mongo_loggers[pid] = Logger(cfg['uri'], cfg['db'], cfg['collection'],
+                                    buffer_size=cfg.get('buffer_size', 100),
+                                    flush_interval=cfg.get('flush_interval', 60))
+    return mongo_loggers[pid]
 
 def log_results(model, config, test, predictions, feature_importances,
-                imputer, scaler):
+                imputer, scaler, pickle=False):
     '''
         Log results to a MongoDB database
     '''
-    # Instantiate logger
-    logger_uri = cfg_main['logger']['uri']
-    logger_db = cfg_main['logger']['db']
-    logger_collection = cfg_main['logger']['collection']
-    mongo_logger = Logger(logger_uri, logger_db, logger_collection)
+    # Get this process' logger
+    mongo_logger = get_mongo_logger()
     # Compute some statistics to log
-    prec_at_1, cutoff_at_1 = precision_at(test.y, predictions, 0.01)
-    prec_at_5, cutoff_at_5 = precision_at(test.y, predictions, 0.05)
-    prec_at_10, cutoff_at_10 = precision_at(test.y, predictions, 0.1)
-    prec_at_20, cutoff_at_20 = precision_at(test.y, predictions, 0.2)
+    metrics = metrics_at_percents(test.y, predictions, [0.01, 0.05, 0.1, 0.2])
+    prec_at_1, prec_at_5, prec_at_10, prec_at_20 = map(float, metrics['precision'])
+    cutoff_at_1, cutoff_at_5, cutoff_at_10, cutoff_at_20 = map(float, metrics['cutoff'])
 
     # Add the name of the experiment if available
     experiment_name = (config["experiment_name"] if config["experiment_name"]
@@ -261,17 +279,11 @@ def log_results(model, config, test, predictions, feature_importances,
                                       # feature_importances=ft_imp)
 
 
-    # Dump test_labels, test_predictions and test_parcels to a csv file
-    parcel_id = [record[0] for record in test.parcels]
-    inspection_date = [record[1] for record in test.parcels]
-    dump = pd.DataFrame({'parcel_id': parcel_id,
-                         'inspection_date': inspection_date,
-                         'viol_outcome': test.y,
-                         'prediction': predictions})
-    # Dump predictions to CSV
-    dump.to_csv(os.path.join(path_to_predictions, mongo_id))
+    # Save test labels and predictions in the prediction store
+    store = PredictionStore(path_to_predictions)
+    store.save(mongo_id, test.parcels, predictions, labels=test.y)
     # Pickle model
-    if args.pickle:
+    if pickle:
         path_to_file = os.path.join(path_to_pickled_models, mongo_id)
         logger.info('Pickling model: {}'.format(path_to_file))
         joblib.dump(model, path_to_file)
@@ -287,44 +299,16 @@ def log_results(model, config, test, predictions, feature_importances,
     return mongo_id
 
 
-def main():
-
-    if args.warninglog:
-        myhandler = logging.FileHandler(os.path.abspath(args.warninglog))
-        myhandler.setLevel('WARNING')
-        logger.addHandler(myhandler)
-    if args.debuglog:
-        myhandler2 = logging.FileHandler(os.path.abspath(args.debuglog))
-        myhandler2.setLevel('DEBUG')
-        logger.addHandler(myhandler2)
-
-    config_file = args.path_to_config_file
-    config, config_raw = configure_model(config_file)
-
-    if args.predicttop and args.notlog:
-        raise ValueError("You cannot save the top X predictions "
-                "on all parcels without also logging.")
-
-    #If logging is enabled, check that there are no records for
-    #the selected experiment
-    if not args.notlog:
-
-        logger_uri = cfg_main['logger']['uri']
-        logger_db = cfg_main['logger']['db']
-        logger_collection = cfg_main['logger']['collection']
-        mongo_logger = Logger(logger_uri, logger_db, logger_collection)
-
-        if mongo_logger.experiment_exists(config['experiment_name']):
-
-            # if the user hasn't selected to overwrite the record, throw error
-            if not args.overwritelog:
-                raise ExperimentExists(config['experiment_name'])
-            else:
-                mongo_logger.delete_experiment(config['experiment_name'])
-
+def prepare_datasets(config, predicttop=False, dump=False):
+    """
+    Load train and test sets (and the prediction set if predicttop),
+    check NAs, dump them if selected, then impute and scale them.
+    Returns train, test, preds (None if not predicttop), imputer and scaler
+    """
     # datasets
     logger.info('Loading datasets...')
-    if not args.predicttop:
+    preds = None
+    if not predicttop:
         train, test  = make_datasets(config, predictset=False)
         logger.debug('Train x shape: {} Test x shape: {}'.format(train.x.shape,
             test.x.shape))
@@ -344,11 +328,11 @@ def main():
     logger.debug(prop)
 
     # Dump datasets if dump option was selected
-    if args.dump:
+    if dump:
         logger.info('Dumping train and tests sets')
         datasets = [(train, 'train'), 
                     (test, 'test')]
-        if args.predicttop:
+        if predicttop:
             logger.info('Dumping prediction sets')
             datasets.append((preds, 'prediction'))
         for data, name in datasets:
@@ -373,7 +357,7 @@ def main():
     test.x = imputer.transform(test.x)
     logger.debug('Train x shape: {} Test x shape: {}'.format(train.x.shape,
         test.x.shape))
-    if args.predicttop:
+    if predicttop:
         preds.x = imputer.transform(preds.x)
         logger.debug('Prediction x shape: {}'.format(preds.x.shape))
 
@@ -384,10 +368,142 @@ def main():
     test.x = scaler.transform(test.x)
     logger.debug('Train x shape: {} Test x shape: {}'.format(train.x.shape,
         test.x.shape))
-    if args.predicttop:
+    if predicttop:
         preds.x = scaler.transform(preds.x)
         logger.debug('Prediction x shape: {}'.format(preds.x.shape))
 
+    return train, test, preds, imputer, scaler
+
+def fit_model(model, config, config_raw, train, test, preds, imputer, scaler,
+              n_jobs=-1, notlog=False, pickle=False, predicttop=None):
+    """
+    Train model, evaluate it on the test set and log the results
+    (unless notlog). Returns the id in MongoDB (None if not logged)
+    """
+    #Try to run in parallel if possible
+    if hasattr(model, 'n_jobs'):
+        model.set_params(n_jobs=n_jobs)
+
+    #SVC does not predict probabilities by default
+    if hasattr(model, 'probability'):
+        model.probability = True
+
+    # train
+    model.fit(train.x, train.y)
+
+    # predict
+    logger.info("Predicting on validation samples...")
+    predicted = model.predict_proba(test.x)
+    predicted = predicted[:, 1]  # probability that label is 1
+
+    # statistics
+    output_evaluation_statistics(test, predicted)
+    feature_importances = get_feature_importances(model)
+
+    # predict on all parcels, if selected
+    if predicttop:
+        predicted_on_all = model.predict_proba(preds.x)[:,1]
+
+    # save results
+    config_raw["parameters"] = model.get_params()
+
+    #Log depending on user selection
+    if notlog:
+        logger.info("You selected not to log results. Skipping...")
+        return None
+
+    #Log parameters and metrics to MongoDB
+    #Save predictions to CSV file
+    #and pickle model
+    model_id = log_results(model, config_raw, test, predicted,
+        feature_importances, imputer, scaler, pickle)
+    if predicttop:
+        # rank by risk, only keep the top X %
+        log_predictions_on_all(preds, predicted_on_all, 
+                               model_id, float(predicttop))
+    return model_id
+
+def fit_model_in_worker(task):
+    model, n_jobs, config, config_raw, datasets, imputer, scaler, options = task
+    train, test, preds = [parallel.load_memmapped(d) for d in datasets]
+    logger.info("Training {} (n_jobs={})".format(model, n_jobs))
+    return fit_model(model, config, config_raw, train, test, preds, imputer,
+                     scaler, n_jobs=n_jobs, **options)
+
+def fit_models_in_parallel(models, cores, config, config_raw, train, test,
+                           preds, imputer, scaler, **options):
+    """
+    Train models in worker processes using at most cores, see
+    parallel.plan_parallelism. Workers open train, test and prediction
+    matrices as memory maps instead of getting a copy of them
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        datasets = parallel.memmap_datasets([train, test, preds], folder)
+        for group, workers, n_jobs in parallel.plan_parallelism(models, cores):
+            logger.info(("Training {} models in {} processes "
+                         "(n_jobs={})").format(len(group), workers, n_jobs))
+            tasks = [(model, n_jobs, config, config_raw, datasets, imputer,
+                      scaler, options) for model in group]
+            pool = Pool(workers)
+            try:
+                pool.map(fit_model_in_worker, tasks, chunksize=1)
+                #Let workers exit normally, so they insert their
+                #buffered MongoDB documents
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+    finally:
+        shutil.rmtree(folder)
+
+def check_experiment_is_new(config, overwritelog):
+    """
+    Raise ExperimentExists if there are records for the experiment in
+    MongoDB, if overwritelog, delete them instead
+    """
+    logger_uri = cfg_main['logger']['uri']
+    logger_db = cfg_main['logger']['db']
+    logger_collection = cfg_main['logger']['collection']
+    mongo_logger = Logger(logger_uri, logger_db, logger_collection)
+
+    if mongo_logger.experiment_exists(config['experiment_name']):
+
+        # if the user hasn't selected to overwrite the record, throw error
+        if not overwritelog:
+            raise ExperimentExists(config['experiment_name'])
+        else:
+            mongo_logger.delete_experiment(config['experiment_name'])
+
+def main():
+
+    if args.warninglog:
+        myhandler = logging.FileHandler(os.path.abspath(args.warninglog))
+        myhandler.setLevel('WARNING')
+        logger.addHandler(myhandler)
+    if args.debuglog:
+        myhandler2 = logging.FileHandler(os.path.abspath(args.debuglog))
+        myhandler2.setLevel('DEBUG')
+        logger.addHandler(myhandler2)
+
+    config_file = args.path_to_config_file
+    config, config_raw = configure_model(config_file)
+
+    if args.predicttop and args.notlog:
+        raise ValueError("You cannot save the top X predictions "
+                "on all parcels without also logging.")
+
+    #If logging is enabled, check that there are no records for
+    #the selected experiment
+    if not args.notlog:
+        check_experiment_is_new(config, args.overwritelog)
+
+    train, test, preds, imputer, scaler = prepare_datasets(config,
+                                            predicttop=args.predicttop,
+                                            dump=args.dump)
+
     #Get size of grids
     grid_size = config["grid_size"]
     #Get list of models selected
@@ -398,6 +514,13 @@ def main():
     if args.shufflemodels:
         random.shuffle(models)
 
+    if args.cores:
+        fit_models_in_parallel(models, args.cores, config, config_raw, train,
+                               test, preds, imputer, scaler,
+                               notlog=args.notlog, pickle=args.pickle,
+                               predicttop=args.predicttop)
+        return
+
     # fit each model for all of these
     idx = 0
     len_models = len(models)
@@ -406,52 +529,12 @@ def main():
 
         model = models.pop()
 
-        #Try to run in parallel if possible
-        if hasattr(model, 'n_jobs'):
-            model.set_params(n_jobs=args.n_jobs)
-
-        #SVC does not predict probabilities by default
-        if hasattr(model, 'probability'):
-            model.probability = True
-
-        timestamp = datetime.datetime.now().isoformat()
-
-        # train
         logger.info("{} out of {} - Training {}".format(idx+1,
                                                         len_models,
                                                         model))
-        model.fit(train.x, train.y)
-
-        # predict
-        logger.info("Predicting on validation samples...")
-        predicted = model.predict_proba(test.x)
-        predicted = predicted[:, 1]  # probability that label is 1
-
-        # statistics
-        output_evaluation_statistics(test, predicted)
-        feature_importances = get_feature_importances(model)
-
-        # predict on all parcels, if selected
-        if args.predicttop:
-            predicted_on_all = model.predict_proba(preds.x)[:,1]
-
-        # save results
-        prefix = config["experiment_name"] if config["experiment_name"] else ''
-        config_raw["parameters"] = model.get_params()
-        
-        #Log depending on user selection
-        if args.notlog:
-            logger.info("You selected not to log results. Skipping...")
-        else:
-            #Log parameters and metrics to MongoDB
-            #Save predictions to CSV file
-            #and pickle model
-            model_id = log_results(model, config_raw, test, predicted,
-                feature_importances, imputer, scaler)
-            if args.predicttop:
-                # rank by risk, only keep the top X %
-                log_predictions_on_all(preds, predicted_on_all, 
-                                       model_id, float(args.predicttop))
+        fit_model(model, config, config_raw, train, test, preds, imputer,
+                  scaler, n_jobs=args.n_jobs, notlog=args.notlog,
+                  pickle=args.pickle, predicttop=args.predicttop)
         idx += 1
         del model
 
@@ -465,6 +548,11 @@ if __name__ == '__main__':
                             help=("n_jobs flag passed to scikit-learn models, "
                                   "fails silently if the model does not support "
                                   "such flag. Defaults to -1 (all jobs possible)"))
+    parser.add_argument("-co", "--cores", type=int, default=None,
+                        help=("Train several models at the same time using "
+                              "at most this number of cores, split between "
+                              "worker processes and the n_jobs flag of "
+                              "models (--n_jobs is ignored)"))
     parser.add_argument("-nl", "--notlog", action="store_true",
                         help="Do not log results to MongoDB")
     parser.add_argument("-ol", "--overwritelog", action="store_true",
@@ -3,10 +3,12 @@ import argparse
 from string import Template
 import os
 from lib_cinci.config import main as cfg
+from lib_cinci import parcel_graph
 from sqlalchemy import create_engine
 import psycopg2
 
 def main():
+    parcel_graph.check_max_dist(args.maxdist)
     table_name = 'neighborhood_score_{}m_{}months'.format(args.maxdist,
       args.months)
     print 'Creating {} table...'.format(table_name)
@@ -16,16 +18,16 @@ def main():
         'neighborhood_score.template.sql')
     with open(path_to_template, 'r') as f:
         sql_script = Template(f.read())
-    #Convert max_dist to survey foot, since those are the units in the
-    #database
-    max_dist_foot = args.maxdist * 3.281
-    #Replace with values: schema, table_name, max_dist_foot, n_months
+    #Replace with values: schema, table_name, graph, max_dist, n_months
     sql_script = sql_script.substitute(schema=args.schema, table_name=table_name,
-        max_dist_foot=max_dist_foot, n_months=args.months)
+        graph=parcel_graph.GRAPH_TABLE, max_dist=args.maxdist,
+        n_months=args.months)
     #Run on DB
     db = cfg['db']
     con = psycopg2.connect(dbname=db['database'], host=db['host'],
       user=db['user'], password=db['password'])
+    #Parcels nearby are taken from the parcel graph, build it if needed
+    parcel_graph.make_parcel_graph(con)
     cur = con.cursor()
     cur.execute(sql_script)
     con.commit()
@@ -7,27 +7,14 @@
 DROP TABLE IF EXISTS ${schema}.${table_name};
 
 CREATE TABLE ${schema}.${table_name} AS(
-    --First: attach geometry column to parcels_inspections table
-    --in the current schema
-    WITH schema_inspections_location AS(
-        SELECT insp.*, parcels.geom
-        FROM ${schema}.parcels_inspections AS insp
-        JOIN shape_files.parcels_cincy AS parcels
-        ON insp.parcel_id=parcels.parcelid
-    ),
-    --Do the same for the parcels_inspections table but in the features
-    --schema, since this table contains the labels
-    real_inspections_location AS(
-        SELECT insp.*, parcels.geom
-        FROM features.parcels_inspections AS insp
-        JOIN shape_files.parcels_cincy AS parcels
-        ON insp.parcel_id=parcels.parcelid
-    ),
-
-    --Second: find inspections pairs that
+    --First: find inspections pairs that
     --ocurred within certain distance and time window
     --store the status of the second parcel
-    matches AS (
+    --parcels within max_dist are taken from the parcel graph
+    --(see lib_cinci/parcel_graph.py), the inspections in the
+    --features schema are used for the second parcel, since that
+    --table contains the labels
+    WITH matches AS (
         --grab parcel_id and inspection_date for both
         --parcels, but only the outcome for the second one
         SELECT parcels_a.parcel_id AS parcel_id,
@@ -35,9 +22,12 @@ CREATE TABLE ${schema}.${table_name} AS(
                parcels_b.parcel_id AS parcel_id_b,
                parcels_b.inspection_date AS inspection_date_b,
                parcels_b.viol_outcome AS viol_outcome
-        FROM schema_inspections_location AS parcels_a
-        JOIN real_inspections_location AS parcels_b
-        ON ST_DWithin(parcels_a.geom, parcels_b.geom, ${max_dist_foot})
+        FROM ${schema}.parcels_inspections AS parcels_a
+        JOIN ${graph} AS neighbours
+        ON neighbours.parcel_id = parcels_a.parcel_id
+        AND neighbours.dist_m <= ${max_dist}
+        JOIN features.parcels_inspections AS parcels_b
+        ON parcels_b.parcel_id = neighbours.neighbour_id
         AND (parcels_a.inspection_date - '${n_months} month'::interval) <= parcels_b.inspection_date
         AND parcels_b.inspection_date < parcels_a.inspection_date
     ),
@@ -87,21 +77,13 @@ CREATE TABLE ${schema}.${table_name} AS(
     
     --select * from counts
         
-    --Get geometric column for the unique parcels in counts
-    parcels_cincy_subset AS(
-        SELECT parcelid, geom
-            FROM shape_files.parcels_cincy
-            WHERE parcelid IN (SELECT DISTINCT parcel_id  FROM counts)
-    ),
-
-    --for those parcels, count the number of parcels nearby using
-    --the table containing all parcels in cincinnati
-    --(shape_files.parcels_cincy)
+    --for the parcels in counts, count the number of parcels nearby
+    --(the parcel itself included) using the parcel graph
     parcels_nearby AS (
-        SELECT parcels_a.parcelid AS parcel_id, COUNT(*) AS houses
-        FROM parcels_cincy_subset AS parcels_a
-        JOIN shape_files.parcels_cincy AS parcels_b
-        ON ST_DWithin(parcels_a.geom, parcels_b.geom, ${max_dist_foot})
+        SELECT parcel_id, COUNT(*) AS houses
+        FROM ${graph}
+        WHERE dist_m <= ${max_dist}
+        AND parcel_id IN (SELECT DISTINCT parcel_id FROM counts)
         GROUP BY parcel_id
     ),
     
@@ -0,0 +1,55 @@
+#Helpers to train several models at the same time in worker processes
+#(see fit_models_in_parallel in model.py)
+import os
+import copy
+
+import numpy as np
+
+def plan_parallelism(models, cores):
+    '''
+        Split a budget of cores between model-level (worker processes) and
+        estimator-level (n_jobs) parallelism. Models that do not support
+        n_jobs get one core each, models that do get the cores that are
+        left when there are less models than cores.
+
+        Returns a list of (models, workers, n_jobs) tuples, one for models
+        without n_jobs and one for models with it (empty groups are
+        skipped)
+    '''
+    single = [m for m in models if not hasattr(m, 'n_jobs')]
+    multi = [m for m in models if hasattr(m, 'n_jobs')]
+    plan = []
+    if single:
+        plan.append((single, min(cores, len(single)), 1))
+    if multi:
+        workers = min(cores, len(multi))
+        plan.append((multi, workers, max(1, cores // workers)))
+    return plan
+
+def memmap_datasets(datasets, folder):
+    '''
+        Save the feature matrix (x) of every dataset in folder, returns
+        copies of datasets where x is the path to the .npy file, so they
+        can be sent to workers without copying the matrices.
+        None datasets are returned as they are
+    '''
+    shared = []
+    for i, dataset in enumerate(datasets):
+        if dataset is not None:
+            path = os.path.join(folder, '{}.npy'.format(i))
+            np.save(path, np.asarray(dataset.x))
+            dataset = copy.copy(dataset)
+            dataset.x = path
+        shared.append(dataset)
+    return shared
+
+def load_memmapped(dataset):
+    '''
+        Inverse of memmap_datasets (for a single dataset), x is opened
+        as a read-only memory map
+    '''
+    if dataset is None or not isinstance(dataset.x, basestring):
+        return dataset
+    dataset = copy.copy(dataset)
+    dataset.x = np.load(dataset.x, mmap_mode='r')
+    return dataset
@@ -0,0 +1,98 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from features import feature_utils
+
+
+def make_pairs_and_events(seed=0, n_inspections=30, n_events=200, n_pairs=600):
+    rng = np.random.RandomState(seed)
+    events = pd.DataFrame({'id': np.arange(n_events),
+                           'kind': rng.choice(['a', 'b', 'c', None], n_events),
+                           'value': rng.normal(size=n_events)}).set_index('id')
+    events.loc[rng.rand(n_events) < 0.2, 'value'] = np.nan
+    inspection = rng.randint(0, n_inspections, n_pairs)
+    pairs = pd.DataFrame({'parcel_id': ['p{}'.format(i % 10) for i in inspection],
+                          'inspection_date': pd.to_datetime('2015-01-01') +
+                                             pd.to_timedelta(inspection // 10, unit='D'),
+                          'id': rng.randint(0, n_events, n_pairs)})
+    return pairs, events
+
+
+class TestAggregateEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.pairs, self.events = make_pairs_and_events()
+        self.joined = self.pairs.join(self.events, on='id')
+        self.grouped = self.joined.groupby(['parcel_id', 'inspection_date'])
+
+    def test_counts_by_level(self):
+        df = feature_utils.aggregate_events(self.pairs, self.events,
+                                            categories={'kind': ['a', 'b']})
+        expected = pd.crosstab([self.joined.parcel_id, self.joined.inspection_date],
+                               self.joined.kind)
+        assert_array_equal(df.total, self.grouped.size().values)
+        assert_array_equal(df.kind_a, expected.a.reindex(df.index).fillna(0))
+        assert_array_equal(df.kind_b, expected.b.reindex(df.index).fillna(0))
+        self.assertEqual(list(df.columns), ['total', 'kind_a', 'kind_b'])
+
+    def test_aggregates_ignore_nulls(self):
+        aggregates = [(function, 'value', function)
+                      for function in feature_utils.AGGREGATES]
+        df = feature_utils.aggregate_events(self.pairs, self.events,
+                                            aggregates=aggregates)
+        value = self.grouped.value
+        assert_array_almost_equal(df['sum'], value.sum().fillna(0))
+        assert_array_almost_equal(df['avg'], value.mean())
+        assert_array_almost_equal(df['max'], value.max())
+        assert_array_almost_equal(df['min'], value.min())
+        assert_array_almost_equal(df['stddev'], value.std())
+
+    def test_inspection_without_values(self):
+        pairs = pd.DataFrame({'parcel_id': ['p1', 'p2', 'p2'],
+                              'inspection_date': pd.to_datetime(['2015-01-01']*3),
+                              'id': [0, 1, 2]})
+        events = pd.DataFrame({'value': [np.nan, 1.0, 3.0]}, index=[0, 1, 2])
+        df = feature_utils.aggregate_events(pairs, events,
+                                            aggregates=[('avg', 'value', 'avg'),
+                                                        ('max', 'value', 'max'),
+                                                        ('stddev', 'value', 'stddev')])
+        assert_array_equal(df.total, [1, 2])
+        assert_array_almost_equal(df.avg, [np.nan, 2.0])
+        assert_array_almost_equal(df['max'], [np.nan, 3.0])
+        assert_array_almost_equal(df.stddev, [np.nan, np.sqrt(2)])
+
+    def test_column_names_are_cleaned(self):
+        events = pd.DataFrame({'kind': ['Trash Pickup']}, index=[0])
+        pairs = pd.DataFrame({'parcel_id': ['p1'], 'id': [0],
+                              'inspection_date': pd.to_datetime(['2015-01-01'])})
+        df = feature_utils.aggregate_events(pairs, events,
+                                            categories={'kind': ['Trash Pickup', 'other']})
+        self.assertEqual(list(df.columns), ['total', 'kind_trash_pickup', 'kind_other'])
+        assert_array_equal(df.values, [[1, 1, 0]])
+
+    def test_no_pairs(self):
+        pairs = self.pairs.iloc[:0]
+        df = feature_utils.aggregate_events(pairs, self.events,
+                                            categories={'kind': ['a', 'b']},
+                                            aggregates=[('avg', 'value', 'avg')])
+        self.assertEqual(len(df), 0)
+        self.assertEqual(list(df.columns), ['total', 'avg', 'kind_a', 'kind_b'])
+        self.assertEqual(list(df.index.names), ['parcel_id', 'inspection_date'])
+
+
+class TestCaseWhenColumns(unittest.TestCase):
+
+    def test_one_expression_per_level(self):
+        columns = feature_utils.case_when_columns('e.event', ['closed', "owner's"])
+        self.assertEqual(columns, [
+            'sum(CASE WHEN e.event = \'closed\' THEN 1 ELSE 0 END) AS "closed"',
+            'sum(CASE WHEN e.event = \'owner\'\'s\' THEN 1 ELSE 0 END) AS "owner\'s"'])
+
+    def test_template_and_name(self):
+        columns = feature_utils.case_when_columns('code', [9999],
+                                                  template='avg({case})',
+                                                  name='code_{level}')
+        self.assertEqual(columns, ['avg(CASE WHEN code = 9999 THEN 1 ELSE 0 END) AS "code_9999"'])
@@ -218,3 +218,18 @@ class TestCrimeAgg(unittest.TestCase):
 
         self.assert_array_almost_equal(expected, actual)
         assert_array_equal(expected, actual)
+
+    def test_crime_in_month_before_inspection(self):
+        crimes = [("16Dec2014", "tract567", 3),
+                  ("02Jan2015", "tract567", 5)]
+        parcels = [("parcelA", "10Jan2015", "tract567")]
+        population = [("tract567", 1234)]
+        window = datetime.timedelta(days=365)
+
+        expected = [("parcelA", date("10Jan2015"), 3 / float(1234))]
+
+        actual = crime_agg.crimerate_in_aggregation_area(self.make_parcels_df(parcels), self.make_crimerate_df(crimes),
+                                       self.make_population_df(population), window)
+        actual = actual.reset_index()[["parcel_id", "inspection_date", "crime_rate"]].values
+
+        self.assert_array_almost_equal(expected, actual)
@@ -0,0 +1,70 @@
+import datetime
+import unittest
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal
+
+from features import ner
+
+YEARS = range(2007, 2016)
+
+
+# Row-wise implementation the vectorized one replaced, used as reference
+def reference_owner_features(df):
+    df = df.copy()
+    for year in ['20' + str(x).zfill(2) for x in range(5, 16)]:
+        indices_this_year = df.inspection_date.dt.year == int(year)
+        year_range = range(int(year[2:]) - 3, int(year[2:]))
+        if int(year) == 2008:
+            num_org = df[["owner_2007", "parcel_id"]]
+        elif int(year) == 2009:
+            num_org = df[["owner_2007", "owner_2008"]]
+        elif int(year) >= 2010:
+            num_org = df[['owner_20' + str(y).zfill(2) for y in year_range]]
+        else:
+            df.ix[indices_this_year, "owner_ner"] = np.nan
+            continue
+        computation = num_org.apply(lambda row:
+                                    len(row[row == 'ORGANIZATION']), axis=1)
+        df.ix[indices_this_year, "owner_ner"] = computation
+    df.set_index(['inspection_date', 'parcel_id'], inplace=True)
+    return df['owner_ner']
+
+
+class TestOwnerFeatures(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        n_parcels, n_inspections = 50, 400
+        owners = pd.DataFrame(rng.choice(['ORGANIZATION', 'PERSON', None],
+                                         size=(n_parcels, len(YEARS))),
+                              columns=['owner_{}'.format(y) for y in YEARS])
+        owners['parcel_id'] = ['p%d' % i for i in range(n_parcels)]
+        self.owners = owners
+        dates = [datetime.datetime(2005, 1, 1) + datetime.timedelta(days=int(d))
+                 for d in rng.randint(0, 365*11, n_inspections)]
+        #some inspections for parcels without owner data
+        self.inspections = pd.DataFrame({
+            'parcel_id': ['p%d' % i for i in rng.randint(0, n_parcels + 5,
+                                                        n_inspections)],
+            'inspection_date': dates})
+
+    def test_same_as_row_wise(self):
+        joined = self.inspections.merge(self.owners, on='parcel_id')
+        expected = reference_owner_features(joined)
+        actual = ner.organization_owned_years(self.inspections, self.owners)
+        actual = actual.reindex(expected.index)
+        assert_array_equal(expected.values.astype(float), actual.values)
+
+    def test_years_after_last_owner_year(self):
+        owners = pd.DataFrame({'parcel_id': ['a'],
+                               'owner_2014': ['ORGANIZATION'],
+                               'owner_2015': ['ORGANIZATION']})
+        inspections = pd.DataFrame({
+            'parcel_id': ['a', 'a', 'a'],
+            'inspection_date': [datetime.date(2016, 5, 1),
+                                datetime.date(2018, 5, 1),
+                                datetime.date(2019, 5, 1)]})
+        actual = ner.organization_owned_years(inspections, owners)
+        assert_array_equal(actual.values, [2, 1, np.nan])
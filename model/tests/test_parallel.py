@@ -0,0 +1,57 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal
+from sklearn.ensemble import RandomForestClassifier, AdaBoostClassifier
+
+import parallel
+from lib_cinci.dataset import Dataset
+
+
+class TestPlanParallelism(unittest.TestCase):
+
+    def test_models_without_n_jobs_get_one_core(self):
+        models = [AdaBoostClassifier() for i in range(10)]
+        plan = parallel.plan_parallelism(models, 4)
+        self.assertEqual([(models, 4, 1)], plan)
+
+    def test_cores_left_go_to_n_jobs(self):
+        models = [RandomForestClassifier() for i in range(3)]
+        plan = parallel.plan_parallelism(models, 12)
+        self.assertEqual([(models, 3, 4)], plan)
+
+    def test_mixed_models(self):
+        single = [AdaBoostClassifier()]
+        multi = [RandomForestClassifier() for i in range(8)]
+        plan = parallel.plan_parallelism(multi + single, 4)
+        self.assertEqual([(single, 1, 1), (multi, 4, 1)], plan)
+
+
+class TestMemmapDatasets(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        train = Dataset([('a', 1), ('b', 2), ('c', 3), ('d', 4)],
+                        pd.DataFrame(np.zeros((4, 3))),
+                        np.array([0, 1, 0, 1]), [])
+        #After imputation and scaling x is a numpy array
+        x = np.arange(12, dtype=float).reshape(4, 3)
+        train.x = x
+        shared = parallel.memmap_datasets([train, None], self.folder)
+        self.assertTrue(isinstance(shared[0].x, basestring))
+        self.assertIsNone(shared[1])
+        #Original dataset is not modified
+        self.assertIs(x, train.x)
+
+        loaded = parallel.load_memmapped(shared[0])
+        self.assertTrue(isinstance(loaded.x, np.memmap))
+        assert_array_equal(x, loaded.x)
+        assert_array_equal(train.y, loaded.y)
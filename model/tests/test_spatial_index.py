@@ -0,0 +1,104 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from features import feature_utils
+from lib_cinci.test_utils import timestamp
+
+
+def brute_force_neighbours(inspections, events, n_months, max_dist):
+    rows = []
+    for _, insp in inspections.iterrows():
+        start = insp.inspection_date - pd.DateOffset(months=n_months)
+        for _, event in events.iterrows():
+            dist_m = np.sqrt((insp.x-event.x)**2 + (insp.y-event.y)**2)/feature_utils.FOOT_PER_METER
+            if dist_m <= max_dist and start <= event.event_date < insp.inspection_date:
+                rows.append((insp.parcel_id, insp.inspection_date, dist_m, event.id))
+    return pd.DataFrame(rows, columns=['parcel_id', 'inspection_date', 'dist_m', 'id'])
+
+
+def sort_neighbours(df):
+    return df.sort_values(['parcel_id', 'inspection_date', 'id']).reset_index(drop=True)
+
+
+class TestFindNeighbours(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        rng = np.random.RandomState(0)
+        n_parcels, n_events = 40, 300
+        parcels = pd.DataFrame({'parcel_id': ['p{}'.format(i) for i in range(n_parcels)],
+                                'x': rng.uniform(0, 20000, n_parcels),
+                                'y': rng.uniform(0, 20000, n_parcels)})
+        #Every parcel gets two inspections
+        dates = pd.date_range('2014-01-31', periods=2*n_parcels, freq='W')
+        inspections = pd.concat([parcels, parcels], ignore_index=True)
+        inspections['inspection_date'] = dates
+        events = pd.DataFrame({'id': np.arange(n_events),
+                               'x': rng.uniform(0, 20000, n_events),
+                               'y': rng.uniform(0, 20000, n_events),
+                               'event_date': pd.Timestamp('2013-10-01') +
+                                    pd.to_timedelta(rng.randint(0, 600, n_events), unit='D')})
+
+        expected = sort_neighbours(brute_force_neighbours(inspections, events, 3, 1000))
+        actual = sort_neighbours(feature_utils.find_neighbours(inspections, events, 3, 1000,
+                                                               chunksize=7))
+        self.assertTrue(len(expected) > 0)
+        assert_array_equal(expected.parcel_id.values, actual.parcel_id.values)
+        assert_array_equal(expected.inspection_date.values, actual.inspection_date.values)
+        assert_array_equal(expected.id.values, actual.id.values)
+        assert_array_almost_equal(expected.dist_m.values, actual.dist_m.values)
+
+    def test_date_window(self):
+        inspections = pd.DataFrame([['a', timestamp('31May2015'), 0.0, 0.0]],
+                                   columns=['parcel_id', 'inspection_date', 'x', 'y'])
+        #Same as Postgres: 31May2015 - '3 month' is 28Feb2015, the window
+        #includes the start and excludes the inspection date
+        events = pd.DataFrame([[1, timestamp('27Feb2015'), 0.0, 0.0],
+                               [2, timestamp('28Feb2015'), 0.0, 0.0],
+                               [3, timestamp('30May2015'), 0.0, 0.0],
+                               [4, timestamp('31May2015'), 0.0, 0.0]],
+                              columns=['id', 'event_date', 'x', 'y'])
+        actual = feature_utils.find_neighbours(inspections, events, 3, 1000)
+        assert_array_equal([2, 3], sorted(actual.id.values))
+
+    def test_max_dist(self):
+        inspections = pd.DataFrame([['a', timestamp('01Jun2015'), 0.0, 0.0]],
+                                   columns=['parcel_id', 'inspection_date', 'x', 'y'])
+        feet = feature_utils.FOOT_PER_METER
+        events = pd.DataFrame([[1, timestamp('01May2015'), 100*feet, 0.0],
+                               [2, timestamp('01May2015'), 0.0, 101*feet]],
+                              columns=['id', 'event_date', 'x', 'y'])
+        actual = feature_utils.find_neighbours(inspections, events, 3, 100)
+        assert_array_equal([1], actual.id.values)
+        assert_array_almost_equal([100.0], actual.dist_m.values)
+
+    def test_no_events(self):
+        inspections = pd.DataFrame([['a', timestamp('01Jun2015'), 0.0, 0.0]],
+                                   columns=['parcel_id', 'inspection_date', 'x', 'y'])
+        events = pd.DataFrame([], columns=['id', 'event_date', 'x', 'y'])
+        actual = feature_utils.find_neighbours(inspections, events, 3, 100)
+        self.assertEqual(0, len(actual))
+        self.assertEqual(['parcel_id', 'inspection_date', 'dist_m', 'id'],
+                         list(actual.columns))
+
+
+class TestNeighbourWindows(unittest.TestCase):
+
+    def tearDown(self):
+        feature_utils.set_neighbour_windows([3], [1000])
+
+    def test_single_window_does_not_use_base_table(self):
+        feature_utils.set_neighbour_windows([3], [1000])
+        self.assertFalse(feature_utils.use_base_table(3, 1000))
+
+    def test_base_table_covers_every_combination(self):
+        feature_utils.set_neighbour_windows([12, 3], [50, 400, 1000])
+        self.assertEqual('insp2crime_3to12months_1000m',
+                         feature_utils.base_table_name('crime'))
+        for months in [3, 12]:
+            for dist in [50, 400, 1000]:
+                self.assertTrue(feature_utils.use_base_table(months, dist))
+        self.assertFalse(feature_utils.use_base_table(24, 1000))
+        self.assertFalse(feature_utils.use_base_table(3, 2000))
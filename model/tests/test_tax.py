@@ -0,0 +1,94 @@
+import datetime
+import unittest
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+from features import tax
+
+
+# Row-wise implementation the vectorized one replaced, used as reference
+def reference_value_changes(group, relative=False):
+    first_year = group["taxyear"].argmin()
+    last_year = group["taxyear"].argmax()
+    names = ["change_market_value", "change_land_value", "change_impr_value"]
+    if relative:
+        names = ["rel_" + n for n in names]
+
+    if first_year == last_year:
+        return pd.Series(dict((n, np.nan) for n in names))
+
+    first_year_values = group.loc[first_year][tax.VALUE_COLUMNS]
+    last_year_values = group.loc[last_year][tax.VALUE_COLUMNS]
+    value_changes = (last_year_values - first_year_values)
+    if relative:
+        value_changes = value_changes / first_year_values
+        value_changes = value_changes.replace([np.inf, -np.inf], np.nan)
+    return pd.Series(dict(zip(names, value_changes.values)))
+
+
+def reference_foreclosures(group):
+    group = group["foreclosure"].replace({True: 1.0, False: 0.0})
+    return pd.Series({"tax_foreclosure": group.sum()})
+
+
+class TestTaxFeatures(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        n = 600
+        dates = [datetime.date(2014, 1, 1) + datetime.timedelta(days=int(d))
+                 for d in rng.randint(0, 5, n)]
+        values = pd.DataFrame({
+            "parcel_id": ["p%d" % i for i in rng.randint(0, 60, n)],
+            "inspection_date": dates,
+            "taxyear": rng.randint(2010, 2014, n),
+            "mkt_total_val": rng.randint(0, 4, n) * 1000.0,
+            "mkt_land_val": rng.randint(0, 4, n) * 100.0,
+            "mkt_impr_val": rng.randint(0, 4, n) * 10.0})
+        # some missing values
+        values.loc[rng.rand(n) < 0.05, "mkt_land_val"] = np.nan
+        self.values = values.set_index(["parcel_id", "inspection_date"])
+        self.foreclosures = pd.DataFrame({
+            "parcel_id": values.parcel_id,
+            "inspection_date": values.inspection_date,
+            "year": values.taxyear,
+            "foreclosure": rng.rand(n) < 0.3}).set_index(["parcel_id",
+                                                          "inspection_date"])
+
+    def grouped(self, df):
+        return df.reset_index().groupby(["parcel_id", "inspection_date"])
+
+    def test_value_changes_same_as_row_wise(self):
+        first, last = tax.first_and_last_year_values(self.values)
+        expected = self.grouped(self.values).apply(reference_value_changes)
+        actual = tax.calculate_value_changes(first, last)
+        assert_frame_equal(expected, actual[expected.columns],
+                           check_dtype=False, check_names=False)
+
+    def test_relative_value_changes_same_as_row_wise(self):
+        first, last = tax.first_and_last_year_values(self.values)
+        expected = self.grouped(self.values).apply(reference_value_changes,
+                                                   relative=True)
+        actual = tax.calculate_relative_value_changes(first, last)
+        assert_frame_equal(expected, actual[expected.columns],
+                           check_dtype=False, check_names=False)
+
+    def test_foreclosures_same_as_row_wise(self):
+        expected = self.grouped(self.foreclosures).apply(reference_foreclosures)
+        actual = tax.count_foreclosed_years(self.foreclosures)
+        assert_frame_equal(expected, actual, check_dtype=False,
+                           check_names=False)
+
+    def test_one_tax_year_is_nan(self):
+        values = pd.DataFrame({"parcel_id": ["a", "a"],
+                               "inspection_date": [datetime.date(2014, 1, 1)]*2,
+                               "taxyear": [2012, 2012],
+                               "mkt_total_val": [1.0, 2.0],
+                               "mkt_land_val": [1.0, 2.0],
+                               "mkt_impr_val": [1.0, 2.0]})
+        values = values.set_index(["parcel_id", "inspection_date"])
+        first, last = tax.first_and_last_year_values(values)
+        self.assertTrue(tax.calculate_value_changes(first, last).isnull()
+                        .values.all())
@@ -10,8 +10,9 @@ import dateutil
 from dateutil.relativedelta import relativedelta
 from lib_cinci.evaluation import load_one_inspection_per_parcel 
 from lib_cinci.config import load, get_config_parameters 
-from sklearn_evaluation.metrics import precision_at
+from sklearn_evaluation.metrics import metrics_at_percents_for_models
 from sklearn_evaluation.Logger import Logger
+from lib_cinci.prediction_store import PredictionStore
 import ast
 import itertools
 
@@ -67,33 +68,50 @@ all_models = [item for sublist in all_models_by_experiment for item in sublist]
 for m in all_models:
     m['model_id'] = str(m['_id'])
 
+def validation_precision(models, validation_inspections):
+    '''
+        Validation precision and labeled percent for every model in models
+        (all with the same validation window). Top k scores of every model
+        are put in a (models x parcels) matrix, parcels not in the top k of
+        a model get -inf, then precision at k is computed for all models
+        at once (parcels not inspected are ignored)
+    '''
+    store = PredictionStore(path_to_predictions)
+    index, scores = store.load_matrix([model['model_id'] for model in models],
+                                      top=k)
+    sizes = np.isfinite(scores).sum(axis=1)
+    scores[np.isnan(scores)] = -np.inf
+    parcels = index.get_level_values('parcel_id')
+    labels = validation_inspections.viol_outcome.reindex(parcels).values
+
+    #Models with the same number of saved predictions are evaluated together
+    for size in np.unique(sizes):
+        rows = np.where(sizes == size)[0]
+        metrics = metrics_at_percents_for_models(labels, scores[rows], ks=[size],
+                                                 ignore_nas=True)
+        for row, precision, labeled in zip(rows, metrics['precision'][:, 0],
+                                           (metrics['tp'] + metrics['fp'])[:, 0]):
+            models[row]['validation_precision_at_p'] = precision
+            models[row]['validation_labeled_percent'] = 100.0*labeled/k
+
+models_by_test_start = {}
 for model in all_models:
     # get validation start date, end date 
     test_start = re.split('_', model['experiment_name'])[2].lower()
     model['test_start'] = test_start
+    models_by_test_start.setdefault(test_start, []).append(model)
 
+for test_start, models in models_by_test_start.items():
     validation_start = datetime.strptime(test_start, '%d%b%Y') + relativedelta(months=validation_months)
     validation_end = validation_start + relativedelta(months=validation_months) 
-    
-    # get saved scores
-    model_top_k = pd.read_csv(os.path.join(path_to_predictions, model['model_id']), 
-                              nrows=k,
-                              index_col='parcel_id',
-                              usecols=['parcel_id','prediction']) 
-    
-    # load inspection results from validation window 
+
+    # load inspection results from validation window (once for all models
+    # with the same window)
     validation_inspections = load_one_inspection_per_parcel(validation_start, validation_end)
-    
-    # get intersection of this model's top k with parcels that were inspected
-    # during validation window, and the results of those inspections
-    top_k_inspected = model_top_k.join(validation_inspections)
-
-    # get validation precision and labeled percent
-    model['validation_precision_at_p'] =  precision_at(top_k_inspected.viol_outcome,
-                                                       model_top_k.prediction,
-                                                       percent=1.0, # precision is calculated on top k, so use 100%
-                                                       ignore_nas=True)[0] # not all parcels in top k will have inspections
-    model['validation_labeled_percent'] = 100.0*(top_k_inspected.viol_outcome.notnull().sum())/k
+
+    # get intersection of every model's top k with parcels that were inspected
+    # during validation window, and the precision in them
+    validation_precision(models, validation_inspections)
 
 all_models_df = pd.DataFrame(all_models)
 all_models_df.set_index('model_id', inplace=True)
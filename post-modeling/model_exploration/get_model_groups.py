@@ -31,14 +31,21 @@ query = 'SELECT * FROM model_results.all_models;'
 all_models = pd.read_sql(query, engine, index_col='model_id')
 engine.dispose()
 
-# add group number to all models
+# add group number to all models, groups are computed in MongoDB and
+# numbered in the order their first member appears in all_models
+groups = logger.group_models_across_splits(all_models.index.values)
+group_of = {}
+for group in groups:
+    for model_id in group:
+        group_of[str(model_id)] = group
+
 all_models['group_number'] = None
 group_number = 1
 
 for model in all_models.index.values:
     # only start a new group if this model is not already a group member 
     if all_models.loc[model, 'group_number'] is None:
-        model_group = [str(model_id) for model_id in Logger.get_model_across_splits(logger, model)]
+        model_group = [str(model_id) for model_id in group_of.get(model, [])]
         model_group.append(model)
 
         for friend in model_group:
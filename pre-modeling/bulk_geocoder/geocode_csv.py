@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 #CLI interface for geocoding csv files
-from geocoding_tools import geocode_dataframe
+from geocoding_tools import geocode_dataframe, GeocodeCache
 import argparse
+import os
 import pandas as pd
 
 parser = argparse.ArgumentParser()
@@ -12,9 +13,23 @@ parser.add_argument("input", help=("Input csv file to geocode. There should be "
 parser.add_argument("output", help="Output geocoded csv file.", type=str)
 parser.add_argument("-sep", "--separator", help="separator in the file, defaults to ','",
                     type=str, default=',')
+parser.add_argument("-c", "--cache", help=("SQLite file with addresses that were "
+                                          "already geocoded, new ones are added to it. "
+                                          "Defaults to $DATA_FOLDER/etl/geocode_cache.sqlite"),
+                    type=str, default=None)
+parser.add_argument("--no-cache", help="Send every address to the geocoder",
+                    action='store_true')
 args = parser.parse_args()
 
+if args.no_cache:
+    cache = None
+else:
+    path = args.cache or os.path.join(os.environ['DATA_FOLDER'], 'etl',
+                                      'geocode_cache.sqlite')
+    print 'Using geocode cache in {}'.format(path)
+    cache = GeocodeCache(path)
+
 #Load data
 df = pd.read_csv(args.input, sep=args.separator, dtype='object')
-res = geocode_dataframe(df)
+res = geocode_dataframe(df, cache=cache)
 res.to_csv(args.output, index=False)
@@ -1,20 +1,95 @@
 from __future__ import division
-import grequests
+import json
+import sqlite3
 import pandas as pd
 import re
 from StringIO import StringIO
 
+#Census batch geocoder
+#http://geocoding.geo.census.gov/geocoder/Geocoding_Services_API.html
+CENSUS_URL = "https://geocoding.geo.census.gov/geocoder/locations/addressbatch"
+CENSUS_DATA = {'benchmark': 'Public_AR_Census2010'}
+# CENSUS_DATA = {'benchmark': 'Public_AR_Current', 'vintage': 'ACS2013_Current'}
+
 class BadInputError(ValueError):
     '''Raise when the input Data Frame does not contain a appropiate input'''
     def __init__(self, message, *args):
         self.message = message
         super(BadInputError, self).__init__(message, *args) 
 
-def geocode_dataframe(df):
+def normalize_address(address):
+    '''
+        Key for an address in the cache: upper case, no repeated spaces
+        and no spaces around commas
+    '''
+    address = ' '.join(address.upper().split())
+    return re.sub(r'\s*,\s*', ',', address)
+
+class GeocodeCache(object):
+    '''
+        SQLite file with the census results for every address that
+        was sent to the geocoder, so addresses are geocoded only once
+        across runs. Results are saved after every batch of requests,
+        so an interrupted run can be resumed
+    '''
+    def __init__(self, path):
+        self.con = sqlite3.connect(path)
+        self.con.execute('CREATE TABLE IF NOT EXISTS geocodes '
+                         '(address TEXT PRIMARY KEY, result TEXT)')
+        self.con.commit()
+
+    def get_many(self, addresses):
+        '''
+            Dictionary with the cached result (without the id) for
+            every address in the cache
+        '''
+        keys = list(set(normalize_address(a) for a in addresses))
+        found = {}
+        #SQLite limits the number of parameters in a query
+        for start in xrange(0, len(keys), 500):
+            chunk = keys[start:start+500]
+            query = ('SELECT address, result FROM geocodes WHERE address IN '
+                     '({})'.format(','.join('?'*len(chunk))))
+            for key, result in self.con.execute(query, chunk):
+                found[key] = json.loads(result)
+        return {a: found[normalize_address(a)] for a in addresses
+                if normalize_address(a) in found}
+
+    def put_many(self, results):
+        '''
+            Save results, a list of (address, result) tuples
+        '''
+        self.con.executemany('INSERT OR REPLACE INTO geocodes VALUES (?, ?)',
+                             [(normalize_address(a), json.dumps(r))
+                              for a, r in results])
+        self.con.commit()
+
+    def __len__(self):
+        return self.con.execute('SELECT count(*) FROM geocodes').fetchone()[0]
+
+def census_service(files_content, url=CENSUS_URL, data=CENSUS_DATA):
+    '''
+        Send every file (a string with one address per line) to the census
+        batch geocoder at the same time. Returns a list with the content of
+        every response, None for requests that failed
+    '''
+    #grequests is only needed to use the census API, import it
+    #here so the module can be used with other services
+    import grequests
+    #http://stackoverflow.com/questions/25024087/mimic-curl-in-python
+    rs = (grequests.post(url, data=data,
+                         files={'addressFile': ('%d.csv'%idx, StringIO(a_file), 'text/csv')})
+          for idx, a_file in enumerate(files_content))
+    responses = grequests.map(rs, size=len(files_content))
+    return [r.content if r is not None and r.status_code == 200 else None
+            for r in responses]
+
+def geocode_dataframe(df, cache=None, service=census_service):
     '''
         Geocodes a Pandas dataframe.
         There should be an address, city, state and zip column.
         Columns can be empty (except address)
+        See geocode_list for cache and service
     '''
     #Check that address column does not contain null or empty strings
     #bad_addresses = df.address.isnull().sum() + (df.address == '').sum()
@@ -46,7 +121,7 @@ def geocode_dataframe(df):
     addresses = [fn(x) for x in id_addresses]
     #TO DO: Check that addresses do not contain commas
     #Geocode addresses using the batch census API
-    census_results = geocode_list(addresses)
+    census_results = geocode_list(addresses, cache=cache, service=service)
     #I don't see any documention about the
     #census output format, I'm guessing here
     res = pd.DataFrame(census_results)
@@ -84,51 +159,65 @@ def geocode_dataframe(df):
     print '{0:.2%} total addresses geocoded'.format(n_total_geocoded/n_addresses)
     return output
 
-def geocode_list(l):
+def geocode_list(l, cache=None, service=census_service, chunksize=1000,
+                 concurrency=50, max_attempts=3):
     '''
         Geocodes a list in which every element has the form
         Unique ID, Street address, City, State, ZIP
         Using http://geocoding.geo.census.gov/geocoder/Geocoding_Services_API.html
+
+        Addresses in cache (a GeocodeCache) are not sent to the geocoder,
+        new results are saved to it after every batch. service is a
+        function that takes a list of files and returns the content
+        of their responses (see census_service). Requests that fail are
+        retried up to max_attempts times
     '''
-    #Get ids in the list
     to_geocode = len(l)
-    remaining_ids = set([element.split(',')[0] for element in l])
+    pending = [tuple(element.split(',', 1)) for element in l]
     geocoded = []
-    try_again = True
 
-    #Request parameters
-    #http://stackoverflow.com/questions/25024087/mimic-curl-in-python
-    url = "https://geocoding.geo.census.gov/geocoder/locations/addressbatch"
-    data = {'benchmark': 'Public_AR_Census2010'}
-    # data = {'benchmark': 'Public_AR_Current', 'vintage': 'ACS2013_Current'}
-
-
-    while try_again:
-        #Split the list in chunks with max 1000 elements
-        chunks = list(__make_chunks(l, 1000))
-        #Combine each chunk so it only has one big string
-        files_content = [reduce(lambda x,y: x+'\n'+y, chunk) for chunk in chunks]
-        #Create the request objects
-        rs = (grequests.post(url, data=data, files={'addressFile': ('%d.csv'%idx, StringIO(a_file), 'text/csv')}) for idx, a_file in enumerate(files_content))
-        #Make the calls, send in batches
-        responses = grequests.map(rs, size=50)
-        #Get the content for each response
-        contents = [r.content for r in responses]
-        #Parse each content received and return
-        #parse elements
-        valid = __parse_contents(contents)
-        #Add elements to the geocoded list
-        geocoded.extend(valid)
-        print 'Geocoded {} out of {}. {} on this attempt.'.format(len(geocoded),
-                                                            to_geocode,
-                                                            len(valid))
-        remaining_ids = remaining_ids - set([e[0] for e in valid])
-        l = [e for e in l if e.split(',')[0] in remaining_ids]   
-        #Try gain only if in this attempt, the api geocoded_address
+    if cache is not None:
+        cached = cache.get_many([address for _, address in pending])
+        #The census API returns the input address as the second element,
+        #use the one in l in case the cached one was written differently
+        geocoded.extend([[id_, address] + cached[address][1:]
+                         for id_, address in pending if address in cached])
+        pending = [(id_, address) for id_, address in pending
+                   if address not in cached]
+        print '{} addresses found in the cache'.format(len(geocoded))
+
+    for attempt in range(max_attempts):
+        if not pending:
+            break
+        #Split the list in chunks with max chunksize elements
+        chunks = list(__make_chunks(pending, chunksize))
+        n_geocoded = len(geocoded)
+        #Send concurrency chunks at the same time
+        for batch in __make_chunks(chunks, concurrency):
+            files_content = ['\n'.join('{},{}'.format(id_, address)
+                                       for id_, address in chunk)
+                             for chunk in batch]
+            contents = service(files_content)
+            for chunk, content in zip(batch, contents):
+                if content is None:
+                    continue
+                valid = __parse_contents([content])
+                addresses = dict(chunk)
+                valid = [e for e in valid if e[0] in addresses]
+                geocoded.extend(valid)
+                if cache is not None:
+                    cache.put_many([(addresses[e[0]], e[1:]) for e in valid])
+        done = set(e[0] for e in geocoded)
+        pending = [(id_, address) for id_, address in pending if id_ not in done]
+        print 'Geocoded {} out of {}. {} on attempt {}.'.format(len(geocoded),
+                                                              to_geocode,
+                                                              len(geocoded) - n_geocoded,
+                                                              attempt + 1)
+        #Try again only if in this attempt, the api geocoded
         #at least one
-        try_again = len(valid)>0
-        if not try_again:
+        if len(geocoded) == n_geocoded:
             print 'Couldnt geocode any on this attempt. Finishing...'
+            break
     return geocoded
 
 def __parse_contents(contents):
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from geocoding_tools import geocode_list, GeocodeCache, normalize_address
+
+
+class LocalService(object):
+    '''
+        Stand-in for the census API, every address is matched to
+        itself (in upper case, with elements separated by ', ' like the
+        census API does), fails the first request if fail_first is True
+    '''
+    def __init__(self, fail_first=False):
+        self.sent = []
+        self.fail_first = fail_first
+
+    def __call__(self, files_content):
+        contents = []
+        for content in files_content:
+            lines = content.split('\n')
+            self.sent.append(lines)
+            if self.fail_first:
+                self.fail_first = False
+                contents.append(None)
+                continue
+            contents.append('\n'.join(
+                '"{}","{}","Match","Exact","{}","-84.5,39.1","1","L"'.format(
+                    line.split(',', 1)[0], line.split(',', 1)[1],
+                    ', '.join(line.split(',')[1:]).upper())
+                for line in lines))
+        return contents
+
+
+class TestGeocodeList(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = GeocodeCache(os.path.join(self.folder, 'cache.sqlite'))
+        self.addresses = ['0,1 Main St,Cincinnati,OH,45202',
+                          '1,2 Main St,Cincinnati,OH,45202',
+                          '2,3 Main St,Cincinnati,OH,45202']
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_only_new_addresses_are_sent(self):
+        service = LocalService()
+        geocode_list(self.addresses[:2], cache=self.cache, service=service)
+        self.assertEqual(len(self.cache), 2)
+        #Same address written differently and a new one
+        res = geocode_list(['5,1 main st , Cincinnati,OH,45202', '6,3 Main St,Cincinnati,OH,45202'],
+                           cache=self.cache, service=service)
+        self.assertEqual(service.sent[-1], ['6,3 Main St,Cincinnati,OH,45202'])
+        self.assertEqual(sorted(r[0] for r in res), ['5', '6'])
+        cached = [r for r in res if r[0] == '5'][0]
+        self.assertEqual(cached[1], '1 main st , Cincinnati,OH,45202')
+        self.assertEqual(cached[4], '1 MAIN ST, CINCINNATI, OH, 45202')
+
+    def test_failed_chunks_are_retried(self):
+        service = LocalService(fail_first=True)
+        res = geocode_list(self.addresses, service=service, chunksize=2)
+        self.assertEqual(sorted(r[0] for r in res), ['0', '1', '2'])
+        #Only the chunk that failed is sent again
+        self.assertEqual(service.sent[2], self.addresses[:2])
+        self.assertEqual(len(service.sent), 3)
+
+    def test_normalize_address(self):
+        self.assertEqual(normalize_address(' 1  main st , cincinnati,OH '),
+                         '1 MAIN ST,CINCINNATI,OH')
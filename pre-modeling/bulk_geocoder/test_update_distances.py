@@ -0,0 +1,143 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from update_distances import (changed, point_tiles, box_tiles, dirty_tiles,
+                              points_by_tile, tile_updates, run_key)
+
+
+def points(ids, hashes, xs, ys):
+    return pd.DataFrame({'id': ids, 'geom_hash': hashes, 'x': xs, 'y': ys},
+                        columns=['id', 'geom_hash', 'x', 'y'])
+
+
+def parcels(ids, hashes, boxes):
+    df = pd.DataFrame(boxes, columns=['xmin', 'ymin', 'xmax', 'ymax'])
+    df.insert(0, 'geom_hash', hashes)
+    df.insert(0, 'parcel_id', ids)
+    return df
+
+
+class TestChanged(unittest.TestCase):
+
+    def test_new_removed_and_moved(self):
+        old = points([1, 2, 3], ['a', 'b', 'c'], [0, 0, 0], [0, 0, 0])
+        new = points([2, 3, 4], ['b', 'x', 'd'], [0, 10, 0], [0, 10, 0])
+        df = changed(old, new, 'id')
+        self.assertEqual(sorted(df.id), [1, 3, 4])
+
+    def test_nothing_changed(self):
+        old = points([1, 2], ['a', 'b'], [0, 0], [0, 0])
+        self.assertEqual(len(changed(old, old.copy(), 'id')), 0)
+
+
+class TestTiles(unittest.TestCase):
+
+    def test_point_tiles(self):
+        tiles = point_tiles([0, 99.9, 100, -1], [0, 250, 0, -1], 100)
+        np.testing.assert_array_equal(tiles, [[0, 0], [0, 2], [1, 0], [-1, -1]])
+
+    def test_box_tiles_with_margin(self):
+        self.assertEqual(box_tiles([110], [110], [120], [120], 100),
+                         set([(1, 1)]))
+        self.assertEqual(box_tiles([110], [110], [120], [120], 100, margin=20),
+                         set((i, j) for i in range(0, 2) for j in range(0, 2)))
+
+    def test_points_by_tile(self):
+        df = points([1, 2, 3], ['a', 'b', 'c'], [0, 50, 150], [0, 50, 0])
+        self.assertEqual(points_by_tile(df, 100), {(0, 0): [1, 2], (1, 0): [3]})
+        self.assertEqual(points_by_tile(df.iloc[:0], 100), {})
+
+
+class TestDirtyTiles(unittest.TestCase):
+
+    def setUp(self):
+        self.parcels = parcels(['p1', 'p2'], ['a', 'b'],
+                               [[0, 0, 10, 10], [500, 500, 510, 510]])
+        self.points = points([1, 2], ['a', 'b'], [5, 505], [5, 505])
+
+    def tiles(self, new_parcels, new_points):
+        return dirty_tiles(changed(self.parcels, new_parcels, 'parcel_id'),
+                           changed(self.points, new_points, 'id'),
+                           tile_size=100, margin=50)
+
+    def test_nothing_changed(self):
+        self.assertEqual(self.tiles(self.parcels, self.points), set())
+
+    def test_moved_point_marks_old_and_new_tile(self):
+        new_points = self.points.copy()
+        new_points.loc[0, ['geom_hash', 'x', 'y']] = ['x', 305, 5]
+        self.assertEqual(self.tiles(self.parcels, new_points),
+                         set([(0, 0), (3, 0)]))
+
+    def test_removed_parcel_marks_tiles_within_margin(self):
+        self.assertEqual(self.tiles(self.parcels.iloc[:1], self.points),
+                         set((i, j) for i in range(4, 6) for j in range(4, 6)))
+
+    def test_new_parcel_marks_tiles_within_margin(self):
+        new_parcels = self.parcels.append(parcels(['p3'], ['c'],
+                                                  [[260, 260, 270, 270]]))
+        self.assertEqual(self.tiles(new_parcels, self.points),
+                         set((i, j) for i in range(2, 4) for j in range(2, 4)))
+
+
+class TestTileUpdates(unittest.TestCase):
+
+    def apply(self, old, new, tile_size=100):
+        '''
+            Run the updates for old and new points on a set of point ids
+            with pairs (like update_tile does on the pairs table), starting
+            with pairs for every old point
+        '''
+        no_parcels = parcels([], [], [])
+        tiles = sorted(dirty_tiles(changed(no_parcels, no_parcels, 'parcel_id'),
+                                   changed(old, new, 'id'), tile_size))
+        with_pairs = set(old.id)
+        for tile, delete, insert in tile_updates(tiles,
+                                                 points_by_tile(old, tile_size),
+                                                 points_by_tile(new, tile_size)):
+            with_pairs.difference_update(delete)
+            with_pairs.update(insert)
+        return with_pairs
+
+    def test_point_moves_to_a_later_tile(self):
+        old = points([1, 2], ['a', 'b'], [5, 150], [5, 5])
+        new = points([1, 2], ['x', 'b'], [305, 150], [5, 5])
+        self.assertEqual(self.apply(old, new), set([1, 2]))
+
+    def test_point_moves_to_an_earlier_tile(self):
+        old = points([1, 2], ['a', 'b'], [305, 150], [5, 5])
+        new = points([1, 2], ['x', 'b'], [5, 150], [5, 5])
+        self.assertEqual(self.apply(old, new), set([1, 2]))
+
+    def test_removed_point_loses_its_pairs(self):
+        old = points([1, 2], ['a', 'b'], [5, 150], [5, 5])
+        new = points([2], ['b'], [150], [5])
+        self.assertEqual(self.apply(old, new), set([2]))
+
+
+class TestRunKey(unittest.TestCase):
+
+    def setUp(self):
+        self.parcels = parcels(['p1'], ['a'], [[0, 0, 10, 10]])
+        self.points = points([1, 2], ['a', 'b'], [5, 150], [5, 5])
+
+    def test_same_data_same_key(self):
+        empty_parcels, empty_points = self.parcels.iloc[:0], self.points.iloc[:0]
+        key = run_key(empty_parcels, empty_points, self.parcels, self.points, 100)
+        self.assertEqual(key, run_key(empty_parcels, empty_points,
+                                      self.parcels, self.points.iloc[::-1], 100))
+
+    def test_changes_change_the_key(self):
+        empty_parcels, empty_points = self.parcels.iloc[:0], self.points.iloc[:0]
+        key = run_key(empty_parcels, empty_points, self.parcels, self.points, 100)
+        moved = self.points.copy()
+        moved.loc[0, 'geom_hash'] = 'x'
+        self.assertNotEqual(key, run_key(empty_parcels, empty_points,
+                                         self.parcels, moved, 100))
+        self.assertNotEqual(key, run_key(empty_parcels, empty_points,
+                                         self.parcels, self.points, 200))
+        #Same points before and after is not the same run
+        self.assertNotEqual(key, run_key(self.parcels, self.points,
+                                         self.parcels, self.points, 100))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+
+import numpy as np
+import pandas as pd
+import psycopg2
+from sqlalchemy import create_engine
+
+from lib_cinci.db import uri, libpq_uri
+from lib_cinci.bulk_writer import copy_to_sql, frame_to_csv
+
+#Keeps the parcel2address (and parcel2three11) tables up to date without
+#recomputing every distance. The city is split in square tiles and every
+#run compares parcels and points (addresses or three11 events) with the
+#ones used in the previous run (saved in the {pairs}_parcels and
+#{pairs}_points tables). Only tiles with points that changed, or points
+#that may be within MAX_DIST of a parcel that changed, are recomputed:
+#their pairs are deleted and computed again with PostGIS, and written
+#with COPY. Tiles are committed one at a time and saved in the
+#{pairs}_progress table, if a run is interrupted, the next one (with the
+#same parcels and points) skips the tiles that were done.
+
+#Units for SRID 3735 are US survey foot
+#1000 m ~ 3281 US survey foot
+MAX_DIST_FOOT = 3281
+FOOT_PER_METER = 3.281
+
+#Point table -> (table with the pairs, column with the point id)
+TARGETS = {'address': ('parcel2address', 'address_id'),
+           'three11': ('parcel2three11', 'event_id')}
+
+
+def load_parcels(con):
+    '''
+        One row per parcel in shape_files.parcels_cincy with a hash of
+        its geometry and its bounding box
+    '''
+    query = ('SELECT parcelid AS parcel_id, '
+             "md5(string_agg(md5(ST_AsBinary(geom)), '' "
+             'ORDER BY md5(ST_AsBinary(geom)))) AS geom_hash, '
+             'ST_XMin(ST_Extent(geom)) AS xmin, ST_YMin(ST_Extent(geom)) AS ymin, '
+             'ST_XMax(ST_Extent(geom)) AS xmax, ST_YMax(ST_Extent(geom)) AS ymax '
+             'FROM shape_files.parcels_cincy '
+             'WHERE parcelid IS NOT NULL AND geom IS NOT NULL '
+             'GROUP BY parcelid')
+    return pd.read_sql(query, con)
+
+
+def load_points(con, table):
+    '''
+        One row per point in table with a hash of its geometry
+        and its coordinates
+    '''
+    query = ('SELECT id, md5(ST_AsBinary(geom)) AS geom_hash, '
+             'ST_X(geom) AS x, ST_Y(geom) AS y '
+             'FROM public.{} WHERE geom IS NOT NULL').format(table)
+    return pd.read_sql(query, con)
+
+
+def changed(old, new, key):
+    '''
+        Rows that are new, removed or whose geometry changed, with the
+        old and new columns (suffixes _old and _new)
+    '''
+    merged = old.merge(new, on=key, how='outer', suffixes=('_old', '_new'))
+    return merged[merged.geom_hash_old.values != merged.geom_hash_new.values]
+
+
+def point_tiles(x, y, tile_size):
+    '''
+        Tile for every point, as an array of (column, row)
+    '''
+    return np.column_stack([np.floor(np.asarray(x, dtype=float)/tile_size),
+                            np.floor(np.asarray(y, dtype=float)/tile_size)]).astype(int)
+
+
+def box_tiles(xmin, ymin, xmax, ymax, tile_size, margin=0):
+    '''
+        Set of tiles that intersect any of the boxes, after
+        expanding them by margin
+    '''
+    first = point_tiles(np.asarray(xmin) - margin, np.asarray(ymin) - margin,
+                        tile_size)
+    last = point_tiles(np.asarray(xmax) + margin, np.asarray(ymax) + margin,
+                       tile_size)
+    tiles = set()
+    for (i0, j0), (i1, j1) in zip(first, last):
+        tiles.update((i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1))
+    return tiles
+
+
+def dirty_tiles(changed_parcels, changed_points, tile_size,
+                margin=MAX_DIST_FOOT):
+    '''
+        Tiles whose points need new distances: tiles with points that
+        changed (before and after the change) and tiles with points that
+        may be within margin of a parcel that changed
+    '''
+    tiles = set()
+    for suffix in ('_old', '_new'):
+        points = changed_points[changed_points['geom_hash' + suffix].notnull()]
+        tiles.update(map(tuple, point_tiles(points['x' + suffix],
+                                            points['y' + suffix], tile_size)))
+        parcels = changed_parcels[changed_parcels['geom_hash' + suffix].notnull()]
+        tiles.update(box_tiles(parcels['xmin' + suffix], parcels['ymin' + suffix],
+                               parcels['xmax' + suffix], parcels['ymax' + suffix],
+                               tile_size, margin))
+    return tiles
+
+
+def points_by_tile(points, tile_size):
+    '''
+        Dictionary with the list of point ids in every tile
+    '''
+    if not len(points):
+        return {}
+    tiles = point_tiles(points.x, points.y, tile_size)
+    grouped = pd.Series(points.id.values).groupby([tiles[:, 0], tiles[:, 1]])
+    return {tile: list(ids) for tile, ids in grouped}
+
+
+def tile_updates(tiles, old_by_tile, new_by_tile):
+    '''
+        For every tile with points, the ids whose pairs are deleted and
+        the ids whose pairs are computed again, as (tile, delete, insert).
+        Points that moved to another tile are only deleted (and inserted)
+        in their new tile, otherwise the tile they left could delete the
+        pairs inserted in their new one
+    '''
+    current = set()
+    for ids in new_by_tile.values():
+        current.update(ids)
+    for tile in tiles:
+        old_ids = old_by_tile.get(tile, [])
+        new_ids = new_by_tile.get(tile, [])
+        if not old_ids and not new_ids:
+            continue
+        delete = set(new_ids) | (set(old_ids) - current)
+        yield tile, sorted(delete), sorted(new_ids)
+
+
+def run_key(old_parcels, old_points, parcels, points, tile_size):
+    '''
+        Hash of the parcels and points before and after a run, runs with
+        the same key update the same tiles with the same results
+    '''
+    md5 = hashlib.md5(str(tile_size))
+    for df in (old_parcels, old_points, parcels, points):
+        md5.update(','.join(sorted(df.geom_hash.astype(str))))
+        md5.update('|')
+    return md5.hexdigest()
+
+
+def update_tile(con, table, pairs, key, delete_ids, insert_ids, run_id, tile):
+    '''
+        Delete pairs for delete_ids and compute the ones for
+        insert_ids, the tile is saved as done for run_id (see run_key) in
+        the same transaction. Returns (removed, added)
+    '''
+    cur = con.cursor()
+    cur.execute('DELETE FROM {pairs} WHERE {key} = ANY(%(ids)s);'
+                .format(pairs=pairs, key=key), {'ids': delete_ids})
+    removed = cur.rowcount
+
+    query = ('SELECT parcels.parcelid AS parcel_id, points.id AS {key}, '
+             'ST_Distance(parcels.geom, points.geom)/{foot_per_meter} AS dist_m '
+             'FROM public.{table} AS points '
+             'JOIN shape_files.parcels_cincy AS parcels '
+             'ON ST_DWithin(parcels.geom, points.geom, {max_dist}) '
+             'WHERE points.id = ANY(%(ids)s)').format(key=key, table=table,
+                                                     foot_per_meter=FOOT_PER_METER,
+                                                     max_dist=MAX_DIST_FOOT)
+    df = pd.read_sql(query, con, params={'ids': insert_ids})
+    if len(df):
+        cur.copy_expert(('COPY {} (parcel_id, {}, dist_m) FROM STDIN '
+                         'WITH (FORMAT csv)').format(pairs, key),
+                        frame_to_csv(df))
+    cur.execute('INSERT INTO {}_progress (run_key, x, y) VALUES (%s, %s, %s);'
+                .format(pairs), (run_id, int(tile[0]), int(tile[1])))
+    con.commit()
+    cur.close()
+    return removed, len(df)
+
+
+def update_distances(table, tile_size, rebuild=False):
+    pairs, key = TARGETS[table]
+    e = create_engine(uri)
+    con = psycopg2.connect(libpq_uri)
+    cur = con.cursor()
+
+    parcels = load_parcels(con)
+    points = load_points(con, table)
+    print 'Loaded {:,d} parcels and {:,d} points'.format(len(parcels), len(points))
+
+    cur.execute('CREATE TABLE IF NOT EXISTS {}_progress (run_key text, '
+                'x integer, y integer);'.format(pairs))
+    cur.execute('SELECT to_regclass(%s);', ('{}_parcels'.format(pairs),))
+    has_state = cur.fetchone()[0] is not None
+    if has_state and rebuild:
+        #Saved parcels are only empty while a rebuild is running, if the
+        #rebuild was interrupted it is resumed
+        cur.execute('SELECT count(*) FROM {}_parcels;'.format(pairs))
+        rebuild = cur.fetchone()[0] > 0
+    removed = 0
+    if rebuild or not has_state:
+        #Without the previous parcels and points every tile is
+        #recomputed, start from an empty table. Saved parcels and points
+        #are emptied too, so an interrupted run is resumed as a rebuild
+        print 'Computing every distance, truncating {}'.format(pairs)
+        cur.execute('SELECT count(*) FROM {};'.format(pairs))
+        removed = cur.fetchone()[0]
+        cur.execute('''
+            DROP TABLE IF EXISTS {pairs}_parcels;
+            DROP TABLE IF EXISTS {pairs}_points;
+            CREATE TABLE {pairs}_parcels (parcel_id text, geom_hash text,
+                xmin float8, ymin float8, xmax float8, ymax float8);
+            CREATE TABLE {pairs}_points (id integer, geom_hash text,
+                x float8, y float8);
+            TRUNCATE {pairs};
+            TRUNCATE {pairs}_progress;
+        '''.format(pairs=pairs))
+        con.commit()
+
+    old_parcels = pd.read_sql('SELECT * FROM {}_parcels'.format(pairs), con)
+    old_points = pd.read_sql('SELECT * FROM {}_points'.format(pairs), con)
+
+    #Tiles done by a previous run that was interrupted
+    run_id = run_key(old_parcels, old_points, parcels, points, tile_size)
+    cur.execute('DELETE FROM {}_progress WHERE run_key <> %s;'.format(pairs),
+                (run_id,))
+    cur.execute('SELECT x, y FROM {}_progress;'.format(pairs))
+    done = set(cur.fetchall())
+    con.commit()
+
+    changed_parcels = changed(old_parcels, parcels, 'parcel_id')
+    changed_points = changed(old_points, points, 'id')
+    tiles = sorted(dirty_tiles(changed_parcels, changed_points, tile_size))
+    print ('{:,d} parcels and {:,d} points changed, {:,d} tiles to '
+           'update').format(len(changed_parcels), len(changed_points), len(tiles))
+    if done:
+        print 'Resuming, {:,d} tiles were updated by a previous run'.format(len(done))
+        tiles = [tile for tile in tiles if tile not in done]
+
+    old_by_tile = points_by_tile(old_points, tile_size)
+    new_by_tile = points_by_tile(points, tile_size)
+    added = 0
+    updates = tile_updates(tiles, old_by_tile, new_by_tile)
+    for n, (tile, delete_ids, insert_ids) in enumerate(updates):
+        tile_removed, tile_added = update_tile(con, table, pairs, key,
+                                               delete_ids, insert_ids,
+                                               run_id, tile)
+        removed += tile_removed
+        added += tile_added
+        if (n + 1) % 100 == 0:
+            print '    {:,d} tiles updated'.format(n + 1)
+
+    #Save the parcels and points used, only after every tile was updated,
+    #if the run is interrupted, the next one updates the same tiles
+    #(skipping the ones in the progress table)
+    copy_to_sql(parcels, '{}_parcels'.format(pairs), e, if_exists='replace',
+                index=False)
+    copy_to_sql(points, '{}_points'.format(pairs), e, if_exists='replace',
+                index=False)
+    cur.execute('TRUNCATE {}_progress;'.format(pairs))
+
+    #Keep the last updated event in sync with the table
+    cur.execute('DELETE FROM last_updated_event WHERE table_name = %s;', (table,))
+    cur.execute('INSERT INTO last_updated_event (table_name, event_id) '
+                'SELECT %s, coalesce(MAX(id), 0) FROM public.{};'.format(table),
+                (table,))
+    con.commit()
+    cur.close()
+    con.close()
+    print 'Done. {:,d} pairs added and {:,d} removed in {}'.format(added, removed,
+                                                                pairs)
+    return added, removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=("Update the distances "
+        "from every parcel to points (addresses or three11 events) within "
+        "1000 m, only for tiles where parcels or points changed"))
+    parser.add_argument("table", choices=sorted(TARGETS.keys()),
+                        help="Table with the points")
+    parser.add_argument("-t", "--tile_size",
+                        help=("Size of the tiles in US survey foot. "
+                              "Defaults to 3281 (1000 m)"),
+                        type=float, default=MAX_DIST_FOOT)
+    parser.add_argument("-r", "--rebuild", action='store_true',
+                        help="Recompute every distance")
+    args = parser.parse_args()
+    update_distances(args.table, args.tile_size, args.rebuild)
@@ -1,14 +1,6 @@
---Units for SRID 3735 are US survey foot
---https://en.wikipedia.org/wiki/Foot_(unit)#US_survey_foot
---1 US survey foot = 1200⁄3937 m
---1000 m ~ 3281 US survey foot
--- X [US Survey foot] / 3.281 ~ Y m
-INSERT INTO last_updated_event
-    (table_name, event_id)
-    SELECT 'three11', 0
-WHERE NOT EXISTS (
-    SELECT table_name FROM last_updated_event WHERE table_name = 'three11'
-);
+--Creates parcel2three11 table, which will store records for each parcel to
+--three11 events nearby. Distances are computed by
+--bulk_geocoder/update_distances.py
 
 --Create table if doesn't exist
 CREATE TABLE IF NOT EXISTS parcel2three11 (
@@ -20,21 +12,3 @@ CREATE TABLE IF NOT EXISTS parcel2three11 (
 CREATE INDEX three11_parcel_id_index ON parcel2three11 (parcel_id);
 CREATE INDEX three11_event_id_index ON parcel2three11 (event_id);
 CREATE INDEX three11_dist_m_index ON parcel2three11 (dist_m);
-    
---Insert new rows into table
-INSERT INTO parcel2three11(
-    parcel_id,
-    event_id,
-    dist_m
-)
---subselect table with rows that have an id greater than the one stored in last_updated_event table
-SELECT parcels.parcelid AS parcel_id, new_records.id AS event_id, ST_Distance(parcels.geom, new_records.geom)/3.281 AS dist_m
-FROM shape_files.parcels_cincy AS parcels
-JOIN three11 AS new_records
-ON ST_DWithin(parcels.geom, new_records.geom, 3281)
-WHERE new_records.id > (SELECT event_id FROM last_updated_event WHERE table_name='three11');
-
---Update last_updated_event table
-UPDATE last_updated_event
-    SET event_id = (SELECT MAX(id) FROM three11)
-    WHERE table_name = 'three11';